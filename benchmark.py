@@ -0,0 +1,391 @@
+"""
+Scan-storm benchmark: seeds a synthetic roster and session history, then drives
+the Flask app with concurrent clients the way a live class does (a burst of
+/validate scans while displays poll /qr and dashboards refresh), and reports
+throughput and p50/p95/p99 per endpoint plus micro-benchmarks of QR rendering
+and the report export path.
+
+    python benchmark.py                                  # in-memory store, defaults
+    python benchmark.py --backend sqlite --students 3000 --scans 600 --duration 10
+    python benchmark.py --save bench.json                # record a baseline
+    python benchmark.py --baseline bench.json            # exit 1 if a p95 regressed
+
+Latencies are measured from each request's planned arrival time, so time spent
+waiting for a free client thread counts (no coordinated omission). The app's
+own environment variables (ATTENDANCE_WRITE_MODE, QR_TOKEN_MODE, ...) apply.
+"""
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import click
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+def summarise(name, latencies, errors, seconds):
+    latencies = sorted(latencies)
+    return {
+        "name": name,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / seconds, 1) if seconds else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+    }
+
+
+def echo_table(title, rows):
+    click.echo(f"\n{title}")
+    click.echo(f"{'':<28}{'n':>7}{'err':>6}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for r in rows:
+        click.echo(f"{r['name']:<28}{r['requests']:>7}{r['errors']:>6}{r['rps']:>9}"
+                   f"{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}{r['max_ms']:>10}")
+
+
+class Recorder:
+    """Thread-safe latency samples and error counts per endpoint"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.outcomes = {}
+
+    def add(self, name, seconds, ok, outcome=None):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            self.errors[name] = self.errors.get(name, 0) + (0 if ok else 1)
+            if outcome:
+                self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+
+# --- Synthetic data ---
+
+def seed(q, students, days, sessions_per_day, attendance_rate, rng):
+    """Roster plus `days` past class days of sessions and marks, and today's sessions so far"""
+    departments = ["AIDS", "CSE", "ECE", "MECH"]
+    now = datetime.now()
+    roster = [{
+        "student_id": f"24{i:08d}",
+        "name": f"Student {i:05d}",
+        "department": departments[i % len(departments)],
+        "year": "2024",
+        "email": f"student{i:05d}@kluniversity.in",
+        "phone": f"98{i:08d}",
+        "created_at": now,
+        "is_active": True,
+    } for i in range(1, students + 1)]
+    q.students_collection.insert_many(roster)
+
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    for day_offset in range(days, -1, -1):
+        day = today - timedelta(days=day_offset)
+        class_start = day.replace(hour=9) if day_offset else now - timedelta(seconds=sessions_per_day * q.QR_AUTO_REFRESH_INTERVAL)
+        sessions = []
+        for n in range(sessions_per_day):
+            created_at = class_start + timedelta(seconds=n * q.QR_AUTO_REFRESH_INTERVAL)
+            sessions.append({
+                "_id": q.new_session_id(created_at.timestamp()),
+                "qr_code": q.generate_random_data(),
+                "created_at": created_at,
+                "expires_at": created_at + timedelta(seconds=q.QR_VALIDITY_SECONDS),
+                "is_active": False,
+                "used_by_count": 0,
+                "session_name": f"AutoSession_{created_at.strftime('%H%M%S')}",
+                "created_by": "AUTO_GENERATOR",
+                "auto_generated": True,
+            })
+        marks = []
+        # Today's marks are left to the scan storm
+        for student in (rng.sample(roster, int(len(roster) * attendance_rate)) if day_offset else []):
+            session = rng.choice(sessions)
+            session["used_by_count"] += 1
+            marks.append({
+                "student_id": student["student_id"],
+                "student_name": student["name"],
+                "department": student["department"],
+                "year": student["year"],
+                "qr_code": session["qr_code"],
+                "qr_session_id": session["_id"],
+                "marked_at": session["created_at"] + timedelta(seconds=rng.uniform(0, q.QR_VALIDITY_SECONDS)),
+                "session_date": day,
+                "status": "present",
+                "ip_address": "10.0.0.1",
+                "user_agent": "benchmark",
+            })
+        if sessions:
+            q.qr_sessions_collection.insert_many(sessions)
+        if marks:
+            q.attendance_collection.insert_many(marks)
+    q.rebuild_rollups()
+    q.roster_cache.refresh()
+    return roster
+
+
+# --- Load ---
+
+def storm(q, roster, scans, rescan_rate, duration, displays, display_interval, dashboards,
+          dashboard_interval, downloads, clients, rng):
+    """Open-loop scan storm with displays and dashboards polling; returns (Recorder, seconds)"""
+    recorder = Recorder()
+    local = threading.local()
+    current = {"code": None, "etag": None}
+
+    def client():
+        if not hasattr(local, "client"):
+            local.client = q.app.test_client()
+        return local.client
+
+    def timed(name, planned, send, check):
+        try:
+            response = send(client())
+            body = response.get_data()
+            ok, outcome = check(response, body)
+        except Exception as e:
+            ok, outcome = False, f"{name} exception: {type(e).__name__}"
+        recorder.add(name, time.perf_counter() - planned, ok, outcome)
+
+    def display(planned):
+        def send(c):
+            headers = {"If-None-Match": current["etag"]} if current["etag"] else {}
+            return c.get("/qr?inline_image=0", headers=headers)
+
+        def check(response, body):
+            if response.status_code == 200:
+                current["code"] = json.loads(body)["data"]
+                current["etag"] = response.headers.get("ETag")
+            return response.status_code in (200, 304), None
+        timed("GET /qr (display)", planned, send, check)
+
+    def scan(planned, student):
+        def send(c):
+            return c.post("/validate", json={"qr_code": current["code"], "student_id": student["student_id"],
+                                             "student_name": student["name"]})
+
+        def check(response, body):
+            result = json.loads(body)
+            if response.status_code == 200 and result.get("valid"):
+                return True, "marked"
+            if result.get("duplicate"):
+                return True, "already marked"
+            return False, f"rejected {response.status_code}: {result.get('message')}"
+        timed("POST /validate", planned, send, check)
+
+    def dashboard(planned):
+        timed("GET /sessions/active", planned, lambda c: c.get("/sessions/active"),
+              lambda response, body: (response.status_code == 200, None))
+
+    def download(planned):
+        timed("GET /download/excel", planned, lambda c: c.get("/download/excel"),
+              lambda response, body: (response.status_code == 200, None))
+
+    # A display has to be showing a code before anyone can scan it
+    display(time.perf_counter())
+    if not current["code"]:
+        raise click.ClickException("GET /qr returned no code; is the database reachable?")
+
+    plan = []
+    scanners = rng.sample(roster, min(scans, len(roster)))
+    for student in scanners:
+        plan.append((rng.uniform(0, duration), scan, (student,)))
+        if rng.random() < rescan_rate:
+            plan.append((rng.uniform(0, duration), scan, (student,)))
+    for d in range(displays):
+        offset = rng.uniform(0, display_interval)
+        plan += [(offset + i * display_interval, display, ()) for i in range(int(duration / display_interval))]
+    for d in range(dashboards):
+        offset = rng.uniform(0, dashboard_interval)
+        plan += [(offset + i * dashboard_interval, dashboard, ()) for i in range(int(duration / dashboard_interval))]
+    plan += [(rng.uniform(duration / 2, duration), download, ()) for _ in range(downloads)]
+    plan.sort(key=lambda item: item[0])
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients, thread_name_prefix="bench-client") as pool:
+        for offset, fn, args in plan:
+            planned = started + offset
+            delay = planned - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(fn, planned, *args)
+    return recorder, time.perf_counter() - started
+
+
+# --- Micro-benchmarks ---
+
+def micro(name, fn, iterations):
+    latencies = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - t0)
+    return summarise(name, latencies, 0, time.perf_counter() - started)
+
+
+def micro_benchmarks(q, iterations, export_iterations):
+    c = q.app.test_client()
+    payloads = [q.generate_random_data() for _ in range(iterations)]
+    yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+    session = q.qr_sessions_collection.find_one({"used_by_count": {"$gt": 0}}, {"_id": 1}, sort=[("created_at", -1)])
+
+    def export(path, cold):
+        def run(_):
+            if cold:
+                q.report_cache.clear()
+            response = c.get(path)
+            assert response.status_code == 200, (path, response.status_code)
+            response.get_data()
+        return run
+
+    rows = [
+        micro("generate_qr_image png", lambda i: q.generate_qr_image(payloads[i], 'png'), iterations),
+        micro("generate_qr_image svg", lambda i: q.generate_qr_image(payloads[i] + "s", 'svg'), iterations),
+        micro("generate_qr_image cached", lambda i: q.generate_qr_image(payloads[0], 'png'), iterations),
+        micro("export day xlsx", export(f"/download/excel?date={yesterday}", True), export_iterations),
+        micro("export day csv", export(f"/download/excel?date={yesterday}&format=csv", True), export_iterations),
+    ]
+    # The cold rows clear the cache, so warm it here; the cached row measures hits only
+    export(f"/download/excel?date={yesterday}", False)(0)
+    rows.append(micro("export day xlsx (cached)", export(f"/download/excel?date={yesterday}", False), export_iterations))
+    if session:
+        rows.append(micro("export session xlsx", export(f"/download/session/{session['_id']}", True), export_iterations))
+    return rows
+
+
+def compare(results, baseline_path, tolerance):
+    """Rows whose p95 is more than `tolerance` above the baseline's (and at least 1 ms worse)"""
+    with open(baseline_path) as f:
+        baseline = {r["name"]: r for r in json.load(f)["results"]}
+    regressions = []
+    for r in results:
+        before = baseline.get(r["name"])
+        if before and r["p95_ms"] > before["p95_ms"] * (1 + tolerance) and r["p95_ms"] - before["p95_ms"] >= 1:
+            regressions.append((r["name"], before["p95_ms"], r["p95_ms"]))
+    return regressions
+
+
+@click.command()
+@click.option('--backend', type=click.Choice(['memory', 'sqlite', 'mongodb']), default='memory', show_default=True,
+              help='Storage for the run; mongodb uses MONGODB_URI and --database')
+@click.option('--database', default='kl_university_attendance_bench', show_default=True,
+              help='MongoDB database to seed (must be empty unless --reuse)')
+@click.option('--sqlite-path', default=None, help='SQLite file (default: a temporary file)')
+@click.option('--reuse', is_flag=True, help='Benchmark the data already in the database instead of seeding')
+@click.option('--students', default=2000, show_default=True, help='Roster size')
+@click.option('--days', default=30, show_default=True, help='Past class days of history')
+@click.option('--sessions-per-day', default=120, show_default=True, help='QR sessions per class day')
+@click.option('--attendance-rate', default=0.85, show_default=True, help='Share of the roster marked each past day')
+@click.option('--scans', default=300, show_default=True, help='Students scanning during the storm')
+@click.option('--rescan-rate', default=0.05, show_default=True, help='Share of students who scan twice')
+@click.option('--duration', default=10.0, show_default=True, help='Length of the storm in seconds')
+@click.option('--displays', default=4, show_default=True, help='Displays polling /qr')
+@click.option('--display-interval', default=1.0, show_default=True, help='Seconds between polls of one display')
+@click.option('--dashboards', default=2, show_default=True, help='Dashboards refreshing /sessions/active')
+@click.option('--dashboard-interval', default=2.0, show_default=True)
+@click.option('--downloads', default=3, show_default=True, help='/download/excel requests in the second half of the storm')
+@click.option('--clients', default=64, show_default=True, help='Concurrent client threads')
+@click.option('--micro-iterations', default=200, show_default=True)
+@click.option('--export-iterations', default=5, show_default=True)
+@click.option('--seed', 'random_seed', default=42, show_default=True)
+@click.option('--save', type=click.Path(dir_okay=False), help='Write the results as JSON')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), help='Fail if a p95 regressed against this JSON')
+@click.option('--tolerance', default=0.25, show_default=True, help='Allowed p95 increase over the baseline')
+@click.option('--verbose', is_flag=True, help="Keep the app's own log output")
+def main(backend, database, sqlite_path, reuse, students, days, sessions_per_day, attendance_rate, scans,
+         rescan_rate, duration, displays, display_interval, dashboards, dashboard_interval, downloads, clients,
+         micro_iterations, export_iterations, random_seed, save, baseline, tolerance, verbose):
+    """Seed synthetic data and run the scan-storm benchmark."""
+    # qr_api starts connecting at import, so the backend has to be chosen first
+    os.environ['STORAGE_BACKEND'] = backend
+    os.environ['DATABASE_NAME'] = database
+    if backend == 'sqlite':
+        if not sqlite_path:
+            fd, sqlite_path = tempfile.mkstemp(prefix='bench-', suffix='.sqlite3')
+            os.close(fd)
+        os.environ['SQLITE_PATH'] = sqlite_path
+    rng = random.Random(random_seed)
+    quiet = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+
+    with quiet:
+        import qr_api as q
+        q.wait_for_database(60)
+    if not q.client:
+        raise click.ClickException(f"could not open {backend} storage")
+
+    click.echo(f"🏁 backend={backend} write_mode={q.ATTENDANCE_WRITE_MODE} token_mode={q.QR_TOKEN_MODE} "
+               f"used_by={q.USED_BY_MODE} unique_marks={q.attendance_daily_unique}")
+    started = time.perf_counter()
+    with quiet:
+        if reuse:
+            q.roster_cache.refresh()
+            roster = q.roster_cache.all()
+        elif q.students_collection.count_documents({}):
+            raise click.ClickException(f"{database} already has students; use an empty database or --reuse")
+        else:
+            roster = seed(q, students, days, sessions_per_day, attendance_rate, rng)
+    click.echo(f"🌱 {len(roster)} students, {q.qr_sessions_collection.estimated_document_count()} sessions, "
+               f"{q.attendance_collection.estimated_document_count()} marks ready in {time.perf_counter() - started:.1f}s")
+    if not roster:
+        raise click.ClickException("no students to scan")
+
+    with quiet:
+        recorder, seconds = storm(q, roster, scans, rescan_rate, duration, displays, display_interval,
+                                  dashboards, dashboard_interval, downloads, clients, rng)
+        if q.attendance_journal is not None:
+            # Marks are acknowledged before they are written; wait for the writer to catch up
+            deadline = time.monotonic() + 30
+            while q.attendance_journal.backlog() and time.monotonic() < deadline:
+                time.sleep(0.1)
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        recorded = q.attendance_collection.count_documents({"session_date": today})
+        micro_rows = micro_benchmarks(q, micro_iterations, export_iterations)
+
+    load_rows = [summarise(name, latencies, recorder.errors.get(name, 0), seconds)
+                 for name, latencies in sorted(recorder.latencies.items())]
+    echo_table(f"Scan storm: {scans} scans over {duration:g}s, {displays} displays, {dashboards} dashboards, "
+               f"{clients} clients ({seconds:.1f}s)", load_rows)
+    click.echo("   " + ", ".join(f"{outcome}: {n}" for outcome, n in sorted(recorder.outcomes.items())))
+    click.echo(f"   marks recorded today: {recorded} (expected {recorder.outcomes.get('marked', 0)})")
+    echo_table(f"Micro-benchmarks ({len(roster)} students)", micro_rows)
+
+    results = load_rows + micro_rows
+    if save:
+        with open(save, 'w') as f:
+            json.dump({
+                "created_at": datetime.now().isoformat(),
+                "config": {"backend": backend, "students": len(roster), "days": days, "sessions_per_day": sessions_per_day,
+                           "scans": scans, "duration": duration, "displays": displays, "dashboards": dashboards,
+                           "clients": clients, "write_mode": q.ATTENDANCE_WRITE_MODE},
+                "results": results,
+            }, f, indent=2)
+        click.echo(f"\n💾 Results saved to {save}")
+
+    failed = any(r["errors"] for r in load_rows) or recorded != recorder.outcomes.get('marked', 0)
+    if baseline:
+        regressions = compare(results, baseline, tolerance)
+        for name, before, after in regressions:
+            click.echo(f"❌ {name}: p95 {before} ms -> {after} ms")
+        if not regressions:
+            click.echo(f"✅ No p95 regressions against {baseline} (tolerance {tolerance:.0%})")
+        failed = failed or bool(regressions)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,68 @@
-from flask import Flask, jsonify, request, send_file
+import time
+# Taken before any other import, for startup_report
+MODULE_LOAD_STARTED = time.perf_counter()
+from flask import Flask, jsonify, request, Response, stream_with_context, g
 from flask_cors import CORS
-import qrcode
 import random
 import string
 import base64
+import hmac
+import hashlib
 from io import BytesIO
-import time
+import struct
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import bisect
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-import pandas as pd
 import os
-from pymongo import MongoClient
-from bson import ObjectId
+from pymongo import MongoClient, ReturnDocument, UpdateOne, ReplaceOne, monitoring
+from pymongo.errors import OperationFailure, DuplicateKeyError, BulkWriteError
+from bson import ObjectId, json_util
 import json
+import tempfile
+import fcntl
+import atexit
+import csv
+import io
+import re
+import socket
+import uuid
+import math
+import sys
+import importlib
+import click
 from dotenv import load_dotenv
-import pyotp
+import storage
+
+# pandas, openpyxl, qrcode/PIL and pyotp are imported by lazy_import() on first
+# use; a cold start pays only for what serves /health and /qr
+HEAVY_MODULES = ('pandas', 'openpyxl', 'qrcode', 'PIL', 'pyotp')
+startup_report = {
+    "imports_seconds": round(time.perf_counter() - MODULE_LOAD_STARTED, 4),
+    "module_seconds": None,
+    "database_seconds": None,
+    "ready_after_seconds": None,
+    "preloaded_heavy_modules": [],
+    "lazy_imports": {},
+}
+
+def lazy_import(name):
+    """Import a heavy module on first use; the first import's cost goes into startup_report"""
+    loaded = name in sys.modules
+    started = time.perf_counter()
+    # import_module (not a sys.modules lookup) waits for another thread's import to finish
+    module = importlib.import_module(name)
+    if not loaded:
+        elapsed = time.perf_counter() - started
+        startup_report["lazy_imports"][name] = round(elapsed, 4)
+        print(f"📦 Imported {name} on first use in {elapsed:.2f}s")
+    return module
 
 # Load environment variables
 load_dotenv()
@@ -29,6 +78,9 @@ CORS(app,
      expose_headers=["*"]  # Expose all headers
 )
 
+# Endpoints that set their own Cache-Control/ETag headers (conditional GETs)
+CACHE_AWARE_ENDPOINTS = {'get_qr', 'qr_image', 'download_excel', 'download_session_excel', 'get_sessions_by_date'}
+
 @app.after_request
 def after_request(response):
     # Remove restrictive CORS headers and make them more permissive
@@ -39,9 +91,10 @@ def after_request(response):
     response.headers['Access-Control-Max-Age'] = '86400'
     
     # Remove any caching that might interfere
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
+    if request.endpoint not in CACHE_AWARE_ENDPOINTS or 'ETag' not in response.headers:
+        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '0'
     
     return response
 
@@ -52,31 +105,400 @@ STUDENTS_COLLECTION = os.getenv('STUDENTS_COLLECTION', 'students')
 ATTENDANCE_COLLECTION = os.getenv('ATTENDANCE_COLLECTION', 'attendance_records')
 QR_SESSIONS_COLLECTION = os.getenv('QR_SESSIONS_COLLECTION', 'qr_sessions')
 FACULTY_COLLECTION = os.getenv('FACULTY_COLLECTION', 'faculty')
+LEASES_COLLECTION = os.getenv('LEASES_COLLECTION', 'leases')
+SESSION_MEMBERS_COLLECTION = os.getenv('SESSION_MEMBERS_COLLECTION', 'qr_session_members')
+ROLLUPS_COLLECTION = os.getenv('ROLLUPS_COLLECTION', 'attendance_rollups')
+QR_CHANNELS_COLLECTION = os.getenv('QR_CHANNELS_COLLECTION', 'qr_channels')
+QR_DEMAND_COLLECTION = os.getenv('QR_DEMAND_COLLECTION', 'qr_channel_demand')
 PORT = int(os.getenv('PORT', 5000))
+# "mongodb", or an embedded backend from storage.py: "sqlite" (single-node
+# deployments, one WAL-mode file at SQLITE_PATH shared by all workers) or
+# "memory" (tests and benchmarks; nothing survives a restart)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'mongodb')
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'attendance.sqlite3')
+
+# /metrics (Prometheus text format); METRICS_TOKEN, if set, is required as a Bearer token
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Sampled request tracing: this fraction of requests records spans (MongoDB
+# commands, pandas, openpyxl, QR renders); around 0.01 is cheap enough to leave on
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0'))
+# Requests slower than this, streamed body included, are logged (with their spans if sampled); 0 disables
+SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', '5'))
+# Recent sampled traces kept per worker for GET /admin/traces
+TRACE_KEEP = int(os.getenv('TRACE_KEEP', '100'))
+# Bearer token for /admin/traces and /admin/profile; both are disabled when unset
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+
+# --- Metrics ---
+
+# Seconds; shared by requests, MongoDB commands, renders and scheduler ticks
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _metric_labels(names, values, **extra):
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+class Histogram:
+    """Latency histogram per label set, rendered with cumulative buckets"""
+
+    def __init__(self, name, help, labels=(), buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, seconds, *label_values):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += seconds
+
+    def render(self):
+        with self._lock:
+            snapshot = [(values, list(counts), total) for values, (counts, total) in sorted(self._series.items())]
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, counts, total in snapshot:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_metric_labels(self.labels, values, le=bound)} {cumulative}")
+            lines.append(f"{self.name}_bucket{_metric_labels(self.labels, values, le='+Inf')} {sum(counts)}")
+            lines.append(f"{self.name}_sum{_metric_labels(self.labels, values)} {total}")
+            lines.append(f"{self.name}_count{_metric_labels(self.labels, values)} {sum(counts)}")
+        return lines
+
+class Counter:
+    """Counter (or, with kind="gauge", a gauge moved both ways) per label set"""
+
+    def __init__(self, name, help, labels=(), kind="counter"):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.kind = kind
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        with self._lock:
+            snapshot = sorted(self._values.items())
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + [
+            f"{self.name}{_metric_labels(self.labels, values)} {value}" for values, value in snapshot
+        ]
+
+http_request_seconds = Histogram(
+    "http_request_duration_seconds", "Time to produce a response (streamed bodies excluded) by route",
+    ("route", "method", "status"))
+http_requests_in_flight = Counter(
+    "http_requests_in_flight", "Requests being handled by this worker", ("route",), kind="gauge")
+mongodb_command_seconds = Histogram(
+    "mongodb_command_duration_seconds", "MongoDB command round trips by collection and command",
+    ("collection", "command"))
+mongodb_command_failures = Counter(
+    "mongodb_command_failures_total", "MongoDB commands that returned an error", ("collection", "command"))
+qr_render_seconds = Histogram("qr_render_duration_seconds", "QR image renders (cache misses) by format", ("format",))
+qr_tick_seconds = Histogram("qr_generator_tick_duration_seconds", "Scheduler ticks that had channels due")
+qr_drift_seconds = Histogram(
+    "qr_generator_drift_seconds", "How late each rotation ran after its due time",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+PROCESS_STARTED_AT = time.time()
+
+class CommandTimer(monitoring.CommandListener):
+    """pymongo command monitoring: per-collection latency, so a slow round trip in a storm is visible"""
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        collection = event.command.get("collection" if event.command_name == "getMore" else event.command_name)
+        self._collections[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else ""
+
+    def succeeded(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        mongodb_command_seconds.observe(event.duration_micros / 1e6, collection, event.command_name)
+        record_span(f"mongodb {event.command_name} {collection}".rstrip(), event.duration_micros / 1e6)
+
+    def failed(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        mongodb_command_seconds.observe(event.duration_micros / 1e6, collection, event.command_name)
+        mongodb_command_failures.inc(1, collection, event.command_name)
+        record_span(f"mongodb {event.command_name} {collection} (failed)", event.duration_micros / 1e6)
+
+def _metrics_route():
+    # The URL rule, not the path, so /download/session/<session_id> is one series
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+@app.before_request
+def start_request_timer():
+    if METRICS_ENABLED:
+        g.metrics_started = time.perf_counter()
+        http_requests_in_flight.inc(1, _metrics_route())
+
+@app.after_request
+def record_request_time(response):
+    started = g.get('metrics_started')
+    if started is not None:
+        http_request_seconds.observe(time.perf_counter() - started, _metrics_route(), request.method, str(response.status_code))
+    return response
+
+@app.teardown_request
+def end_request_timer(exc):
+    if g.get('metrics_started') is not None:
+        http_requests_in_flight.inc(-1, _metrics_route())
+
+# --- Request tracing and profiling ---
+
+# Long-lived by design, so neither traced nor reported as slow
+UNTRACED_ENDPOINTS = {'qr_stream', 'qr_long_poll'}
+TRACE_MAX_SPANS = 500
+PROFILE_TOP = 40
+
+# The sampled trace of the request this thread is serving. A thread-local
+# rather than flask.g: streamed exports do their work after the request
+# context is gone, in the same thread.
+_trace_local = threading.local()
+recent_traces = deque(maxlen=TRACE_KEEP)
+
+# url rule -> {"mode", "remaining"}; one capture runs at a time per worker
+profile_plans = {}
+profile_results = deque(maxlen=20)
+_profile_plans_lock = threading.Lock()
+_profile_busy = threading.Lock()
+
+class RequestTrace:
+    """Spans (name, offset, seconds) of one sampled request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+        self.dropped = 0
+
+    def add(self, name, started, seconds):
+        if len(self.spans) < TRACE_MAX_SPANS:
+            self.spans.append((name, round(started - self.started, 6), round(seconds, 6)))
+        else:
+            self.dropped += 1
+
+    def summary(self):
+        """[(name, count, seconds)] per span name, slowest first"""
+        totals = {}
+        for name, _, seconds in self.spans:
+            count, total = totals.get(name, (0, 0.0))
+            totals[name] = (count + 1, total + seconds)
+        return sorted(((name, count, total) for name, (count, total) in totals.items()), key=lambda t: -t[2])
+
+def record_span(name, seconds):
+    """Add a span that just ended; a no-op unless this thread's request is sampled"""
+    trace = getattr(_trace_local, 'trace', None)
+    if trace is not None:
+        trace.add(name, time.perf_counter() - seconds, seconds)
+
+@contextmanager
+def trace_span(name):
+    """Time the block as a span of the current request, if it is sampled"""
+    trace = getattr(_trace_local, 'trace', None)
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, started, time.perf_counter() - started)
+
+def _start_profile(route):
+    """(mode, state) if this request should be captured, else None"""
+    with _profile_plans_lock:
+        plan = profile_plans.get(route)
+        if plan is None or not _profile_busy.acquire(blocking=False):
+            return None
+        plan["remaining"] -= 1
+        if plan["remaining"] <= 0:
+            del profile_plans[route]
+    if plan["mode"] == 'cprofile':
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Another profiler already owns the interpreter
+            print(f"⚠️ Could not start cProfile: {e}")
+            _profile_busy.release()
+            return None
+        return 'cprofile', profiler
+    # Leave tracemalloc running afterwards if someone else started it
+    already_tracing = tracemalloc.is_tracing()
+    if not already_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    return 'tracemalloc', already_tracing
+
+def _finish_profile(capture, details):
+    mode, state = capture
+    try:
+        if mode == 'cprofile':
+            state.disable()
+            out = io.StringIO()
+            pstats.Stats(state, stream=out).sort_stats('cumulative').print_stats(PROFILE_TOP)
+            report = out.getvalue()
+        else:
+            snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+            _, peak = tracemalloc.get_traced_memory()
+            if not state:
+                tracemalloc.stop()
+            report = {
+                'peak_bytes': peak,
+                'retained': [{'location': str(stat.traceback), 'size_bytes': stat.size, 'count': stat.count}
+                             for stat in snapshot.statistics('lineno')[:PROFILE_TOP]]
+            }
+        profile_results.append({**details, 'mode': mode, 'report': report})
+        print(f"🔬 {mode} capture of {details['method']} {details['path']} done ({details['duration_seconds']}s)")
+    except Exception as e:
+        print(f"⚠️ Profile capture failed: {e}")
+    finally:
+        _profile_busy.release()
+
+def _finish_request(trace, capture, details, started):
+    """Runs when the response is closed, i.e. after a streamed body has been sent"""
+    elapsed = time.perf_counter() - started
+    details['duration_seconds'] = round(elapsed, 4)
+    if getattr(_trace_local, 'trace', None) is trace:
+        _trace_local.trace = None
+    if capture is not None:
+        _finish_profile(capture, details)
+    if trace is not None:
+        recent_traces.append({**details, 'spans': trace.spans, 'dropped_spans': trace.dropped})
+    if SLOW_REQUEST_SECONDS and elapsed >= SLOW_REQUEST_SECONDS:
+        breakdown = ", ".join(f"{name} {total:.3f}s x{count}" for name, count, total in trace.summary()[:8]) if trace else ""
+        print(f"🐢 Slow request {details['method']} {details['path']} -> {details['status']} "
+              f"in {elapsed:.2f}s" + (f": {breakdown}" if breakdown else ""))
+
+@app.before_request
+def start_request_trace():
+    _trace_local.trace = None
+    if request.endpoint in UNTRACED_ENDPOINTS:
+        return
+    g.trace_started = time.perf_counter()
+    if TRACE_SAMPLE_RATE and random.random() < TRACE_SAMPLE_RATE:
+        _trace_local.trace = RequestTrace()
+    g.trace = _trace_local.trace
+    g.profile = _start_profile(_metrics_route()) if profile_plans else None
+
+@app.after_request
+def finish_request_trace(response):
+    started = g.pop('trace_started', None)
+    if started is not None:
+        details = {
+            'route': _metrics_route(),
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'status': response.status_code,
+            'at': datetime.now().isoformat()
+        }
+        trace, capture = g.get('trace'), g.get('profile')
+        response.call_on_close(lambda: _finish_request(trace, capture, details, started))
+    return response
+
+@app.teardown_request
+def abandon_request_trace(exc):
+    # after_request did not run, so nothing will close the trace
+    if g.pop('trace_started', None) is not None:
+        _trace_local.trace = None
+        if g.get('profile') is not None:
+            _finish_profile(g.profile, {'route': _metrics_route(), 'method': request.method,
+                                        'path': request.full_path.rstrip('?'), 'status': 500,
+                                        'at': datetime.now().isoformat(), 'duration_seconds': None})
+
+# Initialize the database client. connect_database() runs at the end of this
+# module; with DEFER_DB_CONNECT it runs on a background thread, so a cold
+# worker serves /health/live while it is still resolving and pinging MongoDB.
+# Requests that need the database wait up to DB_STARTUP_WAIT_SECONDS for it.
+DEFER_DB_CONNECT = os.getenv('DEFER_DB_CONNECT', '1' if STORAGE_BACKEND == 'mongodb' else '0') == '1'
+DB_STARTUP_WAIT_SECONDS = float(os.getenv('DB_STARTUP_WAIT_SECONDS', '10'))
+# Deferred connections are retried, backing off up to this long between attempts
+DB_CONNECT_RETRY_MAX_SECONDS = float(os.getenv('DB_CONNECT_RETRY_MAX_SECONDS', '60'))
+
+client = None
+db = None
+students_collection = attendance_collection = qr_sessions_collection = faculty_collection = None
+leases_collection = session_members_collection = rollups_collection = None
+qr_channels_collection = qr_demand_collection = None
+# Set once connected and the per-process startup work is done (readiness)
+database_ready = threading.Event()
+# Set after the first connection attempt, whatever its outcome
+database_attempted = threading.Event()
+database_error = None
+
+def connect_database():
+    """Create the client, ping it and bind the collection globals; True on success"""
+    global client, db, students_collection, attendance_collection, qr_sessions_collection, faculty_collection
+    global leases_collection, session_members_collection, rollups_collection, qr_channels_collection
+    global qr_demand_collection, database_error
+    new_client = None
+    try:
+        if STORAGE_BACKEND == 'mongodb':
+            new_client = MongoClient(MONGODB_URI, event_listeners=[CommandTimer()] if METRICS_ENABLED else [])
+        else:
+            new_client = storage.connect(STORAGE_BACKEND, SQLITE_PATH)
+        # Test connection
+        new_client.admin.command('ping')
+    except Exception as e:
+        print(f"❌ Failed to connect to {STORAGE_BACKEND}: {e}")
+        database_error = str(e)
+        if new_client is not None:
+            new_client.close()
+        return False
 
-# Initialize MongoDB client
-try:
-    client = MongoClient(MONGODB_URI)
-    db = client[DATABASE_NAME]
+    db = new_client[DATABASE_NAME]
     students_collection = db[STUDENTS_COLLECTION]
     attendance_collection = db[ATTENDANCE_COLLECTION]
     qr_sessions_collection = db[QR_SESSIONS_COLLECTION]
     faculty_collection = db[FACULTY_COLLECTION]
-    
-    # Test connection
-    client.admin.command('ping')
-    print("✅ Successfully connected to MongoDB Atlas!")
-    
-except Exception as e:
-    print(f"❌ Failed to connect to MongoDB: {e}")
-    client = None
+    leases_collection = db[LEASES_COLLECTION]
+    session_members_collection = db[SESSION_MEMBERS_COLLECTION]
+    rollups_collection = db[ROLLUPS_COLLECTION]
+    qr_channels_collection = db[QR_CHANNELS_COLLECTION]
+    qr_demand_collection = db[QR_DEMAND_COLLECTION]
+    # Last: request handlers check client before touching the collections
+    client = new_client
+    database_error = None
+    if STORAGE_BACKEND == 'mongodb':
+        print("✅ Successfully connected to MongoDB Atlas!")
+    else:
+        print(f"✅ Using {STORAGE_BACKEND} storage: {client}")
+    return True
+
+def wait_for_database(timeout=None):
+    """True once the database is connected and startup work is done; waits up to timeout"""
+    return database_ready.wait(timeout)
+
+# Answer without the database, even while it is still connecting
+NO_DATABASE_ENDPOINTS = {'health_check', 'liveness', 'readiness', 'metrics', 'admin_traces', 'admin_profile'}
+
+@app.before_request
+def await_database():
+    # Only the first attempt is waited for; while retrying, handlers fail fast as before
+    if not database_attempted.is_set() and request.method != 'OPTIONS' \
+            and request.endpoint not in NO_DATABASE_ENDPOINTS:
+        database_attempted.wait(DB_STARTUP_WAIT_SECONDS)
 
 # Configuration
 QR_VALIDITY_SECONDS = 30 # Changed from 30 to 3 seconds
 QR_AUTO_REFRESH_INTERVAL = 5  # Auto-generate new QR every 3 seconds
 
-# Global variable to track current QR session
-current_qr_session = None
+# The scheduler thread that rotates every channel's QR
 qr_generation_thread = None
 
 import threading
@@ -86,57 +508,754 @@ KEEP_PREVIOUS_ACTIVE = os.getenv("KEEP_PREVIOUS_ACTIVE", "1") == "1"
 ACCEPT_ROTATED_WITHIN_EXPIRY = os.getenv("ACCEPT_ROTATED_WITHIN_EXPIRY", "1") == "1"
 KEEP_ATTENDANCE_ON_EXPIRE = os.getenv("KEEP_ATTENDANCE_ON_EXPIRE", "1") == "1"
 ATTENDANCE_RETENTION_DAYS = int(os.getenv("ATTENDANCE_RETENTION_DAYS", "90"))
+# Let MongoDB TTL indexes enforce ATTENDANCE_RETENTION_DAYS instead of the cleanup code
+RETENTION_VIA_TTL = os.getenv("RETENTION_VIA_TTL", "0") == "1"
+# One mark per student per day enforced by a unique index and a single upsert in /validate
+ATOMIC_MARKING = os.getenv("ATOMIC_MARKING", "1") == "1"
+# "counter": sessions keep used_by_count, membership lives in its own collection;
+# "array": legacy ever-growing used_by list inside each session document
+USED_BY_MODE = os.getenv("USED_BY_MODE", "counter")
+# Roster cache for /validate and reports; reloaded after this long without a change stream
+ROSTER_CACHE_TTL_SECONDS = int(os.getenv("ROSTER_CACHE_TTL_SECONDS", "300"))
+# Roster import (/students/import, `flask import-roster`)
+ROSTER_IMPORT_BATCH_SIZE = int(os.getenv("ROSTER_IMPORT_BATCH_SIZE", "1000"))
+STUDENT_ID_PATTERN = re.compile(os.getenv("STUDENT_ID_PATTERN", r"^[0-9A-Za-z]{4,20}$"))
+# Report downloads are streamed in chunks of this many bytes
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", str(64 * 1024)))
+# Longest span a range report may cover
+RANGE_REPORT_MAX_DAYS = int(os.getenv("RANGE_REPORT_MAX_DAYS", "366"))
+# Rendered downloads/listings are cached in memory up to this many bytes,
+# and also under REPORT_CACHE_DIR (shared by workers on one host) when it is set
+REPORT_CACHE_MAX_BYTES = int(os.getenv("REPORT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+REPORT_CACHE_DIR = os.getenv("REPORT_CACHE_DIR", "")
+REPORT_CACHE_DISK_MAX_BYTES = int(os.getenv("REPORT_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+# Rollup rebuilds write this many documents per round trip; a startup backfill
+# runs in one worker, which holds the "rollup-backfill" lease for up to this long
+ROLLUP_REBUILD_BATCH_SIZE = int(os.getenv("ROLLUP_REBUILD_BATCH_SIZE", "500"))
+ROLLUP_BACKFILL_LEASE_SECONDS = int(os.getenv("ROLLUP_BACKFILL_LEASE_SECONDS", "600"))
+# "sync": /validate writes the mark before answering. "journal": the mark is
+# acknowledged once fsync'd to a local journal and a writer thread upserts marks
+# in batches. The directory must be local (flock) and should survive restarts.
+# A mark another worker has already written is caught by one indexed read before
+# journaling; two workers taking the same student within one flush interval can
+# still both acknowledge, and the writer counts and logs the second as already_present.
+ATTENDANCE_WRITE_MODE = os.getenv("ATTENDANCE_WRITE_MODE", "sync")
+ATTENDANCE_JOURNAL_DIR = os.getenv("ATTENDANCE_JOURNAL_DIR", os.path.join(tempfile.gettempdir(), "attendance-journal"))
+ATTENDANCE_FLUSH_INTERVAL_SECONDS = float(os.getenv("ATTENDANCE_FLUSH_INTERVAL_SECONDS", "0.5"))
+ATTENDANCE_FLUSH_BATCH_SIZE = int(os.getenv("ATTENDANCE_FLUSH_BATCH_SIZE", "500"))
+# Background janitor: expiry marking and retention run here, never on the request path
+JANITOR_ENABLED = os.getenv("JANITOR_ENABLED", "1") == "1"
+JANITOR_INTERVAL_SECONDS = int(os.getenv("JANITOR_INTERVAL_SECONDS", "30"))
+JANITOR_BATCH_SIZE = int(os.getenv("JANITOR_BATCH_SIZE", "500"))
+JANITOR_TIME_BUDGET_SECONDS = float(os.getenv("JANITOR_TIME_BUDGET_SECONDS", "2"))
+# Session listings (/sessions/active, /sessions/by-date) are paginated at this size
+SESSIONS_PAGE_SIZE = int(os.getenv("SESSIONS_PAGE_SIZE", "200"))
+SESSIONS_MAX_PAGE_SIZE = int(os.getenv("SESSIONS_MAX_PAGE_SIZE", "1000"))
+# Run the idempotent index migration when the app is imported
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "1") == "1"
+# QR rendering: "png" (1-bit, optimised) or "svg"; box size 1 gives the smallest PNG
+QR_IMAGE_FORMAT = os.getenv("QR_IMAGE_FORMAT", "png")
+QR_IMAGE_BOX_SIZE = int(os.getenv("QR_IMAGE_BOX_SIZE", "10"))
+QR_RENDER_CACHE_SIZE = int(os.getenv("QR_RENDER_CACHE_SIZE", "256"))
+QR_PRERENDER_AHEAD = int(os.getenv("QR_PRERENDER_AHEAD", "2"))
+QR_RENDER_WORKERS = int(os.getenv("QR_RENDER_WORKERS", "2"))
+# Store the base64 image in each session document (legacy); images are always served by /qr/<id>.png|svg
+QR_EMBED_IMAGE_IN_DB = os.getenv("QR_EMBED_IMAGE_IN_DB", "1") == "1"
+# "random": opaque codes looked up in qr_sessions; "signed": HMAC tokens checked in CPU
+QR_TOKEN_MODE = os.getenv("QR_TOKEN_MODE", "random")
+# All workers/replicas must share this secret for signed tokens to validate everywhere
+QR_TOKEN_SECRET = os.getenv("QR_TOKEN_SECRET") or base64.b32encode(os.urandom(20)).decode('ascii')
+if QR_TOKEN_MODE == "signed" and not os.getenv("QR_TOKEN_SECRET"):
+    print("⚠️ QR_TOKEN_SECRET not set; signed QR tokens will only validate in this process")
+# Without a change stream, re-check MongoDB for a newer session at most this often per worker
+QR_CACHE_MAX_AGE_SECONDS = float(os.getenv("QR_CACHE_MAX_AGE_SECONDS", "1"))
+# Push channel (/qr/stream, /qr/poll) timing
+QR_STREAM_HEARTBEAT_SECONDS = int(os.getenv("QR_STREAM_HEARTBEAT_SECONDS", "15"))
+QR_LONG_POLL_TIMEOUT_SECONDS = int(os.getenv("QR_LONG_POLL_TIMEOUT_SECONDS", "25"))
+# Named rotation channels (one per room/course/faculty), "name:interval:validity,...";
+# more can be added with POST /qr/channels. The default channel uses the constants above.
+DEFAULT_CHANNEL = "default"
+QR_CHANNELS = os.getenv("QR_CHANNELS", "")
+CHANNEL_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+# Channel settings edited through /qr/channels reach other workers within this long
+QR_CHANNEL_CONFIG_TTL_SECONDS = int(os.getenv("QR_CHANNEL_CONFIG_TTL_SECONDS", "30"))
+# One scheduler thread rotates every channel, on a timer wheel of this resolution
+QR_SCHEDULER_TICK_SECONDS = float(os.getenv("QR_SCHEDULER_TICK_SECONDS", "0.1"))
+QR_SCHEDULER_SLOTS = int(os.getenv("QR_SCHEDULER_SLOTS", "1024"))
+# A channel stops rotating once no display has polled or streamed it for this long (0: never)
+QR_IDLE_TIMEOUT_SECONDS = float(os.getenv("QR_IDLE_TIMEOUT_SECONDS", "60"))
+# Class hours of the default channel, e.g. "Mon-Fri 09:00-17:00;Sat 09:00-13:00" (empty: any time)
+QR_TIMETABLE = os.getenv("QR_TIMETABLE", "")
+# Only the holder of the "qr-generator" lease rotates codes; every other worker/replica
+# serves what it writes. Everyone renews or retries every lease/3, so a standby takes
+# over at most 4/3 of a lease after the leader's last renewal: with the default lease
+# of half a refresh interval, a dead leader costs at most one rotation.
+QR_LEADER_ELECTION = os.getenv("QR_LEADER_ELECTION", "1") == "1"
+QR_LEADER_LEASE_SECONDS = float(os.getenv("QR_LEADER_LEASE_SECONDS", str(QR_AUTO_REFRESH_INTERVAL * 0.5)))
+# How often the leader looks for channels that displays asked other workers for
+QR_DEMAND_POLL_SECONDS = float(os.getenv("QR_DEMAND_POLL_SECONDS", "1"))
 
-def auto_generate_qr():
-    """Background thread to automatically generate new QR codes every QR_AUTO_REFRESH_INTERVAL seconds"""
-    global current_qr_session
+# --- Current QR session cache ---
+
+class CurrentSessionCache:
+    """Thread-safe, versioned in-memory copy of the newest active QR session"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._refresh_lock = threading.Lock()
+        self._session = None
+        self._version = 0
+        self._checked_at = 0.0
+
+    def publish(self, session):
+        """Install a (newer) session and wake everyone waiting for a rotation"""
+        with self._cond:
+            current = self._session
+            if current is not None and session["_id"] == current["_id"]:
+                self._checked_at = time.monotonic()
+                return
+            if current is not None and session["created_at"] < current["created_at"]:
+                return
+            # Fencing: a deposed generator's late writes never replace its successor's
+            if current is not None and "generator_token" in session and current["expires_at"] > datetime.now() \
+                    and session["generator_token"] < current.get("generator_token", 0):
+                return
+            self._session = {k: v for k, v in session.items() if k not in ("used_by", "used_by_count")}
+            self._version += 1
+            self._checked_at = time.monotonic()
+            self._cond.notify_all()
+
+    def invalidate(self, session_id=None):
+        """Drop the cached session (only if it is session_id, when given)"""
+        with self._cond:
+            if session_id is not None and (self._session is None or self._session["_id"] != session_id):
+                return
+            self._session = None
+            self._version += 1
+            self._checked_at = 0.0
+            self._cond.notify_all()
+
+    def snapshot(self):
+        """Return (session, version, checked_at) as one consistent view"""
+        with self._cond:
+            return self._session, self._version, self._checked_at
+
+    def wait_for_session(self, timeout):
+        """Block until a session is available or timeout seconds pass"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._session is not None, timeout)
+            return self._session
+
+    def wait_for_newer(self, session_id, timeout):
+        """Block until the cached session differs from session_id; None on timeout"""
+        def changed():
+            return self._session is not None and str(self._session["_id"]) != session_id
+        with self._cond:
+            if self._cond.wait_for(changed, timeout):
+                return self._session
+            return None
+
+qr_session_watcher_active = False
+qr_session_watcher_thread = None
+
+def _cached_session_is_fresh(session, checked_at):
+    if session is None or session["expires_at"] <= datetime.now():
+        return False
+    return qr_session_watcher_active or time.monotonic() - checked_at < QR_CACHE_MAX_AGE_SECONDS
+
+def get_current_qr_session(channel=None):
+    """Newest active QR session of a channel (default channel if None), from memory unless the cache is empty, expired or stale"""
+    channel = channel or qr_channels.get()
+    cache = channel.cache
+    session, _, checked_at = cache.snapshot()
+    if _cached_session_is_fresh(session, checked_at):
+        return session
+
+    # Only one request per worker goes to MongoDB; the rest reuse its answer
+    with cache._refresh_lock:
+        session, _, checked_at = cache.snapshot()
+        if _cached_session_is_fresh(session, checked_at):
+            return session
+
+        latest = qr_sessions_collection.find_one({
+            "channel": channel.key,
+            "is_active": True,
+            "expires_at": {"$gt": datetime.now()}
+        }, {"used_by": 0}, sort=[("created_at", -1)])
+
+        if latest:
+            cache.publish(latest)
+        else:
+            cache.invalidate()
+        return cache.snapshot()[0]
+
+def wait_for_rotation(channel, session_id, timeout):
+    """
+    The channel's session once it differs from session_id, or None after timeout.
+    Without a change stream nothing pushes another worker's rotation into this
+    cache, so re-check through get_current_qr_session at least once per rotation.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        if not qr_session_watcher_active:
+            remaining = min(remaining, channel.interval, QR_CACHE_MAX_AGE_SECONDS)
+        session = channel.cache.wait_for_newer(session_id, remaining)
+        if session is not None:
+            return session
+        if not qr_session_watcher_active:
+            try:
+                session = get_current_qr_session(channel)
+            except Exception as e:
+                print(f"❌ Could not re-check channel {channel.name} for a rotation: {e}")
+                continue
+            if session is not None and str(session['_id']) != session_id:
+                return session
+
+def watch_qr_sessions():
+    """Follow qr_sessions writes from other gunicorn workers through a change stream"""
+    global qr_session_watcher_active
+    pipeline = [{"$match": {"operationType": {"$in": ["insert", "delete", "drop", "invalidate"]}}}]
     while True:
         try:
-            if not client:
-                print("❌ Database not connected, skipping auto QR generation")
-                time.sleep(QR_AUTO_REFRESH_INTERVAL)
+            with qr_sessions_collection.watch(pipeline) as stream:
+                qr_session_watcher_active = True
+                print("👀 Watching qr_sessions for rotations from other workers")
+                for change in stream:
+                    if change["operationType"] == "insert":
+                        doc = change["fullDocument"]
+                        # Only channels this worker has been asked about keep a cache
+                        channel = qr_channels.peek(doc.get("channel"))
+                        if channel and doc.get("is_active") and doc["expires_at"] > datetime.now():
+                            channel.cache.publish(doc)
+                    elif change["operationType"] == "delete":
+                        for channel in qr_channels.all():
+                            channel.cache.invalidate(change["documentKey"]["_id"])
+                    else:
+                        for channel in qr_channels.all():
+                            channel.cache.invalidate()
+        except OperationFailure as e:
+            # Standalone servers have no change streams; fall back to max-age polling
+            qr_session_watcher_active = False
+            print(f"⚠️ Change streams unavailable ({e}), re-checking every {QR_CACHE_MAX_AGE_SECONDS}s")
+            return
+        except Exception as e:
+            qr_session_watcher_active = False
+            for channel in qr_channels.all():
+                channel.cache.invalidate()
+            print(f"❌ qr_sessions change stream failed: {e}")
+            time.sleep(QR_AUTO_REFRESH_INTERVAL)
+
+def start_qr_session_watcher():
+    """Start the change stream thread that keeps the session cache coherent across workers"""
+    global qr_session_watcher_thread
+
+    if qr_session_watcher_thread is None or not qr_session_watcher_thread.is_alive():
+        qr_session_watcher_thread = threading.Thread(target=watch_qr_sessions, daemon=True)
+        qr_session_watcher_thread.start()
+
+# --- Roster cache ---
+
+ROSTER_FIELDS = {"_id": 0, "student_id": 1, "name": 1, "department": 1, "year": 1, "email": 1, "phone": 1}
+
+class RosterCache:
+    """student_id -> the few fields /validate and the reports use, kept in memory"""
+
+    def __init__(self, ttl_seconds):
+        self._ttl = ttl_seconds
+        self._lock = threading.Lock()
+        self._students = {}
+        self._loaded_at = None
+        self._digest = None
+        self.watching = False
+
+    def _stale(self):
+        if self._loaded_at is None:
+            return True
+        return not self.watching and time.monotonic() - self._loaded_at > self._ttl
+
+    def refresh(self):
+        """Reload the whole roster from MongoDB (one indexed scan)"""
+        students = {s["student_id"]: s for s in students_collection.find({}, ROSTER_FIELDS).sort("student_id", 1)}
+        with self._lock:
+            self._students = students
+            self._loaded_at = time.monotonic()
+            self._digest = None
+        print(f"📋 Roster cache loaded: {len(students)} students")
+
+    def _ensure_loaded(self):
+        if self._stale():
+            self.refresh()
+
+    def get(self, student_id):
+        """Roster entry for student_id, falling back to MongoDB for students added since the last load"""
+        self._ensure_loaded()
+        student = self._students.get(student_id)
+        if student is None:
+            student = students_collection.find_one({"student_id": student_id}, ROSTER_FIELDS)
+            if student is not None:
+                self.put(student)
+        return student
+
+    def all(self):
+        """Every student, ordered by student_id"""
+        self._ensure_loaded()
+        return sorted(self._students.values(), key=lambda s: s["student_id"])
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._students)
+
+    def put(self, student):
+        with self._lock:
+            self._students = {**self._students, student["student_id"]: {k: v for k, v in student.items() if k in ROSTER_FIELDS}}
+            self._digest = None
+
+    def digest(self):
+        """Content hash of the roster (same in every process), recomputed only after a change"""
+        self._ensure_loaded()
+        students, digest = self._students, self._digest
+        if digest is None:
+            digest = hashlib.sha1(json.dumps(sorted(students.items()), default=str, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+            with self._lock:
+                if self._students is students:
+                    self._digest = digest
+        return digest
+
+    def invalidate(self):
+        self._loaded_at = None
+
+roster_cache = RosterCache(ROSTER_CACHE_TTL_SECONDS)
+roster_watcher_thread = None
+
+def watch_roster():
+    """Apply student inserts/updates to the roster cache as they happen; any other change reloads it"""
+    while True:
+        try:
+            with students_collection.watch(full_document="updateLookup") as stream:
+                roster_cache.watching = True
+                roster_cache.invalidate()
+                for change in stream:
+                    doc = change.get("fullDocument")
+                    if change["operationType"] in ("insert", "update", "replace") and doc and "student_id" in doc:
+                        roster_cache.put(doc)
+                    else:
+                        roster_cache.invalidate()
+        except OperationFailure as e:
+            roster_cache.watching = False
+            print(f"⚠️ Roster change stream unavailable ({e}), reloading every {ROSTER_CACHE_TTL_SECONDS}s")
+            return
+        except Exception as e:
+            roster_cache.watching = False
+            roster_cache.invalidate()
+            print(f"❌ students change stream failed: {e}")
+            time.sleep(ROSTER_CACHE_TTL_SECONDS)
+
+def start_roster_cache():
+    """Load the roster and keep it current through a change stream"""
+    global roster_watcher_thread
+
+    roster_cache.refresh()
+    if roster_watcher_thread is None or not roster_watcher_thread.is_alive():
+        roster_watcher_thread = threading.Thread(target=watch_roster, daemon=True)
+        roster_watcher_thread.start()
+
+# --- Rotation channels ---
+
+def channel_key(name):
+    """Value of a session's/mark's `channel` field: None (field absent) for the default channel"""
+    return None if name in (None, "", DEFAULT_CHANNEL) else name
+
+def channel_fields(name):
+    """Document fields placing a session or mark in a channel (none for the default channel)"""
+    key = channel_key(name)
+    return {} if key is None else {"channel": key}
+
+def _static_channel_configs():
+    """QR_CHANNELS parsed into {name: (interval, validity)}"""
+    configs = {}
+    for spec in filter(None, (part.strip() for part in QR_CHANNELS.split(','))):
+        name, _, timings = spec.partition(':')
+        interval, _, validity = timings.partition(':')
+        configs[name] = (float(interval or QR_AUTO_REFRESH_INTERVAL), float(validity or QR_VALIDITY_SECONDS))
+    return configs
+
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+def _minute_of_day(hhmm):
+    hours, _, minutes = hhmm.strip().partition(':')
+    value = int(hours) * 60 + int(minutes)
+    if not 0 <= value <= 24 * 60:
+        raise ValueError(f"bad time {hhmm!r}")
+    return value
+
+def parse_timetable(windows):
+    """
+    ["Mon-Fri 09:00-10:50", "Sat,Sun 10:00-12:00", "daily 08:00-18:00"] ->
+    [(weekdays, start_minute, end_minute)]. Raises ValueError on a bad window.
+    """
+    parsed = []
+    for window in windows:
+        day_spec, _, hours = window.strip().partition(' ')
+        start, _, end = hours.partition('-')
+        days = set()
+        for part in day_spec.lower().split(','):
+            if part == 'daily':
+                days.update(range(7))
                 continue
+            first, _, last = part.partition('-')
+            a, b = WEEKDAYS.index(first[:3]), WEEKDAYS.index((last or first)[:3])
+            days.update(range(a, b + 1) if a <= b else [*range(a, 7), *range(0, b + 1)])
+        start_minute, end_minute = _minute_of_day(start), _minute_of_day(end)
+        if start_minute >= end_minute:
+            raise ValueError(f"window {window!r} must end after it starts")
+        parsed.append((frozenset(days), start_minute, end_minute))
+    return parsed
 
-            # Only deactivate the immediately previous session (NOT all) if we do NOT keep previous active
-            if not KEEP_PREVIOUS_ACTIVE and current_qr_session:
-                qr_sessions_collection.update_one(
-                    {"_id": current_qr_session["_id"], "is_active": True},
-                    {"$set": {"is_active": False, "terminated_at": datetime.now(), "auto_terminated": True}}
-                )
-
-            cleanup_expired_sessions_and_data()
-
-            qr_data = generate_random_data()
-            qr_image = generate_qr_image(qr_data)
-            if qr_image:
-                now = datetime.now()
-                new_session = {
-                    "qr_code": qr_data,
-                    "created_at": now,
-                    "expires_at": now + timedelta(seconds=QR_VALIDITY_SECONDS),
-                    "is_active": True,
-                    "used_by": [],
-                    "session_name": f"AutoSession_{now.strftime('%H%M%S')}",
-                    "created_by": "AUTO_GENERATOR",
-                    "auto_generated": True,
-                    "qr_image": qr_image
-                }
-                ins = qr_sessions_collection.insert_one(new_session)
-                new_session["_id"] = ins.inserted_id
-                current_qr_session = new_session
-                print(f"🔄 NEW QR {qr_data} valid {QR_VALIDITY_SECONDS}s keep_prev={KEEP_PREVIOUS_ACTIVE}")
+def in_timetable(timetable, at):
+    """Is `at` inside one of the windows? An empty timetable means always."""
+    if not timetable:
+        return True
+    minute = at.hour * 60 + at.minute
+    return any(at.weekday() in days and start <= minute < end for days, start, end in timetable)
+
+class QRChannel:
+    """One rotation (room/course/faculty): its own timings, pre-rendered codes and session cache"""
+
+    def __init__(self, name, interval, validity, timetable=()):
+        self.name = name
+        self.key = channel_key(name)
+        self.interval = interval
+        self.validity = validity
+        self.timetable = timetable
+        self.cache = CurrentSessionCache()
+        # Demand: last display request, and displays currently waiting on /qr/stream or /qr/poll
+        self.last_demand = float("-inf")
+        self.subscribers = 0
+        self._subscribers_lock = threading.Lock()
+        # Latest demand any worker recorded in qr_channel_demand, and when this one last wrote there
+        self.shared_demand_at = None
+        self.demand_published_at = float("-inf")
+        self.prerenderer = QRPrerenderer(QR_PRERENDER_AHEAD, self)
+        # Last session this process issued, and the scheduler's bookkeeping
+        self.current = None
+        self.scheduled = False
+        self.next_at = None
+        self.config_loaded_at = time.monotonic()
+
+    def subscribe(self, delta):
+        """+1 when a display starts waiting for rotations, -1 when it goes away"""
+        with self._subscribers_lock:
+            self.subscribers += delta
+
+    def in_demand(self):
+        """Has a display asked for this channel within QR_IDLE_TIMEOUT_SECONDS (or is one still waiting)?"""
+        if QR_IDLE_TIMEOUT_SECONDS <= 0:
+            return True
+        if self.subscribers > 0 or time.monotonic() - self.last_demand < QR_IDLE_TIMEOUT_SECONDS:
+            return True
+        # Displays connected to other workers
+        return self.shared_demand_at is not None and \
+            datetime.now() - self.shared_demand_at < timedelta(seconds=QR_IDLE_TIMEOUT_SECONDS)
+
+    def publish_demand(self):
+        """Record this worker's demand where the generator leader sees it (at most a few times per idle timeout)"""
+        if time.monotonic() - self.demand_published_at < max(QR_IDLE_TIMEOUT_SECONDS / 4, QR_DEMAND_POLL_SECONDS):
+            return
+        self.demand_published_at = time.monotonic()
+        qr_demand_collection.update_one({"_id": self.name}, {"$max": {"last_demand_at": datetime.now()}}, upsert=True)
+
+    def in_class_hours(self, at=None):
+        return in_timetable(self.timetable, at or datetime.now())
+
+class QRChannelRegistry:
+    """Channels this process has been asked about, by name, with their settings refreshed periodically"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._channels = {}
+
+    def _load_config(self, name):
+        """(interval, validity, timetable) for a channel, or None if it is not configured"""
+        if channel_key(name) is None:
+            return QR_AUTO_REFRESH_INTERVAL, QR_VALIDITY_SECONDS, parse_timetable(filter(None, QR_TIMETABLE.split(';')))
+        doc = qr_channels_collection.find_one({"_id": name}) if client else None
+        if doc:
+            return doc["interval_seconds"], doc["validity_seconds"], parse_timetable(doc.get("timetable", []))
+        static = _static_channel_configs().get(name)
+        return static and (*static, [])
+
+    def get(self, name=None):
+        """The channel called name (default channel for None/""), or None if there is no such channel"""
+        name = name or DEFAULT_CHANNEL
+        if not CHANNEL_NAME_PATTERN.match(name):
+            return None
+        channel = self._channels.get(name)
+        if channel is not None and time.monotonic() - channel.config_loaded_at < QR_CHANNEL_CONFIG_TTL_SECONDS:
+            return channel
+        config = self._load_config(name)
+        with self._lock:
+            channel = self._channels.get(name)
+            if config is None:
+                return channel
+            if channel is None:
+                channel = self._channels[name] = QRChannel(name, *config)
+            else:
+                channel.interval, channel.validity, channel.timetable = config
+                channel.config_loaded_at = time.monotonic()
+        return channel
+
+    def peek(self, key):
+        """Channel for a document's `channel` field if this process knows it (no DB access)"""
+        return self._channels.get(key or DEFAULT_CHANNEL)
+
+    def expire_config(self, name):
+        """Make the next get(name) re-read the channel's settings"""
+        channel = self._channels.get(name)
+        if channel is not None:
+            channel.config_loaded_at = float("-inf")
+
+    def all(self):
+        return list(self._channels.values())
+
+qr_channels = QRChannelRegistry()
+
+class TimerWheel:
+    """
+    Hashed timing wheel: scheduling is O(1) and each tick looks at one slot,
+    however many channels are waiting. Due times round up to the next tick.
+    """
+
+    def __init__(self, tick_seconds, slots):
+        self._tick = tick_seconds
+        self._slots = [[] for _ in range(slots)]
+        self._lock = threading.Lock()
+        self._now_tick = int(time.monotonic() / tick_seconds)
+
+    def schedule(self, at, item):
+        """Fire item at monotonic time `at` (on the next tick if that has already passed)"""
+        with self._lock:
+            tick = max(math.ceil(at / self._tick), self._now_tick + 1)
+            self._slots[tick % len(self._slots)].append((tick, item))
+
+    def advance(self):
+        """Sleep until the next tick; return the items due by then, including any from ticks overslept"""
+        delay = (self._now_tick + 1) * self._tick - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        with self._lock:
+            last = max(int(time.monotonic() / self._tick), self._now_tick + 1)
+            ticks = range(self._now_tick + 1, last + 1)
+            slots = range(len(self._slots)) if len(ticks) >= len(self._slots) else [t % len(self._slots) for t in ticks]
+            due = []
+            for index in slots:
+                keep = []
+                for entry in self._slots[index]:
+                    (due if entry[0] <= last else keep).append(entry)
+                self._slots[index] = keep
+            self._now_tick = last
+        return [item for _, item in due]
+
+qr_wheel = TimerWheel(QR_SCHEDULER_TICK_SECONDS, QR_SCHEDULER_SLOTS)
+_activation_lock = threading.Lock()
+
+scheduler_stats = {
+    "sessions_issued": 0,
+    "idle_pauses": 0,
+    "resumes": 0,
+    "skipped_outside_timetable": 0,
+}
+
+def activate_channel(channel):
+    """Start (or resume) rotating a channel, first code on the next tick; no-op if it already rotates"""
+    with _activation_lock:
+        if channel.scheduled:
+            return
+        channel.scheduled = True
+        if channel.next_at is not None:
+            scheduler_stats["resumes"] += 1
+            print(f"▶️ Channel {channel.name} resumed")
+    channel.next_at = time.monotonic()
+    qr_wheel.schedule(channel.next_at, channel)
+
+def rotate_channels(channels, generator_token=None):
+    """Issue the next session of every due channel with a single insert_many, stamped with the leader's fencing token"""
+    issued = []
+    for channel in channels:
+        session_id, qr_data, qr_image = channel.prerenderer.next_code()
+        if not qr_image:
+            continue
+        now = datetime.now()
+        issued.append((channel, {
+            "_id": session_id,
+            "qr_code": qr_data,
+            "created_at": now,
+            "expires_at": now + timedelta(seconds=channel.validity),
+            "is_active": True,
+            **channel_fields(channel.name),
+            **initial_usage(),
+            "session_name": f"AutoSession_{now.strftime('%H%M%S')}",
+            "created_by": "AUTO_GENERATOR",
+            "auto_generated": True,
+            **({"generator_token": generator_token} if generator_token is not None else {}),
+            "qr_image": qr_image
+        }))
+    if not issued:
+        return
+    scheduler_stats["sessions_issued"] += len(issued)
+    qr_sessions_collection.insert_many([session_document(session) for _, session in issued], ordered=False)
+    _safe_rollup(record_session_rollups, [session for _, session in issued])
+    # Only deactivate each channel's immediately previous session (NOT all) if we do NOT keep previous active
+    if not KEEP_PREVIOUS_ACTIVE:
+        deactivate_previous_sessions(issued, generator_token)
+    for channel, session in issued:
+        channel.current = session
+        channel.cache.publish(session)
+        print(f"🔄 NEW QR {session['qr_code']} channel={channel.name} valid {channel.validity}s keep_prev={KEEP_PREVIOUS_ACTIVE}")
+
+def deactivate_previous_sessions(issued, generator_token=None):
+    """Deactivate what each channel showed before its newly issued session"""
+    update = {"$set": {"is_active": False, "terminated_at": datetime.now(), "auto_terminated": True}}
+    previous = []
+    for channel, session in issued:
+        if channel.current is not None and channel.current.get("generator_token") == generator_token:
+            previous.append(channel.current["_id"])
+        else:
+            # First rotation here under this fencing token (e.g. just took over from
+            # another leader): its last session is not ours to know, so clear the channel
+            qr_sessions_collection.update_many(
+                {"channel": channel_key(channel.name), "is_active": True, "_id": {"$ne": session["_id"]}}, update
+            )
+    if previous:
+        qr_sessions_collection.update_many({"_id": {"$in": previous}, "is_active": True}, update)
+
+# This process's hold on the "qr-generator" lease
+generator_lease = {"token": None, "valid_until": 0.0, "leader_since": None}
+
+def is_generator_leader():
+    """May this process rotate codes right now?"""
+    if not QR_LEADER_ELECTION:
+        return True
+    return generator_lease["token"] is not None and time.monotonic() < generator_lease["valid_until"]
+
+def generator_heartbeat():
+    """Take or renew the generator lease; as leader, pick up demand recorded by other workers"""
+    if not QR_LEADER_ELECTION:
+        return
+    started = time.monotonic()
+    try:
+        token = acquire_lease("qr-generator", QR_LEADER_LEASE_SECONDS)
+    except Exception as e:
+        token = None
+        print(f"❌ Could not renew qr-generator lease: {e}")
+    was_leader = generator_lease["token"] is not None
+    if token is None:
+        if was_leader:
+            print(f"⚠️ {WORKER_ID} lost the qr-generator lease; following")
+        generator_lease.update(token=None, valid_until=0.0, leader_since=None)
+    else:
+        # Stop a safety margin before the lease can expire, in case our clock runs slow
+        generator_lease.update(token=token, valid_until=started + QR_LEADER_LEASE_SECONDS * 0.8)
+        if not was_leader:
+            generator_lease["leader_since"] = datetime.now().isoformat()
+
+def sync_channel_demand():
+    """Followers publish their displays' demand; the leader resumes every channel someone is watching"""
+    for channel in qr_channels.all():
+        if channel.scheduled and channel.subscribers > 0:
+            channel.publish_demand()
+    if not is_generator_leader():
+        return
+    since = datetime.now() - timedelta(seconds=max(QR_IDLE_TIMEOUT_SECONDS, QR_DEMAND_POLL_SECONDS))
+    for doc in qr_demand_collection.find({"last_demand_at": {"$gt": since}}):
+        channel = qr_channels.get(doc["_id"])
+        if channel is not None:
+            channel.shared_demand_at = doc["last_demand_at"]
+            activate_channel(channel)
+
+def auto_generate_qr():
+    """
+    Background scheduler thread: on each timer wheel tick, rotate every channel
+    that is due, still watched by a display and inside its class hours. Idle
+    channels drop off the wheel until the next display request. With leader
+    election only the lease holder writes; followers keep their wheel (so they
+    can take over within a lease period) and serve what the leader writes.
+    """
+    next_heartbeat = next_demand_sync = 0.0
+    while True:
+        due = qr_wheel.advance()
+        now = time.monotonic()
+        try:
+            if client and now >= next_heartbeat:
+                next_heartbeat = now + QR_LEADER_LEASE_SECONDS / 3
+                generator_heartbeat()
+            if client and now >= next_demand_sync:
+                next_demand_sync = now + QR_DEMAND_POLL_SECONDS
+                sync_channel_demand()
+        except Exception as e:
+            print(f"❌ Error coordinating QR generation: {e}")
+        if not due:
+            continue
+        tick_started = time.monotonic()
+        wanted = []
+        # Same lock as activate_channel, so a request arriving now either
+        # counts as demand here or re-activates the channel afterwards
+        with _activation_lock:
+            for channel in due:
+                if channel.in_demand():
+                    wanted.append(channel)
+                else:
+                    channel.scheduled = False
+                    scheduler_stats["idle_pauses"] += 1
+                    print(f"💤 Channel {channel.name} idle for {QR_IDLE_TIMEOUT_SECONDS:g}s, rotation paused")
+        now = datetime.now()
+        rotating = [channel for channel in wanted if channel.in_class_hours(now)]
+        scheduler_stats["skipped_outside_timetable"] += len(wanted) - len(rotating)
+        try:
+            if rotating and not client:
+                print("❌ Database not connected, skipping auto QR generation")
+            elif rotating and is_generator_leader():
+                for channel in rotating:
+                    qr_drift_seconds.observe(max(tick_started - channel.next_at, 0.0))
+                rotate_channels(rotating, generator_lease["token"])
         except Exception as e:
             print(f"❌ Error in auto_generate_qr: {e}")
-        time.sleep(QR_AUTO_REFRESH_INTERVAL)
+        now = time.monotonic()
+        qr_tick_seconds.observe(now - tick_started)
+        for channel in wanted:
+            # Next slot rather than now + interval so pre-rendered codes stay on time
+            channel.next_at = max(channel.next_at + channel.interval, now)
+            qr_wheel.schedule(channel.next_at, channel)
+
+def start_auto_qr_generation(channel=None):
+    """
+    Start the scheduler thread (once) and record a display's demand for a
+    channel (default channel if None), resuming its rotation if it was idle.
+    """
+    start_qr_scheduler()
+    channel = channel or qr_channels.get()
+    channel.last_demand = time.monotonic()
+    activate_channel(channel)
+    if QR_LEADER_ELECTION and client:
+        try:
+            channel.publish_demand()
+        except Exception as e:
+            print(f"❌ Could not record demand for channel {channel.name}: {e}")
 
-def start_auto_qr_generation():
-    """Start the background QR generation thread"""
+def start_qr_scheduler():
+    """Start the scheduler thread (it competes for the generator lease) and the session watcher"""
     global qr_generation_thread
     
     if qr_generation_thread is None or not qr_generation_thread.is_alive():
         qr_generation_thread = threading.Thread(target=auto_generate_qr, daemon=True)
         qr_generation_thread.start()
-        print("🚀 Auto QR generation started (every 3 seconds)")
+        print("🚀 Auto QR generation started")
+        if QR_LEADER_ELECTION:
+            # A clean shutdown hands the lease over at once instead of after it expires
+            atexit.register(lambda: generator_lease["token"] is not None and release_lease("qr-generator"))
+    start_qr_session_watcher()
 
 def initialize_database():
     """Initialize the database with student records"""
@@ -170,172 +1289,1573 @@ def initialize_database():
         
         # Insert all students
         result = students_collection.insert_many(students)
+        roster_cache.invalidate()
         print(f"✅ Inserted {len(result.inserted_ids)} student records")
         
         # Create indexes for better performance
-        students_collection.create_index("student_id", unique=True)
-        attendance_collection.create_index([("student_id", 1), ("session_date", 1)])
-        qr_sessions_collection.create_index("expires_at")
-        
-        print("✅ Database indexes created")
+        migrate_database()
         return True
         
     except Exception as e:
         print(f"❌ Error initializing database: {e}")
         return False
 
-def generate_random_data(length=10):
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+# --- Roster import ---
+
+# Accepted spellings of each roster column (compared lower-cased, punctuation stripped)
+ROSTER_COLUMN_ALIASES = {
+    "student_id": ["student_id", "studentid", "university id", "universityid", "student id", "id",
+                   "roll no", "rollno", "roll number", "regd no", "registration number"],
+    "name": ["name", "student_name", "student name", "full name"],
+    "department": ["department", "dept", "branch", "program"],
+    "year": ["year", "batch"],
+    "section": ["section", "sec"],
+    "email": ["email", "email id", "mail"],
+    "phone": ["phone", "mobile", "phone number", "mobile number"],
+}
+
+ROSTER_OPTIONAL_FIELDS = ("department", "year", "section", "email", "phone")
+
+def _normalise_header(value):
+    return re.sub(r"[^a-z0-9_ ]", "", str(value or "").strip().lower()).strip()
+
+def _roster_column_map(header):
+    """{field: column index} for a header row, or None if it has no student id column"""
+    columns = {}
+    for index, cell in enumerate(header):
+        name = _normalise_header(cell)
+        for field, aliases in ROSTER_COLUMN_ALIASES.items():
+            if field not in columns and name in aliases:
+                columns[field] = index
+    return columns if "student_id" in columns else None
+
+def iter_roster_rows(stream, filename):
+    """Yield raw rows from an .xlsx (openpyxl read-only, row by row) or .csv upload"""
+    if filename.lower().endswith(".csv"):
+        yield from csv.reader(io.TextIOWrapper(stream, encoding="utf-8-sig", newline=""))
+        return
+    workbook = lazy_import('openpyxl').load_workbook(stream, read_only=True, data_only=True)
+    try:
+        yield from workbook.active.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+def normalise_student_id(value):
+    """2410080001, 2410080001.0 and ' 2410080001 ' all become '2410080001'"""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip() if value is not None else ""
+
+def import_roster(rows, defaults=None, dry_run=False):
+    """
+    Validate roster rows and upsert them by student_id in unordered bulk batches.
+    Returns inserted/updated/unchanged counts and the rejected rows.
+    """
+    defaults = {k: v for k, v in (defaults or {}).items() if v}
+    report = {"rows": 0, "inserted": 0, "updated": 0, "unchanged": 0, "rejected": 0, "errors": []}
+    columns = None
+    seen = set()
+    batch = []
+    now = datetime.now()
+
+    def flush():
+        if batch and not dry_run:
+            # Rows identical to the stored student are skipped, so updated_at only moves on a real change
+            existing = {s["student_id"]: s for s in students_collection.find(
+                {"student_id": {"$in": [student_id for student_id, _ in batch]}},
+                {"_id": 0, "student_id": 1, "name": 1, **{field: 1 for field in ROSTER_OPTIONAL_FIELDS}}
+            )}
+            ops = []
+            for student_id, fields in batch:
+                current = existing.get(student_id)
+                if current is not None and all(current.get(k) == v for k, v in fields.items()):
+                    report["unchanged"] += 1
+                    continue
+                ops.append(UpdateOne(
+                    {"student_id": student_id},
+                    {"$set": {**fields, "updated_at": now}, "$setOnInsert": {"created_at": now, "is_active": True}},
+                    upsert=True
+                ))
+            if ops:
+                result = students_collection.bulk_write(ops, ordered=False)
+                report["inserted"] += result.upserted_count
+                report["updated"] += result.modified_count
+        batch.clear()
+
+    def reject(row_number, reason):
+        report["rejected"] += 1
+        if len(report["errors"]) < 100:
+            report["errors"].append({"row": row_number, "reason": reason})
+
+    for row_number, row in enumerate(rows, start=1):
+        if columns is None:
+            # Anything above the header (titles, blank lines) is skipped
+            columns = _roster_column_map(row)
+            continue
+        if not any(cell not in (None, "") for cell in row):
+            continue
+        report["rows"] += 1
+
+        def cell(field):
+            index = columns.get(field)
+            value = row[index] if index is not None and index < len(row) else None
+            return value if value not in (None, "") else defaults.get(field)
+
+        student_id = normalise_student_id(cell("student_id"))
+        if not STUDENT_ID_PATTERN.match(student_id):
+            reject(row_number, f"invalid student id {student_id!r}")
+            continue
+        if student_id in seen:
+            reject(row_number, f"duplicate student id {student_id} in file")
+            continue
+        name = " ".join(str(cell("name") or "").split())
+        if not name:
+            reject(row_number, f"missing name for {student_id}")
+            continue
+        seen.add(student_id)
+
+        fields = {"name": name}
+        for field in ROSTER_OPTIONAL_FIELDS:
+            value = cell(field)
+            if value is not None:
+                fields[field] = normalise_student_id(value) if field in ("year", "phone") else str(value).strip()
+        batch.append((student_id, fields))
+        if len(batch) >= ROSTER_IMPORT_BATCH_SIZE:
+            flush()
+
+    if columns is None:
+        raise ValueError("No header row with a student ID column found")
+    flush()
+    if not dry_run:
+        roster_cache.invalidate()
+    return report
+
+@app.cli.command('import-roster')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--department', help='Department for rows that do not have one')
+@click.option('--year', help='Year for rows that do not have one')
+@click.option('--dry-run', is_flag=True, help='Validate only, write nothing')
+def import_roster_command(path, department, year, dry_run):
+    """Bulk upsert students from an .xlsx or .csv roster."""
+    require_database()
+    started = time.monotonic()
+    with open(path, 'rb') as stream:
+        report = import_roster(iter_roster_rows(stream, path), {"department": department, "year": year}, dry_run)
+    click.echo(f"rows={report['rows']} inserted={report['inserted']} updated={report['updated']} "
+               f"unchanged={report['unchanged']} rejected={report['rejected']} "
+               f"in {time.monotonic() - started:.2f}s{' (dry run)' if dry_run else ''}")
+    for error in report['errors']:
+        click.echo(f"  row {error['row']}: {error['reason']}")
+
+# --- Attendance rollups ---
+# Counters kept next to the raw data so stats never scan it:
+#   "total"                        sessions, attendance
+#   "day:YYYY-MM-DD"               sessions, attendance
+#   "dept:YYYY-MM-DD:<department>" attendance
+#   "session:<session_id>"         attendance
+# Day and session rollups also carry "rev", bumped on every change, and "total"
+# carries "epoch", reset by a rebuild; together they version cached reports.
+
+def _day(dt):
+    return dt.strftime('%Y-%m-%d')
+
+def _rollup_inc(rollup_id, counts, **fields):
+    return UpdateOne({"_id": rollup_id}, {"$inc": counts, "$set": fields}, upsert=True)
+
+def record_session_rollup(session):
+    """Count a newly created session"""
+    record_session_rollups([session])
+
+def record_session_rollups(sessions):
+    """Count newly created sessions (all channels rotating on one tick)"""
+    per_day = {}
+    for session in sessions:
+        day = _day(session["created_at"])
+        per_day[day] = per_day.get(day, 0) + 1
+    rollups_collection.bulk_write([_rollup_inc("total", {"sessions": len(sessions)})] + [
+        _rollup_inc(f"day:{day}", {"sessions": n, "rev": 1}, kind="day", date=day) for day, n in per_day.items()
+    ], ordered=False)
+
+def record_attendance_rollup(record):
+    """Count a newly inserted attendance record (one round trip for all four counters)"""
+    record_attendance_rollups([record])
+
+def record_attendance_rollups(records):
+    """Count newly inserted attendance records, one update per counter touched"""
+    counts = {}
+    for record in records:
+        day = _day(record["session_date"])
+        for rollup_id, fields in (
+            ("total", {}),
+            (f"day:{day}", dict(kind="day", date=day)),
+            (f"dept:{day}:{record['department']}", dict(kind="dept", date=day, department=record["department"])),
+            (f"session:{record['qr_session_id']}", dict(kind="session", date=day, session_id=record["qr_session_id"])),
+        ):
+            n, _ = counts.get(rollup_id, (0, None))
+            counts[rollup_id] = (n + 1, fields)
+    rollups_collection.bulk_write([
+        _rollup_inc(rollup_id, {"attendance": n, **({"rev": 1} if fields.get("kind") in ("day", "session") else {})}, **fields)
+        for rollup_id, (n, fields) in counts.items()
+    ], ordered=False)
+
+def _safe_rollup(update, *args):
+    """Rollups must never fail a scan or a rotation; `flask rebuild-rollups` repairs drift"""
+    try:
+        update(*args)
+    except Exception as e:
+        print(f"❌ Rollup update failed: {e}")
+
+def rollup_counts(session_ids, include_attendance):
+    """Per-day session counts (and attendance counters) for sessions about to be deleted"""
+    day_expr = {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}}
+    sessions = list(qr_sessions_collection.aggregate([
+        {"$match": {"_id": {"$in": session_ids}}},
+        {"$group": {"_id": day_expr, "n": {"$sum": 1}}}
+    ]))
+    attendance = []
+    if include_attendance:
+        attendance = list(attendance_collection.aggregate([
+            {"$match": {"qr_session_id": {"$in": session_ids}}},
+            {"$group": {"_id": {"day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$session_date"}},
+                                "department": "$department"}, "n": {"$sum": 1}}}
+        ]))
+    return sessions, attendance
+
+def apply_rollup_deletions(session_ids, counts):
+    """Subtract deleted sessions/attendance (from rollup_counts) from the counters"""
+    sessions, attendance = counts
+    ops = [UpdateOne({"_id": f"day:{g['_id']}"}, {"$inc": {"sessions": -g["n"], "rev": 1}}) for g in sessions]
+    for g in attendance:
+        ops.append(UpdateOne({"_id": f"day:{g['_id']['day']}"}, {"$inc": {"attendance": -g["n"], "rev": 1}}))
+        ops.append(UpdateOne({"_id": f"dept:{g['_id']['day']}:{g['_id']['department']}"}, {"$inc": {"attendance": -g["n"]}}))
+    deleted_sessions = sum(g["n"] for g in sessions)
+    deleted_attendance = sum(g["n"] for g in attendance)
+    ops.append(UpdateOne({"_id": "total"}, {"$inc": {"sessions": -deleted_sessions, "attendance": -deleted_attendance}}))
+    rollups_collection.bulk_write(ops, ordered=False)
+    rollups_collection.delete_many({"_id": {"$in": [f"session:{sid}" for sid in session_ids]}})
+
+def rebuild_rollups():
+    """
+    Recompute every rollup from the raw collections (backfill / repair) under a
+    fresh epoch. Documents are swapped in one by one (upsert replace), so the
+    counters never disappear mid-rebuild; only ids that existed before the
+    rebuild and no longer exist are deleted, so counters created by marks made
+    meanwhile survive. Returns documents written.
+    """
+    previous_ids = {d["_id"] for d in rollups_collection.find({}, {"_id": 1})}
+    docs = {}
+
+    def add(rollup_id, field, n, **fields):
+        doc = docs.setdefault(rollup_id, {"_id": rollup_id, **fields})
+        doc[field] = doc.get(field, 0) + n
+
+    day_of = lambda field: {"$dateToString": {"format": "%Y-%m-%d", "date": f"${field}"}}
+    add("total", "sessions", 0)
+    add("total", "attendance", 0)
+    # Counts restart from scratch, so every report cached before this is invalid
+    docs["total"]["epoch"] = time.time_ns()
+    for g in qr_sessions_collection.aggregate([{"$group": {"_id": day_of("created_at"), "n": {"$sum": 1}}}], allowDiskUse=True):
+        add("total", "sessions", g["n"])
+        add(f"day:{g['_id']}", "sessions", g["n"], kind="day", date=g["_id"])
+    for g in attendance_collection.aggregate([
+        {"$group": {"_id": {"day": day_of("session_date"), "department": "$department", "session_id": "$qr_session_id"},
+                    "n": {"$sum": 1}}}
+    ], allowDiskUse=True):
+        day, department, session_id = g["_id"]["day"], g["_id"].get("department"), g["_id"].get("session_id")
+        add("total", "attendance", g["n"])
+        add(f"day:{day}", "attendance", g["n"], kind="day", date=day)
+        add(f"dept:{day}:{department}", "attendance", g["n"], kind="dept", date=day, department=department)
+        add(f"session:{session_id}", "attendance", g["n"], kind="session", date=day, session_id=session_id)
+
+    # "total" goes last: its presence is what tells other workers the backfill is done
+    total = docs.pop("total")
+    ops = [ReplaceOne({"_id": rollup_id}, doc, upsert=True) for rollup_id, doc in docs.items()]
+    ops.append(ReplaceOne({"_id": "total"}, total, upsert=True))
+    for start in range(0, len(ops), ROLLUP_REBUILD_BATCH_SIZE):
+        rollups_collection.bulk_write(ops[start:start + ROLLUP_REBUILD_BATCH_SIZE])
+    stale = list(previous_ids - set(docs) - {"total"})
+    if stale:
+        rollups_collection.delete_many({"_id": {"$in": stale}})
+    return len(ops)
+
+def backfill_rollups():
+    """Build the rollups if they do not exist yet; one worker does it, under a lease"""
+    if rollups_collection.find_one({"_id": "total"}, {"_id": 1}) is not None:
+        return
+    if not acquire_lease("rollup-backfill", ROLLUP_BACKFILL_LEASE_SECONDS):
+        print("⏳ Rollup backfill is running in another worker")
+        return
+    try:
+        # Another worker may have finished it while this one waited for the lease
+        if rollups_collection.find_one({"_id": "total"}, {"_id": 1}) is None:
+            print(f"🔄 Building attendance rollups: {rebuild_rollups()} documents")
+    finally:
+        release_lease("rollup-backfill")
+
+def report_version(day=None, session_id=None):
+    """
+    Data version of a day's and/or a session's attendance for the report cache:
+    changes whenever a rollup bump (or a rebuild) records a change to it.
+    None when the data may change unrecorded (TTL retention deletes old days).
+    """
+    if RETENTION_VIA_TTL and day is not None and day < datetime.now() - timedelta(days=ATTENDANCE_RETENTION_DAYS - 1):
+        return None
+    ids = ([f"day:{_day(day)}"] if day is not None else []) + ([f"session:{session_id}"] if session_id else [])
+    found = {d["_id"]: d for d in rollups_collection.find({"_id": {"$in": ids + ["total"]}}, {"rev": 1, "epoch": 1})}
+    version = {rollup_id: found.get(rollup_id, {}).get("rev", 0) for rollup_id in ids}
+    version["epoch"] = found.get("total", {}).get("epoch", 0)
+    return version
+
+def day_rollups(start_date):
+    """(day rollup, total rollup) for the given day in one query"""
+    day_id = f"day:{_day(start_date)}"
+    found = {d["_id"]: d for d in rollups_collection.find({"_id": {"$in": [day_id, "total"]}})}
+    return found.get(day_id, {}), found.get("total", {})
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recompute the attendance rollups used by /sessions/stats from scratch."""
+    require_database()
+    started = time.monotonic()
+    click.echo(f"Wrote {rebuild_rollups()} rollup documents in {time.monotonic() - started:.2f}s")
+
+# --- Schema / index migration ---
+
+def index_specs():
+    """(collection, keys, options) for every index, matched to the queries this module runs"""
+    retention_seconds = ATTENDANCE_RETENTION_DAYS * 86400
+    session_expiry = {"expireAfterSeconds": retention_seconds} if RETENTION_VIA_TTL else {}
+    attendance_expiry = (
+        {"expireAfterSeconds": retention_seconds}
+        if RETENTION_VIA_TTL and not KEEP_ATTENDANCE_ON_EXPIRE else {}
+    )
+    return [
+        # /validate student lookup, roster sort in /download/excel
+        (students_collection, [("student_id", 1)], {"unique": True}),
+        (faculty_collection, [("email", 1)], {}),
+        # /validate (random codes)
+        (qr_sessions_collection, [("qr_code", 1)], {}),
+        # generator leader: channels with recent demand from any worker
+        (qr_demand_collection, [("last_demand_at", -1)], {}),
+        # /qr and /qr/status per channel: equality, sort, range
+        (qr_sessions_collection, [("channel", 1), ("is_active", 1), ("created_at", -1), ("expires_at", 1)], {}),
+        # cleanup: newly expired active sessions
+        (qr_sessions_collection, [("is_active", 1), ("expires_at", 1)], {}),
+        # /sessions/active, /sessions/by-date, /sessions/stats
+        (qr_sessions_collection, [("created_at", -1)], {}),
+        # retention sweep (or TTL)
+        (qr_sessions_collection, [("expires_at", 1)], session_expiry),
+        # one mark per student per day per channel; the /validate upsert relies on it
+        (attendance_collection, [("student_id", 1), ("session_date", 1), ("channel", 1)], {"unique": True}),
+        # /download/excel, /attendance/today, /sessions/stats
+        (attendance_collection, [("session_date", 1), ("marked_at", 1)], {}),
+        # /download/session/<id>, session listings, /attendance/session/<id>
+        (attendance_collection, [("qr_session_id", 1), ("marked_at", 1)], {}),
+        # used_by membership outside array mode
+        (session_members_collection, [("session_id", 1), ("student_id", 1)], {"unique": True}),
+        # /download/latest-session (walked backwards), retention (or TTL)
+        (attendance_collection, [("marked_at", 1)], attendance_expiry),
+    ] + ([(session_members_collection, [("created_at", 1)], session_expiry)] if RETENTION_VIA_TTL else [])
+
+def retired_index_specs():
+    """(collection, keys) of indexes superseded by index_specs(), dropped once the replacements exist"""
+    return [
+        # single-rotation /qr lookup, before channels
+        (qr_sessions_collection, [("is_active", 1), ("created_at", -1), ("expires_at", 1)]),
+        # one mark per student per day across all channels
+        (attendance_collection, [("student_id", 1), ("session_date", 1)]),
+    ]
+
+def ensure_index(collection, keys, **options):
+    """Create an index, or rebuild one with the same keys whose options differ. Returns the action."""
+    name = "_".join(f"{field}_{direction}" for field, direction in keys)
+    wanted = {k: options[k] for k in ("unique", "expireAfterSeconds") if options.get(k) is not None}
 
-def generate_qr_image(data):
-    """Generate QR code image"""
+    for existing_name, info in collection.index_information().items():
+        if [(f, int(d)) for f, d in info["key"]] != keys:
+            continue
+        current = {k: info[k] for k in ("unique", "expireAfterSeconds") if info.get(k) is not None}
+        if current == wanted:
+            return "ok"
+        if set(current) - {"expireAfterSeconds"} == set(wanted) - {"expireAfterSeconds"} \
+                and "expireAfterSeconds" in current and "expireAfterSeconds" in wanted:
+            collection.database.command("collMod", collection.name, index={
+                "keyPattern": dict(keys), "expireAfterSeconds": wanted["expireAfterSeconds"]
+            })
+            return "ttl-updated"
+        collection.drop_index(existing_name)
+        try:
+            collection.create_index(keys, name=name, **options)
+        except Exception:
+            # e.g. duplicates block a unique build: put the old index back
+            restored = {k: v for k, v in info.items() if k in ("unique", "expireAfterSeconds")}
+            collection.create_index(keys, name=existing_name, **restored)
+            raise
+        return "rebuilt"
+
+    collection.create_index(keys, name=name, **options)
+    return "created"
+
+def migrate_database():
+    """Idempotently bring every collection's indexes in line with index_specs()"""
+    if not client:
+        print("❌ MongoDB not connected. Cannot migrate database.")
+        return []
+
+    results = []
+    for collection, keys, options in index_specs():
+        try:
+            action = ensure_index(collection, keys, **options)
+        except Exception as e:
+            action = f"failed: {e}"
+            print(f"❌ Index {collection.name} {keys}: {e}")
+        results.append({"collection": collection.name, "keys": keys, "options": options, "action": action})
+
+    if not any(r["action"].startswith("failed") for r in results):
+        for collection, keys in retired_index_specs():
+            for existing_name, info in collection.index_information().items():
+                if [(f, int(d)) for f, d in info["key"]] == keys:
+                    collection.drop_index(existing_name)
+                    results.append({"collection": collection.name, "keys": keys, "options": {}, "action": "dropped"})
+
+    changed = [r for r in results if r["action"] != "ok"]
+    print(f"✅ Index migration: {len(results) - len(changed)} up to date, {len(changed)} changed")
+    detect_attendance_uniqueness()
+    return results
+
+attendance_daily_unique = False
+
+def detect_attendance_uniqueness():
+    """Enable the atomic /validate path only once the (student_id, session_date, channel) index is unique"""
+    global attendance_daily_unique
     try:
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
+        attendance_daily_unique = ATOMIC_MARKING and any(
+            info.get("unique") and [(f, int(d)) for f, d in info["key"]] == [("student_id", 1), ("session_date", 1), ("channel", 1)]
+            for info in attendance_collection.index_information().values()
         )
-        qr.add_data(data)
-        qr.make(fit=True)
+    except Exception as e:
+        print(f"❌ Could not inspect attendance indexes: {e}")
+        attendance_daily_unique = False
+    if ATOMIC_MARKING and not attendance_daily_unique:
+        print("⚠️ attendance (student_id, session_date, channel) is not unique; run `flask dedupe-attendance` then `flask migrate-db`")
+    return attendance_daily_unique
+
+def dedupe_attendance():
+    """Keep the earliest mark per student per day per channel and delete the rest. Returns rows deleted."""
+    duplicates = attendance_collection.aggregate([
+        {"$sort": {"marked_at": 1}},
+        # A missing channel and null are the same key to the unique index
+        {"$group": {"_id": {"student_id": "$student_id", "session_date": "$session_date",
+                            "channel": {"$ifNull": ["$channel", None]}},
+                    "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)
+    deleted = 0
+    for group in duplicates:
+        deleted += attendance_collection.delete_many({"_id": {"$in": group["ids"][1:]}}).deleted_count
+    return deleted
+
+def query_shapes():
+    """Representative filter/sort of every hot query, used by the coverage report"""
+    now = datetime.now()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return [
+        ("/validate student lookup", students_collection, {"student_id": "2410080001"}, None),
+        ("/validate QR lookup", qr_sessions_collection, {"qr_code": "x"}, None),
+        ("/validate today's attendance", attendance_collection, {"student_id": "2410080001", "session_date": today, "channel": None}, None),
+        ("/qr latest active session", qr_sessions_collection, {"channel": None, "is_active": True, "expires_at": {"$gt": now}}, [("created_at", -1)]),
+        ("cleanup newly expired", qr_sessions_collection, {"expires_at": {"$lt": now}, "is_active": True}, None),
+        ("cleanup retention", qr_sessions_collection, {"expires_at": {"$lt": now - timedelta(days=ATTENDANCE_RETENTION_DAYS)}}, None),
+        ("/sessions/* by day", qr_sessions_collection, {"created_at": {"$gte": today, "$lt": today + timedelta(days=1)}}, [("created_at", -1)]),
+        ("session attendance", attendance_collection, {"qr_session_id": ObjectId()}, None),
+        ("/download/excel day", attendance_collection, {"session_date": today}, None),
+        ("/attendance/today", attendance_collection, {"session_date": today}, [("marked_at", 1)]),
+        ("/download/latest-session", attendance_collection, {}, [("marked_at", -1)]),
+        ("faculty TOTP", faculty_collection, {"email": "faculty@kluniversity.edu"}, None),
+    ]
 
+def _plan_stages(plan):
+    """Flatten an explain() plan tree into (stage, indexName) pairs"""
+    if isinstance(plan, list):
+        return [stage for child in plan for stage in _plan_stages(child)]
+    if not isinstance(plan, dict):
+        return []
+    stages = [(plan["stage"], plan.get("indexName"))] if "stage" in plan else []
+    for key, value in plan.items():
+        if isinstance(value, (dict, list)):
+            stages.extend(_plan_stages(value))
+    return stages
+
+def index_coverage_report():
+    """Explain each query shape and report whether the winning plan uses an index"""
+    report = []
+    for description, collection, query, sort in query_shapes():
+        cursor = collection.find(query).limit(1)
+        if sort:
+            cursor = cursor.sort(sort)
+        stages = _plan_stages(cursor.explain()["queryPlanner"]["winningPlan"])
+        indexes = sorted({name for _, name in stages if name})
+        report.append({
+            "query": description,
+            "collection": collection.name,
+            "covered": any(stage == "IXSCAN" for stage, _ in stages) and not any(stage == "COLLSCAN" for stage, _ in stages),
+            "indexes": indexes
+        })
+    return report
+
+def _echo_coverage_report():
+    for row in index_coverage_report():
+        click.echo(f"{'✅' if row['covered'] else '❌'} {row['query']:<32} {row['collection']:<20} "
+                   f"{', '.join(row['indexes']) or 'COLLSCAN'}")
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Create/rebuild indexes and print which hot queries they cover."""
+    require_database()
+    for result in migrate_database():
+        click.echo(f"{result['action']:<12} {result['collection']}.{result['keys']} {result['options'] or ''}")
+    _echo_coverage_report()
+
+@app.cli.command('dedupe-attendance')
+def dedupe_attendance_command():
+    """Delete repeat marks so the one-mark-per-day unique index can be built."""
+    require_database()
+    click.echo(f"Deleted {dedupe_attendance()} duplicate attendance records")
+
+@app.cli.command('index-report')
+def index_report_command():
+    """Print which hot queries are served by an index."""
+    require_database()
+    _echo_coverage_report()
+
+def generate_random_data(length=10):
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+
+def _qr_token_signature(session_id, channel=None):
+    # Channel codes are signed over the channel too, so they only validate in their own class
+    message = session_id.binary + (b"|" + channel.encode('utf-8') if channel else b"")
+    digest = hmac.new(QR_TOKEN_SECRET.encode('utf-8'), message, hashlib.sha256).digest()
+    return base64.b32encode(digest[:10]).decode('ascii')
+
+def generate_qr_token(session_id, channel=None):
+    """
+    Signed QR payload "<SESSION_ID>.<SIG>", or "<SESSION_ID>.<CHANNEL>.<SIG>" for
+    a class channel (its key). The ObjectId carries the issue time, so expiry is
+    implied; uppercase keeps default-channel codes in the compact QR alphanumeric mode.
+    """
+    middle = f"{channel}." if channel else ""
+    return f"{str(session_id).upper()}.{middle}{_qr_token_signature(session_id, channel)}"
+
+def verify_qr_token(token):
+    """Return (session_id, channel key) for an authentic token, else None. No DB access."""
+    sid_hex, _, rest = token.partition('.')
+    channel, _, signature = rest.rpartition('.')
+    if not ObjectId.is_valid(sid_hex.lower()):
+        return None
+    session_id = ObjectId(sid_hex.lower())
+    if not hmac.compare_digest(signature, _qr_token_signature(session_id, channel or None)):
+        return None
+    return session_id, channel or None
+
+def qr_token_expiry(session_id, validity):
+    # ObjectId timestamps are whole seconds, so allow the truncated fraction
+    return datetime.fromtimestamp(session_id.generation_time.timestamp() + validity + 1)
+
+def generate_qr_code_data(session_id, channel=None):
+    """Payload embedded in the QR for a new session, according to QR_TOKEN_MODE"""
+    if QR_TOKEN_MODE == "signed":
+        return generate_qr_token(session_id, channel)
+    return generate_random_data()
+
+QR_IMAGE_MIMETYPES = {'png': 'image/png', 'svg': 'image/svg+xml'}
+
+def _qr_matrix_to_svg(matrix):
+    """Compact SVG: one path with a horizontal run per row segment of dark modules"""
+    runs = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < len(row):
+            if row[x]:
+                start = x
+                while x < len(row) and row[x]:
+                    x += 1
+                runs.append(f"M{start} {y}h{x - start}v1h-{x - start}z")
+            else:
+                x += 1
+    size = len(matrix)
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {size} {size}" shape-rendering="crispEdges">'
+            f'<rect width="{size}" height="{size}" fill="#fff"/><path d="{"".join(runs)}"/></svg>').encode('utf-8')
+
+@lru_cache(maxsize=QR_RENDER_CACHE_SIZE)
+def render_qr(data, fmt='png'):
+    """Render data as QR image bytes ("png" or "svg"), cached by payload and format"""
+    qrcode = lazy_import('qrcode')
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=QR_IMAGE_BOX_SIZE,
+        border=4,
+    )
+    started = time.perf_counter()
+    qr.add_data(data)
+    qr.make(fit=True)
+
+    if fmt == 'svg':
+        image = _qr_matrix_to_svg(qr.get_matrix())
+    else:
+        # Black on white renders as a 1-bit image; optimize shrinks the PNG further
         img = qr.make_image(fill_color="black", back_color="white")
-        
         buffered = BytesIO()
-        img.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
-        
-        return f"data:image/png;base64,{img_str}"
+        img.save(buffered, format="PNG", optimize=True)
+        image = buffered.getvalue()
+    elapsed = time.perf_counter() - started
+    qr_render_seconds.observe(elapsed, fmt)
+    record_span(f"qr render {fmt}", elapsed)
+    return image
+
+def generate_qr_image(data, fmt=None):
+    """Generate QR code image as a data URI (QR_IMAGE_FORMAT unless fmt is given)"""
+    fmt = fmt or QR_IMAGE_FORMAT
+    try:
+        img_str = base64.b64encode(render_qr(data, fmt)).decode('utf-8')
+        return f"data:{QR_IMAGE_MIMETYPES[fmt]};base64,{img_str}"
     except Exception as e:
         print(f"Error generating QR image: {e}")
         return None
 
+def session_document(session):
+    """The qr_sessions document to store; drops the image unless QR_EMBED_IMAGE_IN_DB"""
+    if QR_EMBED_IMAGE_IN_DB:
+        return session
+    return {k: v for k, v in session.items() if k != "qr_image"}
+
+def session_image(session):
+    """Data URI for a session, from the document or (if not embedded) the render cache"""
+    return session.get('qr_image') or generate_qr_image(session['qr_code']) or ''
+
+def new_session_id(at):
+    """ObjectId whose embedded timestamp is the planned start time `at` (epoch seconds)"""
+    return ObjectId(struct.pack(">I", int(at)) + os.urandom(8))
+
+# Shared by every channel's pre-renderer
+qr_render_pool = ThreadPoolExecutor(max_workers=QR_RENDER_WORKERS, thread_name_prefix="qr-render")
+
+class QRPrerenderer:
+    """Prepares a channel's next QR_PRERENDER_AHEAD codes and renders them on the shared pool"""
+
+    # A pre-rendered code is used only if its planned slot is this close to now
+    SLACK_SECONDS = 1.0
+
+    def __init__(self, ahead, channel):
+        self._ahead = ahead
+        self._channel = channel
+        self._queue = deque()
+        self._lock = threading.Lock()
+
+    def _submit(self, planned_at):
+        session_id = new_session_id(planned_at)
+        qr_data = generate_qr_code_data(session_id, self._channel.key)
+        return planned_at, session_id, qr_data, qr_render_pool.submit(generate_qr_image, qr_data)
+
+    def next_code(self):
+        """(session_id, qr_data, qr_image) for a session starting now"""
+        now = time.time()
+        with self._lock:
+            # Slots missed while the generator was paused or busy are useless now
+            while self._queue and self._queue[0][0] < now - self.SLACK_SECONDS:
+                self._queue.popleft()[3].cancel()
+            if self._queue and self._queue[0][0] <= now + self.SLACK_SECONDS:
+                item = self._queue.popleft()
+            else:
+                item = self._submit(now)
+            planned_at = self._queue[-1][0] if self._queue else item[0]
+            while len(self._queue) < self._ahead:
+                planned_at += self._channel.interval
+                self._queue.append(self._submit(planned_at))
+        _, session_id, qr_data, future = item
+        return session_id, qr_data, future.result()
+
+# --- Leases (one holder across gunicorn workers and replicas) ---
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def acquire_lease(name, ttl_seconds):
+    """
+    Take or renew the named lease for this process. Returns the fencing token
+    (incremented on every change of holder), or None while another holder is live.
+    """
+    now = datetime.now()
+    expires_at = now + timedelta(seconds=ttl_seconds)
+    renewed = leases_collection.find_one_and_update(
+        {"_id": name, "holder": WORKER_ID},
+        {"$set": {"expires_at": expires_at, "renewed_at": now}},
+        return_document=ReturnDocument.AFTER
+    )
+    if renewed:
+        return renewed["token"]
+    try:
+        # Matches only an expired lease; a live one makes the upsert collide on _id
+        acquired = leases_collection.find_one_and_update(
+            {"_id": name, "expires_at": {"$lt": now}},
+            {"$set": {"holder": WORKER_ID, "expires_at": expires_at, "renewed_at": now, "acquired_at": now},
+             "$inc": {"token": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        return None
+    print(f"👑 {WORKER_ID} acquired lease '{name}' (token {acquired['token']})")
+    return acquired["token"]
+
+def release_lease(name):
+    """Give up the lease early so another process can take over immediately"""
+    leases_collection.update_one({"_id": name, "holder": WORKER_ID}, {"$set": {"expires_at": datetime.now()}})
+
+# --- Background janitor ---
+
+janitor_stats = {
+    "runs": 0,
+    "skipped_not_leader": 0,
+    "sessions_deactivated": 0,
+    "sessions_deleted": 0,
+    "attendance_deleted": 0,
+    "budget_exhausted": 0,
+    "last_run_at": None,
+    "last_run_seconds": 0.0,
+    "last_error": None,
+}
+janitor_thread = None
+
+def _batched_ids(collection, query, deadline):
+    """Yield lists of at most JANITOR_BATCH_SIZE matching _ids until none are left or the budget runs out"""
+    while time.monotonic() < deadline:
+        ids = [doc["_id"] for doc in collection.find(query, {"_id": 1}).limit(JANITOR_BATCH_SIZE)]
+        if not ids:
+            return
+        yield ids
+        if len(ids) < JANITOR_BATCH_SIZE:
+            return
+
+def run_janitor_pass():
+    """One batched cleanup pass bounded by JANITOR_TIME_BUDGET_SECONDS. Returns rows touched."""
+    started = time.monotonic()
+    deadline = started + JANITOR_TIME_BUDGET_SECONDS
+    now = datetime.now()
+    deactivated = deleted_sessions = deleted_attendance = 0
+
+    # 1. Mark newly expired sessions as inactive (do not delete attendance)
+    for ids in _batched_ids(qr_sessions_collection, {"is_active": True, "expires_at": {"$lt": now}}, deadline):
+        deactivated += qr_sessions_collection.update_many(
+            {"_id": {"$in": ids}, "is_active": True},
+            {"$set": {"is_active": False, "expired_at": now}}
+        ).modified_count
+
+    # 2. Hard delete sessions (and maybe attendance) older than the retention window,
+    #    unless TTL indexes already do it for us
+    if not RETENTION_VIA_TTL:
+        retention_cutoff = now - timedelta(days=ATTENDANCE_RETENTION_DAYS)
+        for ids in _batched_ids(qr_sessions_collection, {"expires_at": {"$lt": retention_cutoff}}, deadline):
+            counts = rollup_counts(ids, not KEEP_ATTENDANCE_ON_EXPIRE)
+            if not KEEP_ATTENDANCE_ON_EXPIRE:
+                deleted_attendance += attendance_collection.delete_many({"qr_session_id": {"$in": ids}}).deleted_count
+            session_members_collection.delete_many({"session_id": {"$in": ids}})
+            deleted_sessions += qr_sessions_collection.delete_many({"_id": {"$in": ids}}).deleted_count
+            _safe_rollup(apply_rollup_deletions, ids, counts)
+    else:
+        # TTL deletes behind our back; keep at least the totals honest
+        _safe_rollup(reconcile_rollup_totals)
+
+    elapsed = time.monotonic() - started
+    janitor_stats["runs"] += 1
+    janitor_stats["sessions_deactivated"] += deactivated
+    janitor_stats["sessions_deleted"] += deleted_sessions
+    janitor_stats["attendance_deleted"] += deleted_attendance
+    janitor_stats["budget_exhausted"] += int(time.monotonic() >= deadline)
+    janitor_stats["last_run_at"] = now.isoformat()
+    janitor_stats["last_run_seconds"] = round(elapsed, 4)
+
+    if deleted_sessions or deleted_attendance or deactivated:
+        print(f"🧹 JANITOR: expired->inactive={deactivated}, "
+              f"old_sessions_deleted={deleted_sessions}, "
+              f"old_attendance_deleted={deleted_attendance}, "
+              f"keep_attendance={KEEP_ATTENDANCE_ON_EXPIRE}, took={elapsed:.2f}s")
+    return deactivated + deleted_sessions + deleted_attendance
+
+def reconcile_rollup_totals():
+    """Reset the total counters from collection metadata (O(1), approximate after crashes)"""
+    rollups_collection.update_one({"_id": "total"}, {"$set": {
+        "sessions": qr_sessions_collection.estimated_document_count(),
+        "attendance": attendance_collection.estimated_document_count()
+    }}, upsert=True)
+
+def janitor_loop():
+    """Run the janitor every JANITOR_INTERVAL_SECONDS in whichever process holds the lease"""
+    while True:
+        try:
+            if client and acquire_lease("janitor", JANITOR_INTERVAL_SECONDS * 2):
+                run_janitor_pass()
+            else:
+                janitor_stats["skipped_not_leader"] += 1
+        except Exception as e:
+            janitor_stats["last_error"] = str(e)
+            print(f"❌ Error in janitor: {e}")
+        time.sleep(JANITOR_INTERVAL_SECONDS)
+
+def start_janitor():
+    """Start the background janitor thread"""
+    global janitor_thread
+
+    if janitor_thread is None or not janitor_thread.is_alive():
+        janitor_thread = threading.Thread(target=janitor_loop, daemon=True)
+        janitor_thread.start()
+        print(f"🧹 Janitor started (every {JANITOR_INTERVAL_SECONDS}s, batch {JANITOR_BATCH_SIZE})")
+
 def cleanup_expired_qr_codes():
     """Legacy function - now calls the enhanced cleanup"""
     return cleanup_expired_sessions_and_data()
 
 def cleanup_expired_sessions_and_data():
-    """Handle expired QR sessions. By default keep attendance; optionally purge very old data."""
+    """Run one janitor pass right now (e.g. from a shell); requests no longer call this"""
     try:
         if not client:
             return 0
+        return run_janitor_pass()
+    except Exception as e:
+        print(f"❌ Error in cleanup_expired_sessions_and_data: {e}")
+        return 0
 
-        now = datetime.now()
+# Health check endpoint for Render
+@app.route('/')
+@app.route('/health')
+def health_check():
+    """Health check endpoint"""
+    return jsonify({
+        'status': 'healthy',
+        'service': 'KL University Attendance API',
+        'version': '1.0.0',
+        'timestamp': datetime.now().isoformat(),
+        'mongodb_connected': client is not None,
+        'ready': database_ready.is_set(),
+        'storage_backend': STORAGE_BACKEND
+    })
 
-        # 1. Mark newly expired sessions as inactive (do not delete attendance)
-        result_mark = qr_sessions_collection.update_many(
-            {
-                "expires_at": {"$lt": now},
-                "is_active": True
-            },
-            {
-                "$set": {
-                    "is_active": False,
-                    "expired_at": now
-                }
+@app.route('/health/live')
+def liveness():
+    """The process is up and serving; never touches the database"""
+    return jsonify({
+        'status': 'alive',
+        'worker_id': WORKER_ID,
+        'uptime_seconds': round(time.perf_counter() - MODULE_LOAD_STARTED, 1),
+        'startup': startup_report
+    })
+
+@app.route('/health/ready')
+def readiness():
+    """200 once the database is connected and startup work is done, 503 before that"""
+    if database_ready.is_set():
+        return jsonify({'status': 'ready', 'storage_backend': STORAGE_BACKEND})
+    return jsonify({
+        'status': 'unavailable' if database_attempted.is_set() else 'starting',
+        'storage_backend': STORAGE_BACKEND,
+        'error': database_error
+    }), 503
+
+def _stat_lines(name, help, kind, value, labels=(), values=()):
+    return [f"# HELP {name} {help}", f"# TYPE {name} {kind}", f"{name}{_metric_labels(labels, values)} {value}"]
+
+def render_metrics():
+    """This worker's metrics in the Prometheus text format; scrape every worker, they are not shared"""
+    lines = _stat_lines("attendance_api_info", "Worker identity", "gauge", 1,
+                        ("worker_id", "storage_backend"), (WORKER_ID, STORAGE_BACKEND))
+    lines += _stat_lines("process_start_time_seconds", "Start time of this worker (unix seconds)", "gauge", PROCESS_STARTED_AT)
+    lines += _stat_lines("attendance_api_ready", "1 once the database is connected and startup work is done",
+                         "gauge", int(database_ready.is_set()))
+    lines += ["# HELP process_startup_seconds Time spent in each startup phase",
+              "# TYPE process_startup_seconds gauge"] + [
+        f"process_startup_seconds{_metric_labels(('phase',), (phase,))} {startup_report[f'{phase}_seconds']}"
+        for phase in ('imports', 'module', 'database') if startup_report[f'{phase}_seconds'] is not None]
+    lines += ["# HELP process_lazy_import_seconds First-use import time of heavy modules",
+              "# TYPE process_lazy_import_seconds gauge"] + [
+        f"process_lazy_import_seconds{_metric_labels(('module',), (name,))} {seconds}"
+        for name, seconds in sorted(startup_report["lazy_imports"].items())]
+    for metric in (http_request_seconds, http_requests_in_flight, mongodb_command_seconds, mongodb_command_failures,
+                   qr_render_seconds, qr_tick_seconds, qr_drift_seconds):
+        lines += metric.render()
+    channels = qr_channels.all()
+    lines += _stat_lines("qr_generator_leader", "1 if this worker currently issues QR sessions", "gauge", int(is_generator_leader()))
+    lines += _stat_lines("qr_channels_rotating", "Channels whose codes are rotating", "gauge", sum(1 for c in channels if c.scheduled))
+    lines += _stat_lines("qr_display_subscribers", "Displays connected to this worker", "gauge", sum(c.subscribers for c in channels))
+    for key, value in scheduler_stats.items():
+        lines += _stat_lines(f"qr_scheduler_{key}_total", f"Scheduler {key.replace('_', ' ')}", "counter", value)
+    for key in ("runs", "sessions_deactivated", "sessions_deleted", "attendance_deleted", "budget_exhausted", "skipped_not_leader"):
+        lines += _stat_lines(f"janitor_{key}_total", f"Janitor {key.replace('_', ' ')}", "counter", janitor_stats.get(key, 0))
+    if attendance_journal is not None:
+        for key in ("journaled", "duplicates", "flushes", "inserted", "already_present", "failed_flushes"):
+            lines += _stat_lines(f"attendance_journal_{key}_total", f"Journal {key.replace('_', ' ')}", "counter", journal_stats[key])
+        lines += _stat_lines("attendance_journal_backlog", "Journaled marks not yet in MongoDB", "gauge", attendance_journal.backlog())
+    lines += _stat_lines("report_cache_hits_total", "Report cache hits", "counter", report_cache.hits)
+    lines += _stat_lines("report_cache_misses_total", "Report cache misses", "counter", report_cache.misses)
+    lines += _stat_lines("report_cache_bytes", "Bytes of rendered reports held in memory", "gauge", report_cache.size())
+    return "\n".join(lines) + "\n"
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint"""
+    if not METRICS_ENABLED:
+        return jsonify({'error': 'Metrics are disabled'}), 404
+    if METRICS_TOKEN and not bearer_token_matches(METRICS_TOKEN):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def bearer_token_matches(token):
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    return hmac.compare_digest(supplied.encode(), token.encode())
+
+def admin_denied():
+    """Error response unless the request carries ADMIN_TOKEN, else None"""
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Admin endpoints are disabled', 'message': 'Set ADMIN_TOKEN to enable them'}), 404
+    if not bearer_token_matches(ADMIN_TOKEN):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return None
+
+@app.route('/admin/traces')
+def admin_traces():
+    """This worker's recent sampled traces, slowest first (?route= to filter by URL rule)"""
+    denied = admin_denied()
+    if denied:
+        return denied
+    route = request.args.get('route')
+    traces = [t for t in list(recent_traces) if not route or t['route'] == route]
+    return jsonify({
+        'worker_id': WORKER_ID,
+        'sample_rate': TRACE_SAMPLE_RATE,
+        'slow_request_seconds': SLOW_REQUEST_SECONDS,
+        'traces': sorted(traces, key=lambda t: -t['duration_seconds'])
+    })
+
+@app.route('/admin/profile', methods=['GET', 'POST'])
+def admin_profile():
+    """
+    POST {"route": "/download/session/<session_id>", "mode": "cprofile" |
+    "tracemalloc", "requests": N} captures the next N requests to that URL rule
+    on this worker; GET lists pending captures and finished reports.
+    """
+    denied = admin_denied()
+    if denied:
+        return denied
+    if request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        route = body.get('route', '')
+        mode = body.get('mode', 'cprofile')
+        if route not in {rule.rule for rule in app.url_map.iter_rules()}:
+            return jsonify({'error': f'Unknown route: {route}', 'message': 'Use the URL rule, e.g. /download/session/<session_id>'}), 400
+        if mode not in ('cprofile', 'tracemalloc'):
+            return jsonify({'error': 'mode must be cprofile or tracemalloc'}), 400
+        try:
+            count = int(body.get('requests', 1))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'requests must be a number'}), 400
+        if not 1 <= count <= 100:
+            return jsonify({'error': 'requests must be between 1 and 100'}), 400
+        with _profile_plans_lock:
+            profile_plans[route] = {'mode': mode, 'remaining': count}
+        print(f"🔬 {mode} armed for the next {count} request(s) to {route}")
+    with _profile_plans_lock:
+        pending = {route: dict(plan) for route, plan in profile_plans.items()}
+    return jsonify({'worker_id': WORKER_ID, 'pending': pending, 'results': list(profile_results)})
+
+# API Routes
+def await_current_session(channel):
+    """
+    Current session of a channel, waiting briefly if it was just started or
+    resumed: the scheduler publishes within a tick here, or the leader picks up
+    this worker's demand within QR_DEMAND_POLL_SECONDS and its write arrives
+    through the change stream or the next MongoDB check.
+    """
+    timeout = 0.5 if is_generator_leader() else QR_DEMAND_POLL_SECONDS + 1
+    deadline = time.monotonic() + timeout
+    session = get_current_qr_session(channel)
+    while session is None and time.monotonic() < deadline:
+        channel.cache.wait_for_session(min(0.25, max(deadline - time.monotonic(), 0)))
+        session = get_current_qr_session(channel)
+    return session
+
+def request_channel(name=None):
+    """The channel named by name, or by ?channel= when name is None; None if there is no such channel"""
+    if name is None:
+        name = request.args.get('channel', '')
+    return qr_channels.get(name.strip())
+
+def unknown_channel_response():
+    return jsonify({"error": "Unknown channel", "message": "Create it with POST /qr/channels or QR_CHANNELS"}), 404
+
+def qr_payload(session, channel, inline_image=True):
+    """JSON body describing a QR session, shared by /qr and the push channels"""
+    current_time = datetime.now()
+    time_remaining = (session['expires_at'] - current_time).total_seconds()
+    return {
+        "data": session['qr_code'],
+        "image": session_image(session) if inline_image else '',
+        "image_url": f"/qr/{session['_id']}.{QR_IMAGE_FORMAT}",
+        "timestamp": current_time.isoformat(),
+        "expires_at": session['expires_at'].isoformat(),
+        "expires_in": max(0, int(time_remaining)),
+        "session_id": str(session['_id']),
+        "session_name": session["session_name"],
+        "channel": channel.name,
+        "auto_generated": True,
+        "refresh_interval": channel.interval,
+        "message": f"QR auto-refreshes every {channel.interval:g} seconds"
+    }
+
+@app.route('/qr')
+def get_qr():
+    """Get the current auto-generated QR code of ?channel= (default channel), served from memory, supports If-None-Match"""
+    try:
+        if not client:
+            return jsonify({"error": "Database not connected"}), 500
+        
+        channel = request_channel()
+        if channel is None:
+            return unknown_channel_response()
+        
+        # Start auto-generation if not running (or resume it if the channel went idle)
+        start_auto_qr_generation(channel)
+        if not channel.in_class_hours():
+            return jsonify({
+                "error": "No class scheduled on this channel now",
+                "message": "QR codes are only issued during the channel's timetable"
+            }), 503
+        
+        try:
+            active_qr = await_current_session(channel)
+        except Exception as db_error:
+            return jsonify({"error": f"Database error: {str(db_error)}"}), 500
+        
+        if not active_qr:
+            return jsonify({
+                "error": "No active QR code available",
+                "message": "Auto-generation starting, please try again in a moment"
+            }), 503
+        
+        session_id = str(active_qr['_id'])
+        if request.if_none_match.contains(session_id):
+            response = app.response_class(status=304)
+        else:
+            inline_image = request.args.get('inline_image', '1') != '0'
+            response = jsonify(qr_payload(active_qr, channel, inline_image))
+        
+        # Clients must revalidate every poll; the ETag only changes on rotation
+        response.set_etag(session_id)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+        
+    except Exception as e:
+        print(f"❌ Error in get_qr: {e}")
+        return jsonify({"error": str(e)}, 500)
+
+@app.route('/qr/<session_id>.<fmt>')
+def qr_image(session_id, fmt):
+    """Serve a session's QR as binary PNG or SVG; the image never changes, so cache hard"""
+    if fmt not in QR_IMAGE_MIMETYPES:
+        return jsonify({"error": "Unsupported image format. Use .png or .svg"}), 404
+    if not ObjectId.is_valid(session_id):
+        return jsonify({"error": "Invalid session ID format"}), 400
+
+    etag = f"{session_id}.{fmt}"
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        session = next((cached for cached in (c.cache.snapshot()[0] for c in qr_channels.all())
+                        if cached is not None and str(cached['_id']) == session_id), None)
+        if session is None:
+            if not client:
+                return jsonify({"error": "Database not connected"}), 500
+            session = qr_sessions_collection.find_one({"_id": ObjectId(session_id)}, {"qr_code": 1})
+        if not session:
+            return jsonify({"error": "QR session not found"}), 404
+        response = app.response_class(render_qr(session['qr_code'], fmt), mimetype=QR_IMAGE_MIMETYPES[fmt])
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=86400, immutable'
+    return response
+
+@app.route('/qr/stream')
+def qr_stream():
+    """
+    Push every QR rotation of ?channel= (default channel) to a display as Server-Sent Events.
+    Resumes from the Last-Event-ID header (or ?since=<session_id>). Each open
+    stream holds a worker, so run gunicorn with threaded or async workers.
+    """
+    if not client:
+        return jsonify({"error": "Database not connected"}), 500
+
+    channel = request_channel()
+    if channel is None:
+        return unknown_channel_response()
+    start_auto_qr_generation(channel)
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        get_current_qr_session(channel)
+    except Exception as db_error:
+        return jsonify({"error": f"Database error: {str(db_error)}"}), 500
+
+    def events(last_seen):
+        # An open stream keeps the channel rotating until the display disconnects
+        channel.subscribe(1)
+        try:
+            yield f"retry: {int(channel.interval * 1000)}\n\n"
+            while True:
+                session = wait_for_rotation(channel, last_seen, QR_STREAM_HEARTBEAT_SECONDS)
+                if session is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                last_seen = str(session['_id'])
+                yield f"id: {last_seen}\nevent: qr\ndata: {json.dumps(qr_payload(session, channel))}\n\n"
+        finally:
+            channel.subscribe(-1)
+            channel.last_demand = time.monotonic()
+
+    return Response(
+        stream_with_context(events(since)),
+        mimetype='text/event-stream',
+        headers={'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/qr/poll')
+def qr_long_poll():
+    """
+    Long-poll fallback for /qr/stream: returns as soon as the current session of
+    ?channel= differs from ?since=<session_id>, or 204 after ?timeout seconds.
+    """
+    if not client:
+        return jsonify({"error": "Database not connected"}), 500
+
+    channel = request_channel()
+    if channel is None:
+        return unknown_channel_response()
+    start_auto_qr_generation(channel)
+    since = request.args.get('since')
+    try:
+        timeout = min(float(request.args.get('timeout', QR_LONG_POLL_TIMEOUT_SECONDS)), QR_LONG_POLL_TIMEOUT_SECONDS)
+    except ValueError:
+        return jsonify({"error": "timeout must be a number of seconds"}), 400
+
+    try:
+        session = get_current_qr_session(channel)
+    except Exception as db_error:
+        return jsonify({"error": f"Database error: {str(db_error)}"}), 500
+
+    if session is None or str(session['_id']) == since:
+        channel.subscribe(1)
+        try:
+            session = wait_for_rotation(channel, since, timeout)
+        finally:
+            channel.subscribe(-1)
+            channel.last_demand = time.monotonic()
+    if session is None:
+        return '', 204
+    return jsonify(qr_payload(session, channel))
+
+@app.route('/qr/channels', methods=['GET'])
+def list_qr_channels():
+    """Configured rotation channels and whether this worker is rotating them"""
+    try:
+        if not client:
+            return jsonify({'error': 'Database not connected'}), 500
+        
+        timetable = [w.strip() for w in QR_TIMETABLE.split(';') if w.strip()]
+        configs = {DEFAULT_CHANNEL: (QR_AUTO_REFRESH_INTERVAL, QR_VALIDITY_SECONDS, timetable, 'built-in')}
+        for name, (interval, validity) in _static_channel_configs().items():
+            configs[name] = (interval, validity, [], 'QR_CHANNELS')
+        for doc in qr_channels_collection.find():
+            configs[doc['_id']] = (doc['interval_seconds'], doc['validity_seconds'], doc.get('timetable', []), 'database')
+        
+        channels = []
+        for name, (interval, validity, timetable, source) in sorted(configs.items()):
+            local = qr_channels.peek(name)
+            channels.append({
+                'name': name,
+                'interval_seconds': interval,
+                'validity_seconds': validity,
+                'timetable': timetable,
+                'source': source,
+                'rotating_here': bool(local and local.scheduled),
+                'displays_waiting': local.subscribers if local else 0,
+                'qr_url': f"/qr?channel={name}"
+            })
+        lease = leases_collection.find_one({"_id": "qr-generator"}) if QR_LEADER_ELECTION else None
+        return jsonify({
+            'channels': channels,
+            'total': len(channels),
+            'idle_timeout_seconds': QR_IDLE_TIMEOUT_SECONDS,
+            'scheduler': scheduler_stats,
+            'generator': {
+                'worker_id': WORKER_ID,
+                'leader_election': QR_LEADER_ELECTION,
+                'is_leader': is_generator_leader(),
+                'leader': lease and lease.get('holder'),
+                'fencing_token': lease and lease.get('token'),
+                'lease_expires_at': lease and lease['expires_at'].isoformat(),
+                'leader_since': generator_lease['leader_since']
             }
+        })
+        
+    except Exception as e:
+        print(f"❌ Error in list_qr_channels: {e}")
+        return jsonify({'error': str(e), 'message': 'Failed to list channels'}), 500
+
+@app.route('/qr/channels', methods=['POST'])
+def save_qr_channel():
+    """
+    Create or update a channel: {"name", "interval_seconds", "validity_seconds",
+    "timetable": ["Mon-Fri 09:00-10:50", ...]} (no timetable: any time)
+    """
+    try:
+        if not client:
+            return jsonify({'error': 'Database not connected'}), 500
+        
+        data = request.get_json(silent=True) or {}
+        name = str(data.get('name', '')).strip()
+        if not CHANNEL_NAME_PATTERN.match(name) or channel_key(name) is None:
+            return jsonify({'error': 'name must be 1-64 letters, digits, "_", "-" or "." (and not "default")'}), 400
+        try:
+            interval = float(data.get('interval_seconds', QR_AUTO_REFRESH_INTERVAL))
+            validity = float(data.get('validity_seconds', QR_VALIDITY_SECONDS))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'interval_seconds and validity_seconds must be numbers'}), 400
+        if interval < 1 or validity < 1:
+            return jsonify({'error': 'interval_seconds and validity_seconds must be at least 1'}), 400
+        timetable = data.get('timetable') or []
+        try:
+            if not isinstance(timetable, list):
+                raise ValueError('timetable must be a list of windows')
+            parse_timetable(timetable)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid timetable: {e}', 'example': ['Mon-Fri 09:00-10:50', 'Sat 10:00-12:00']}), 400
+        
+        now = datetime.now()
+        qr_channels_collection.update_one(
+            {"_id": name},
+            {"$set": {"interval_seconds": interval, "validity_seconds": validity, "timetable": timetable, "updated_at": now},
+             "$setOnInsert": {"created_at": now}},
+            upsert=True
+        )
+        # Other workers pick the change up within QR_CHANNEL_CONFIG_TTL_SECONDS
+        qr_channels.expire_config(name)
+        print(f"🏫 Channel {name}: every {interval:g}s, valid {validity:g}s")
+        
+        return jsonify({
+            'name': name,
+            'interval_seconds': interval,
+            'validity_seconds': validity,
+            'timetable': timetable,
+            'qr_url': f"/qr?channel={name}"
+        })
+        
+    except Exception as e:
+        print(f"❌ Error in save_qr_channel: {e}")
+        return jsonify({'error': str(e), 'message': 'Failed to save channel'}), 500
+
+def initial_usage():
+    """used_by fields for a new session document, per USED_BY_MODE"""
+    return {"used_by": []} if USED_BY_MODE == "array" else {"used_by_count": 0}
+
+def session_has_member(qr_session, student_id):
+    """Has student_id already used this session? O(1) lookup outside array mode."""
+    if USED_BY_MODE == "array":
+        return student_id in qr_session.get('used_by', [])
+    return session_members_collection.find_one(
+        {"session_id": qr_session['_id'], "student_id": student_id}, {"_id": 1}
+    ) is not None
+
+def record_session_use(session_id, student_id):
+    """Record that student_id used the session and bump its counter"""
+    if USED_BY_MODE == "array":
+        qr_sessions_collection.update_one({"_id": session_id}, {"$addToSet": {"used_by": student_id}})
+        return
+    if not attendance_daily_unique:
+        # Without the daily unique index, membership is what stops double counting
+        try:
+            session_members_collection.insert_one({
+                "session_id": session_id, "student_id": student_id, "created_at": datetime.now()
+            })
+        except DuplicateKeyError:
+            return
+    qr_sessions_collection.update_one({"_id": session_id}, {"$inc": {"used_by_count": 1}})
+
+def record_session_uses(records):
+    """record_session_use for a batch of marks already known to be new, one update per session"""
+    students_by_session = {}
+    for record in records:
+        students_by_session.setdefault(record["qr_session_id"], []).append(record["student_id"])
+    if USED_BY_MODE == "array":
+        ops = [UpdateOne({"_id": sid}, {"$addToSet": {"used_by": {"$each": ids}}}) for sid, ids in students_by_session.items()]
+    else:
+        ops = [UpdateOne({"_id": sid}, {"$inc": {"used_by_count": len(ids)}}) for sid, ids in students_by_session.items()]
+    qr_sessions_collection.bulk_write(ops, ordered=False)
+
+# Server-side count that never ships the used_by array (legacy documents have no counter)
+USED_BY_COUNT_PROJECTION = {
+    "used_by_count": {"$ifNull": ["$used_by_count", {"$size": {"$ifNull": ["$used_by", []]}}]}
+}
+
+def attendance_key(record):
+    """The unique (student_id, session_date, channel) of a mark, as a filter"""
+    return {"student_id": record["student_id"], "session_date": record["session_date"], "channel": record.get("channel")}
+
+def mark_attendance_once(attendance_record):
+    """
+    Upsert keyed on (student_id, session_date, channel). Returns (attendance_id, None)
+    when this call inserted the mark, or (None, existing_record) when the student was
+    already marked today in that channel.
+    """
+    key = attendance_key(attendance_record)
+    attendance_id = ObjectId()
+    on_insert = {k: v for k, v in attendance_record.items() if k not in key}
+    on_insert["_id"] = attendance_id
+    try:
+        existing = attendance_collection.find_one_and_update(
+            key,
+            {"$setOnInsert": on_insert},
+            projection={"marked_at": 1},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
         )
+    except DuplicateKeyError:
+        # Lost a race with a concurrent scan from the same student
+        existing = attendance_collection.find_one(key, {"marked_at": 1}) or {}
+    if existing is not None:
+        return None, existing
+    return attendance_id, None
+
+def already_marked_response(existing_attendance):
+    attendance_time = existing_attendance.get('marked_at', 'Unknown time')
+    return jsonify({
+        'valid': False,
+        'duplicate': True,
+        'message': f'You have already marked attendance today at {attendance_time.strftime("%H:%M:%S") if hasattr(attendance_time, "strftime") else attendance_time}'
+    }), 400
+
+# --- Write-behind attendance journal (ATTENDANCE_WRITE_MODE=journal) ---
+
+journal_stats = {
+    "journaled": 0,
+    "duplicates": 0,
+    "flushes": 0,
+    "inserted": 0,
+    "already_present": 0,
+    "failed_flushes": 0,
+    "replayed_journals": 0,
+    "last_flush_at": None,
+    "last_flush_seconds": 0.0,
+    "last_error": None,
+}
+attendance_journal = None
+attendance_writer_thread = None
+
+class AttendanceJournal:
+    """
+    Marks appended to this process's journal file and fsync'd before the scan
+    is acknowledged, queued in memory for the writer thread. The file is
+    flock'd while the process lives, so a journal nobody holds belongs to a
+    dead process and is replayed. The (student_id, session_date, channel) unique index
+    makes each replay or retry exactly-once.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, f"journal-{re.sub(r'[^0-9A-Za-z.-]', '_', WORKER_ID)}.jsonl")
+        self._lock = threading.Condition()
+        self._file = None
+        self._pending = []
+        self._outstanding = 0
+        # (student_id, session_date, channel) -> marked_at for today's marks made here
+        self._marked = {}
+        self._marked_day = None
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._file = open(self.path, 'ab')
+        fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def append(self, record):
+        """Durably queue a mark. Returns the earlier marked_at if this process already took one for that student today."""
+        key = (record["student_id"], record["session_date"], record.get("channel"))
+        line = json_util.dumps(record).encode('utf-8') + b'\n'
+        with self._lock:
+            if self._marked_day != record["session_date"]:
+                self._marked, self._marked_day = {}, record["session_date"]
+            if key in self._marked:
+                journal_stats["duplicates"] += 1
+                return self._marked[key]
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._marked[key] = record["marked_at"]
+            self._pending.append(record)
+            self._outstanding += 1
+            journal_stats["journaled"] += 1
+            if len(self._pending) >= ATTENDANCE_FLUSH_BATCH_SIZE:
+                self._lock.notify()
+        return None
 
-        deleted_sessions = 0
-        deleted_attendance = 0
+    def take(self, timeout):
+        """Everything queued, after waiting up to timeout for a full batch"""
+        with self._lock:
+            if len(self._pending) < ATTENDANCE_FLUSH_BATCH_SIZE:
+                self._lock.wait(timeout)
+            batch, self._pending = self._pending[:ATTENDANCE_FLUSH_BATCH_SIZE], self._pending[ATTENDANCE_FLUSH_BATCH_SIZE:]
+            return batch
+
+    def done(self, batch, failed):
+        """Requeue failed marks; empty the journal file once every mark in it is in MongoDB"""
+        with self._lock:
+            self._pending[:0] = failed
+            self._outstanding -= len(batch) - len(failed)
+            if self._outstanding == 0:
+                self._file.truncate(0)
+                os.fsync(self._file.fileno())
+
+    def backlog(self):
+        return self._outstanding
+
+def flush_attendance(records):
+    """
+    Upsert journaled marks in one unordered bulk write; marks that already
+    exist are left alone. Counters are bumped only for the marks this call
+    inserted. Returns the marks that hit any other write error.
+    A mark that was already there was acknowledged twice (by another worker
+    in the same flush interval) or is being replayed; it is logged.
+    """
+    ops = []
+    for record in records:
+        key = attendance_key(record)
+        ops.append(UpdateOne(key, {"$setOnInsert": {k: v for k, v in record.items() if k not in key}}, upsert=True))
+    try:
+        result = attendance_collection.bulk_write(ops, ordered=False).bulk_api_result
+    except BulkWriteError as e:
+        # E11000: two upserts for the same student raced and the other one won
+        result = e.details
+    inserted = [records[u["index"]] for u in result.get("upserted", [])]
+    failed = [records[err["index"]] for err in result.get("writeErrors", []) if err.get("code") != 11000]
+    for err in result.get("writeErrors", []):
+        if err.get("code") != 11000:
+            print(f"❌ Attendance write error: {err.get('errmsg')}")
+    if inserted:
+        try:
+            record_session_uses(inserted)
+        except Exception as e:
+            print(f"❌ Session usage update failed: {e}")
+        _safe_rollup(record_attendance_rollups, inserted)
+    already_present = len(records) - len(inserted) - len(failed)
+    if already_present:
+        inserted_ids = {id(r) for r in inserted} | {id(r) for r in failed}
+        students = [r["student_id"] for r in records if id(r) not in inserted_ids]
+        print(f"⚠️ {already_present} journaled marks were already in MongoDB (duplicate acknowledgement or replay): {', '.join(students[:10])}")
+    journal_stats["inserted"] += len(inserted)
+    journal_stats["already_present"] += already_present
+    return failed
 
-        # 2. (Optional) Hard delete sessions (and maybe attendance) older than retention window
-        retention_cutoff = now - timedelta(days=ATTENDANCE_RETENTION_DAYS)
-        old_sessions = list(qr_sessions_collection.find(
-            {"expires_at": {"$lt": retention_cutoff}}
-        ).limit(500))
+def replay_orphaned_journals():
+    """Flush and delete journals whose process died before writing them out"""
+    for name in sorted(os.listdir(ATTENDANCE_JOURNAL_DIR)):
+        path = os.path.join(ATTENDANCE_JOURNAL_DIR, name)
+        if not (name.startswith('journal-') and name.endswith('.jsonl')) or path == attendance_journal.path:
+            continue
+        try:
+            with open(path, 'rb') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # its process is still running
+                records = []
+                for line in f:
+                    try:
+                        records.append(json_util.loads(line))
+                    except ValueError:
+                        pass  # torn last line: the crash came before that scan was acknowledged
+                failed = []
+                for start in range(0, len(records), ATTENDANCE_FLUSH_BATCH_SIZE):
+                    failed += flush_attendance(records[start:start + ATTENDANCE_FLUSH_BATCH_SIZE])
+                if failed:
+                    print(f"⚠️ {len(failed)} marks in {name} could not be written; keeping it")
+                    continue
+                os.remove(path)
+            journal_stats["replayed_journals"] += 1
+            print(f"🔁 Replayed {len(records)} journaled marks from {name}")
+        except FileNotFoundError:
+            pass  # another worker replayed it first
 
-        if old_sessions:
-            old_session_ids = [s["_id"] for s in old_sessions]
+def attendance_writer_loop():
+    """Drain the journal into MongoDB every ATTENDANCE_FLUSH_INTERVAL_SECONDS (sooner when a batch fills)"""
+    last_replay = None
+    while True:
+        try:
+            if last_replay is None or time.monotonic() - last_replay > 60:
+                last_replay = time.monotonic()
+                replay_orphaned_journals()
+        except Exception as e:
+            journal_stats["last_error"] = str(e)
+            print(f"❌ Error replaying attendance journals: {e}")
 
-            if KEEP_ATTENDANCE_ON_EXPIRE:
-                # Only delete the old session docs; keep attendance history
-                del_sess_res = qr_sessions_collection.delete_many({"_id": {"$in": old_session_ids}})
-                deleted_sessions = del_sess_res.deleted_count
-            else:
-                # Delete both sessions and their attendance
-                del_att_res = attendance_collection.delete_many({"qr_session_id": {"$in": old_session_ids}})
-                del_sess_res = qr_sessions_collection.delete_many({"_id": {"$in": old_session_ids}})
-                deleted_sessions = del_sess_res.deleted_count
-                deleted_attendance = del_att_res.deleted_count
+        batch = attendance_journal.take(ATTENDANCE_FLUSH_INTERVAL_SECONDS)
+        if not batch:
+            continue
+        started = time.monotonic()
+        try:
+            failed = flush_attendance(batch)
+        except Exception as e:
+            journal_stats["failed_flushes"] += 1
+            journal_stats["last_error"] = str(e)
+            print(f"❌ Attendance flush of {len(batch)} marks failed, will retry: {e}")
+            failed = batch
+        attendance_journal.done(batch, failed)
+        journal_stats["flushes"] += 1
+        journal_stats["last_flush_at"] = datetime.now().isoformat()
+        journal_stats["last_flush_seconds"] = round(time.monotonic() - started, 3)
+        if failed:
+            time.sleep(ATTENDANCE_FLUSH_INTERVAL_SECONDS)
 
-            if deleted_sessions or deleted_attendance or result_mark.modified_count:
-                print(f"🧹 CLEANUP: expired->inactive={result_mark.modified_count}, "
-                      f"old_sessions_deleted={deleted_sessions}, "
-                      f"old_attendance_deleted={deleted_attendance}, "
-                      f"keep_attendance={KEEP_ATTENDANCE_ON_EXPIRE}")
+def flush_journal_on_exit():
+    """Best effort on a clean shutdown; anything left is replayed from the journal"""
+    batch = attendance_journal.take(0)
+    if batch:
+        try:
+            attendance_journal.done(batch, flush_attendance(batch))
+        except Exception as e:
+            print(f"❌ Could not flush {len(batch)} journaled marks on exit: {e}")
 
-        return result_mark.modified_count + deleted_sessions
+def start_attendance_writer():
+    """Open this process's journal and start the writer thread (journal mode needs the daily unique index)"""
+    global attendance_journal, attendance_writer_thread
 
-    except Exception as e:
-        print(f"❌ Error in cleanup_expired_sessions_and_data: {e}")
-        return 0
+    if not attendance_daily_unique:
+        print("⚠️ ATTENDANCE_WRITE_MODE=journal needs the unique (student_id, session_date, channel) index; writing synchronously")
+        return
+    if attendance_writer_thread is None or not attendance_writer_thread.is_alive():
+        journal = AttendanceJournal(ATTENDANCE_JOURNAL_DIR)
+        journal.open()
+        attendance_journal = journal
+        attendance_writer_thread = threading.Thread(target=attendance_writer_loop, daemon=True)
+        attendance_writer_thread.start()
+        atexit.register(flush_journal_on_exit)
+        print(f"📝 Attendance write-behind journal at {journal.path}")
 
-# Health check endpoint for Render
-@app.route('/')
-@app.route('/health')
-def health_check():
-    """Health check endpoint"""
+@app.route('/attendance/journal/status')
+def attendance_journal_status():
+    """Write-behind counters for this process"""
     return jsonify({
-        'status': 'healthy',
-        'service': 'KL University Attendance API',
-        'version': '1.0.0',
-        'timestamp': datetime.now().isoformat(),
-        'mongodb_connected': client is not None
+        'worker_id': WORKER_ID,
+        'mode': 'journal' if attendance_journal else 'sync',
+        'journal': attendance_journal and attendance_journal.path,
+        'backlog': attendance_journal.backlog() if attendance_journal else 0,
+        'flush_interval_seconds': ATTENDANCE_FLUSH_INTERVAL_SECONDS,
+        'flush_batch_size': ATTENDANCE_FLUSH_BATCH_SIZE,
+        'stats': journal_stats
     })
 
-# API Routes
-@app.route('/qr')
-def get_qr():
-    """Get the current auto-generated QR code"""
-    try:
-        global current_qr_session
-        
-        if not client:
-            return jsonify({"error": "Database not connected"}), 500
-        
-        # Start auto-generation if not running
-        start_auto_qr_generation()
-        
-        # If no current session, wait a moment for auto-generation
-        if not current_qr_session:
-            time.sleep(0.5)  # Brief wait for auto-generation to start
-        
-        # Get the most recent active QR session
-        try:
-            active_qr = qr_sessions_collection.find_one({
-                "is_active": True,
-                "expires_at": {"$gt": datetime.now()}
-            }, sort=[("created_at", -1)])
-        except Exception as db_error:
-            return jsonify({"error": f"Database error: {str(db_error)}"}), 500
-        
-        if not active_qr:
-            return jsonify({
-                "error": "No active QR code available",
-                "message": "Auto-generation starting, please try again in a moment"
-            }), 503
-        
-        current_time = datetime.now()
-        time_remaining = (active_qr['expires_at'] - current_time).total_seconds()
-        
-        return jsonify({
-            "data": active_qr['qr_code'],
-            "image": active_qr.get('qr_image', ''),
-            "timestamp": current_time.isoformat(),
-            "expires_at": active_qr['expires_at'].isoformat(),
-            "expires_in": max(0, int(time_remaining)),
-            "session_id": str(active_qr['_id']),
-            "session_name": active_qr["session_name"],
-            "auto_generated": True,
-            "refresh_interval": QR_AUTO_REFRESH_INTERVAL,
-            "message": f"QR auto-refreshes every {QR_AUTO_REFRESH_INTERVAL} seconds"
-        })
-        
-    except Exception as e:
-        print(f"❌ Error in get_qr: {e}")
-        return jsonify({"error": str(e)}, 500)
-
 @app.route('/validate', methods=['POST', 'OPTIONS'])
 def validate_qr():
     """Validate QR code and mark attendance"""
@@ -348,8 +2868,6 @@ def validate_qr():
                 'valid': False,
                 'message': 'Database not connected'
             }), 500
-            
-        cleanup_expired_qr_codes()
         
         # Better JSON parsing with error handling
         try:
@@ -368,6 +2886,8 @@ def validate_qr():
         qr_code = data.get('qr_code', '').strip()
         student_id = data.get('student_id', '').strip()
         student_name = data.get('student_name', '').strip()
+        # Optional: the scanner's class; the code must then belong to that channel
+        channel_name = (data.get('channel') or '').strip()
         
         print(f"🔍 Validation request: QR={qr_code}, Student={student_id}")
         
@@ -384,9 +2904,9 @@ def validate_qr():
                 'message': 'Student ID is required'
             }), 400
         
-        # Check if student exists in database
+        # Check if student exists in database (served from the roster cache)
         try:
-            student = students_collection.find_one({"student_id": student_id})
+            student = roster_cache.get(student_id)
             if not student:
                 return jsonify({
                     'valid': False,
@@ -399,17 +2919,43 @@ def validate_qr():
                 'message': 'Database error while finding student'
             }), 500
         
+        requested_channel = request_channel(channel_name) if channel_name else None
+        if channel_name and requested_channel is None:
+            return jsonify({'valid': False, 'message': f'Unknown class channel {channel_name}'}), 400
+        
         # Check if QR code exists and is valid
         current_time = datetime.now()
-        try:
-            # Fetch session regardless of active flag
-            qr_session = qr_sessions_collection.find_one({"qr_code": qr_code})
-        except Exception as qr_error:
-            print(f"❌ Database error finding QR session: {qr_error}")
-            return jsonify({'valid': False,'message': 'Database error while validating QR code'}), 500
+        if QR_TOKEN_MODE == "signed":
+            # Signature and expiry are checked in CPU; the session doc is only written to.
+            # The token names its channel, so the scanner need not.
+            verified = verify_qr_token(qr_code)
+            channel = verified and qr_channels.get(verified[1])
+            if not channel:
+                return jsonify({'valid': False,'message': 'Invalid QR code'}), 400
+            session_id = verified[0]
+            if requested_channel is not None and requested_channel.key != channel.key:
+                return jsonify({'valid': False,'message': 'This QR code belongs to a different class'}), 400
+            current = channel.cache.snapshot()[0]
+            qr_session = {
+                "_id": session_id,
+                "expires_at": qr_token_expiry(session_id, channel.validity),
+                "is_active": current is None or current["_id"] == session_id,
+                **channel_fields(channel.name)
+            }
+        else:
+            try:
+                # Fetch session regardless of active flag (used_by only matters in legacy array mode)
+                legacy_array = USED_BY_MODE == "array" and not attendance_daily_unique
+                projection = {"qr_image": 0} if legacy_array else {"used_by": 0, "qr_image": 0}
+                qr_session = qr_sessions_collection.find_one({"qr_code": qr_code}, projection)
+            except Exception as qr_error:
+                print(f"❌ Database error finding QR session: {qr_error}")
+                return jsonify({'valid': False,'message': 'Database error while validating QR code'}), 500
 
-        if not qr_session:
-            return jsonify({'valid': False,'message': 'Invalid QR code'}), 400
+            if not qr_session:
+                return jsonify({'valid': False,'message': 'Invalid QR code'}), 400
+            if requested_channel is not None and qr_session.get('channel') != requested_channel.key:
+                return jsonify({'valid': False,'message': 'This QR code belongs to a different class'}), 400
 
         expired = qr_session['expires_at'] <= current_time
         rotated = (not qr_session.get('is_active', True)) and not expired
@@ -421,34 +2967,31 @@ def validate_qr():
             return jsonify({'valid': False,'message': 'QR code rotated. Scan the latest QR now displayed.'}), 400
         # If rotated but ACCEPT_ROTATED_WITHIN_EXPIRY=True, continue as valid
         
-        # Check if student already marked attendance with this QR
-        used_by_list = qr_session.get('used_by', [])
-        if student_id in used_by_list:
-            return jsonify({
-                'valid': False,
-                'message': 'You have already marked attendance with this QR code'
-            }), 400
-        
-        # Check if student already marked attendance today
         today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        try:
-            existing_attendance = attendance_collection.find_one({
-                "student_id": student_id,
-                "session_date": today_start
-            })
-        except Exception as attendance_error:
-            print(f"❌ Database error checking existing attendance: {attendance_error}")
-            return jsonify({
-                'valid': False,
-                'message': 'Database error while checking attendance'
-            }), 500
-        
-        if existing_attendance:
-            attendance_time = existing_attendance.get('marked_at', 'Unknown time')
-            return jsonify({
-                'valid': False,
-                'message': f'You have already marked attendance today at {attendance_time.strftime("%H:%M:%S") if hasattr(attendance_time, "strftime") else attendance_time}'
-            }), 400
+        if not attendance_daily_unique:
+            # Check if student already marked attendance with this QR
+            if session_has_member(qr_session, student_id):
+                return jsonify({
+                    'valid': False,
+                    'message': 'You have already marked attendance with this QR code'
+                }), 400
+            
+            # Check if student already marked attendance today
+            try:
+                existing_attendance = attendance_collection.find_one({
+                    "student_id": student_id,
+                    "session_date": today_start,
+                    "channel": qr_session.get('channel')
+                })
+            except Exception as attendance_error:
+                print(f"❌ Database error checking existing attendance: {attendance_error}")
+                return jsonify({
+                    'valid': False,
+                    'message': 'Database error while checking attendance'
+                }), 500
+            
+            if existing_attendance:
+                return already_marked_response(existing_attendance)
         
         # Mark attendance
         attendance_record = {
@@ -458,6 +3001,7 @@ def validate_qr():
             "year": student.get('year', '2024'),
             "qr_code": qr_code,
             "qr_session_id": qr_session['_id'],
+            **channel_fields(qr_session.get('channel')),
             "marked_at": current_time,
             "session_date": today_start,
             "status": "present",
@@ -466,15 +3010,36 @@ def validate_qr():
         }
         
         try:
-            # Insert attendance record
-            attendance_result = attendance_collection.insert_one(attendance_record)
-            print(f"✅ INSERTED attendance _id={attendance_result.inserted_id} student={student_id} qr={qr_code}")
-            
-            # Update QR session to mark it as used by this student
-            qr_sessions_collection.update_one(
-                {"_id": qr_session['_id']},
-                {"$push": {"used_by": student_id}}
-            )
+            if attendance_journal is not None:
+                # Acknowledged once it is on local disk; the writer thread upserts it
+                # (a mark already in MongoDB from another worker wins there)
+                try:
+                    existing_attendance = attendance_collection.find_one(attendance_key(attendance_record), {"marked_at": 1})
+                except Exception as attendance_error:
+                    # The journal is there to ride out the database; its own dedupe still applies
+                    print(f"⚠️ Could not check for an existing mark, journaling anyway: {attendance_error}")
+                    existing_attendance = None
+                if existing_attendance:
+                    return already_marked_response(existing_attendance)
+                attendance_id = ObjectId()
+                marked_at = attendance_journal.append({"_id": attendance_id, **attendance_record})
+                if marked_at is not None:
+                    return already_marked_response({'marked_at': marked_at})
+                print(f"📝 JOURNALED attendance _id={attendance_id} student={student_id} qr={qr_code}")
+            else:
+                if attendance_daily_unique:
+                    # Insert-if-absent in one round trip; the previous document means "duplicate"
+                    attendance_id, existing_attendance = mark_attendance_once(attendance_record)
+                    if existing_attendance:
+                        return already_marked_response(existing_attendance)
+                else:
+                    # Insert attendance record
+                    attendance_id = attendance_collection.insert_one(attendance_record).inserted_id
+                print(f"✅ INSERTED attendance _id={attendance_id} student={student_id} qr={qr_code}")
+                
+                # Update QR session to mark it as used by this student
+                record_session_use(qr_session['_id'], student_id)
+                _safe_rollup(record_attendance_rollup, attendance_record)
             
             print(f"✅ Attendance marked: {student_id} - {student.get('name')}")
             
@@ -484,7 +3049,7 @@ def validate_qr():
                 'student_name': student.get('name', student_name),
                 'student_id': student_id,
                 'timestamp': current_time.isoformat(),
-                'attendance_id': str(attendance_result.inserted_id)
+                'attendance_id': str(attendance_id)
             })
             
         except Exception as insert_error:
@@ -502,10 +3067,262 @@ def validate_qr():
             'message': f'Server error: Please try again later'
         }), 500
 
+# --- Streaming report export ---
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+def csv_chunks(columns, rows):
+    """Encode rows as CSV, yielding roughly EXPORT_CHUNK_SIZE bytes at a time"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM so Excel opens UTF-8 names correctly
+    buffer.write('\ufeff')
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+def xlsx_chunks(sheets):
+    """
+    Build an .xlsx with openpyxl's write-only mode (rows are flushed to disk as
+    they are appended) and stream the file. sheets: [(title, columns, rows_fn)];
+    rows_fn is called only when its sheet is written, so later sheets can
+    summarise earlier ones.
+    """
+    workbook = lazy_import('openpyxl').Workbook(write_only=True)
+    for title, columns, rows_fn in sheets:
+        sheet = workbook.create_sheet(title=title)
+        with trace_span(f"openpyxl sheet {title}"):
+            sheet.append(columns)
+            try:
+                for row in rows_fn():
+                    sheet.append(row)
+            except Exception:
+                # Finish the sheet's temp file now, not in openpyxl's generator at garbage collection
+                sheet.close()
+                raise
+    with tempfile.TemporaryFile() as buffer:
+        with trace_span("openpyxl save"):
+            workbook.save(buffer)
+        buffer.seek(0)
+        while True:
+            chunk = buffer.read(EXPORT_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+def _started_body(body, filename):
+    """
+    Produce the first chunk now, inside the request handler, so an error in the
+    first rows (for xlsx: in any row, the workbook is built first) becomes a 500
+    instead of a truncated 200. A later error aborts the connection mid-body.
+    """
+    body = iter(body)
+    first = next(body, b'')
+
+    def stream():
+        yield first
+        try:
+            yield from body
+        except Exception as e:
+            print(f"❌ Export {filename} failed mid-stream, aborting the download: {e}")
+            raise
+    return stream()
+
+def export_response(filename_base, fmt, sheets):
+    """Streaming download of sheets as xlsx, or the first sheet as csv"""
+    if fmt == 'csv':
+        title, columns, rows_fn = sheets[0]
+        body, mimetype, filename = csv_chunks(columns, rows_fn()), 'text/csv', f"{filename_base}.csv"
+    else:
+        body, mimetype, filename = xlsx_chunks(sheets), XLSX_MIMETYPE, f"{filename_base}.xlsx"
+    return Response(_started_body(body, filename), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+# --- Report cache ---
+
+class ReportCache:
+    """Rendered report bodies by key: an LRU bounded by total bytes, optionally mirrored to a directory"""
+
+    def __init__(self, max_bytes, directory=None, disk_max_bytes=0):
+        self._max_bytes = max_bytes
+        self._directory = directory
+        self._disk_max_bytes = disk_max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def size(self):
+        """Bytes held in memory"""
+        return self._bytes
+
+    def get(self, key):
+        """(body, mimetype, content_disposition) or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if entry is not None:
+            self._remember(key, entry)
+        return entry
+
+    def put(self, key, body, mimetype, content_disposition):
+        entry = (body, mimetype, content_disposition)
+        self._remember(key, entry)
+        try:
+            self._write_disk(key, entry)
+        except OSError as e:
+            print(f"⚠️ Could not write report cache file: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remember(self, key, entry):
+        size = len(entry[0])
+        # One huge report must not flush everything else
+        if size > self._max_bytes // 4:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[0])
+            self._entries[key] = entry
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted[0])
+
+    def _paths(self, key):
+        return os.path.join(self._directory, f"{key}.body"), os.path.join(self._directory, f"{key}.json")
+
+    def _read_disk(self, key):
+        if not self._directory:
+            return None
+        body_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with open(body_path, 'rb') as f:
+                body = f.read()
+            os.utime(meta_path)
+        except (OSError, ValueError):
+            return None
+        return body, meta['mimetype'], meta.get('content_disposition')
+
+    def _write_disk(self, key, entry):
+        if not self._directory:
+            return
+        body, mimetype, content_disposition = entry
+        body_path, meta_path = self._paths(key)
+        # Write-then-rename so another worker never reads half a file; the
+        # metadata goes last, so a body without it is simply not found
+        for path, data in ((body_path, body), (meta_path, json.dumps({
+                'mimetype': mimetype, 'content_disposition': content_disposition}).encode('utf-8'))):
+            fd, tmp_path = tempfile.mkstemp(dir=self._directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        self._trim_disk()
+
+    def _trim_disk(self):
+        """Delete least recently used files until the directory fits REPORT_CACHE_DISK_MAX_BYTES"""
+        entries = []
+        total = 0
+        for name in os.listdir(self._directory):
+            if not name.endswith('.json'):
+                continue
+            body_path, meta_path = self._paths(name[:-5])
+            try:
+                size = os.path.getsize(body_path)
+                used = os.path.getmtime(meta_path)
+            except OSError:
+                continue
+            entries.append((used, size, body_path, meta_path))
+            total += size
+        for used, size, body_path, meta_path in sorted(entries):
+            if total <= self._disk_max_bytes:
+                break
+            for path in (meta_path, body_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+report_cache = ReportCache(REPORT_CACHE_MAX_BYTES, REPORT_CACHE_DIR or None, REPORT_CACHE_DISK_MAX_BYTES)
+
+def cached_report(version, build):
+    """
+    Serve the current request (path + query string) from report_cache when
+    `version` (see report_version) is unchanged, otherwise call build() for the
+    streaming Response and keep a copy of the body as it is sent. The cache key
+    doubles as the ETag, so repeat downloads can also be answered with a 304.
+    version=None bypasses the cache.
+    """
+    if version is None:
+        return build()
+    key = hashlib.sha256(json.dumps(
+        [request.path, sorted(request.args.items(multi=True)), version], default=str, sort_keys=True
+    ).encode('utf-8')).hexdigest()[:32]
+
+    if request.if_none_match.contains(key):
+        response = Response(status=304)
+    else:
+        entry = report_cache.get(key)
+        if entry is not None:
+            body, mimetype, content_disposition = entry
+            response = Response(body, mimetype=mimetype)
+            if content_disposition:
+                response.headers['Content-Disposition'] = content_disposition
+        else:
+            response = build()
+            if response.status_code != 200:
+                return response
+            response.response = _tee_into_cache(key, response.response, response.mimetype,
+                                                response.headers.get('Content-Disposition'))
+    response.set_etag(key)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def _tee_into_cache(key, body, mimetype, content_disposition):
+    chunks = []
+    for chunk in body:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        chunks.append(chunk)
+        yield chunk
+    # Only reached when body finished normally: an export error or a client
+    # disconnect leaves the loop by exception, so partial output is never cached
+    report_cache.put(key, b''.join(chunks), mimetype, content_disposition)
+
+def _export_format():
+    fmt = request.args.get('format', 'xlsx').lower()
+    if fmt not in ('xlsx', 'csv'):
+        raise ValueError('format must be xlsx or csv')
+    return fmt
+
 # Also fix the download_excel function for better date handling
 @app.route('/download/excel')
 def download_excel():
-    """Download attendance report as Excel"""
+    """Download attendance report as Excel (or ?format=csv), streamed"""
     try:
         if not client:
             return jsonify({'error': 'Database not connected'}), 500
@@ -526,65 +3343,58 @@ def download_excel():
             # Today only
             start_date = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
         
-        end_date = start_date + timedelta(days=1)
-        
-        # Get all students
-        students = list(students_collection.find({}).sort("student_id", 1))
+        try:
+            fmt = _export_format()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # Get attendance records for the date range
-        attendance_records = list(attendance_collection.find({
-            "session_date": start_date
-        }))
+        # ?channel= limits the report to one class; otherwise a student's first mark of the day counts
+        attendance_filter = {"session_date": start_date}
+        if request.args.get('channel') is not None:
+            attendance_filter["channel"] = channel_key(request.args['channel'])
         
-        # Create attendance lookup
-        attendance_lookup = {}
-        for record in attendance_records:
-            attendance_lookup[record['student_id']] = record
-        
-        # Prepare Excel data
-        excel_data = []
-        for student in students:
-            row = {
-                'Student_ID': student['student_id'],
-                'Name': student['name'],
-                'Department': student['department'],
-                'Year': student['year'],
-                'Email': student.get('email', ''),
-                'Phone': student.get('phone', '')
+        def build():
+            # Get all students
+            students = roster_cache.all()
+            
+            # Only the fields the report shows; newest first so the earliest mark wins
+            attendance_lookup = {
+                record['student_id']: record
+                for record in attendance_collection.find(
+                    attendance_filter,
+                    {"_id": 0, "student_id": 1, "marked_at": 1, "qr_code": 1}
+                ).sort("marked_at", -1)
             }
             
-            # Add attendance status
-            if student['student_id'] in attendance_lookup:
-                attendance_record = attendance_lookup[student['student_id']]
-                row['Attendance_Status'] = 'Present'
-                row['Attendance_Time'] = attendance_record['marked_at'].strftime('%H:%M:%S')
-                row['QR_Code_Used'] = attendance_record['qr_code']
-            else:
-                row['Attendance_Status'] = 'Absent'
-                row['Attendance_Time'] = ''
-                row['QR_Code_Used'] = ''
+            columns = ['Student_ID', 'Name', 'Department', 'Year', 'Email', 'Phone',
+                       'Attendance_Status', 'Attendance_Time', 'QR_Code_Used']
             
-            excel_data.append(row)
-        
-        # Create DataFrame and Excel file
-        df = pd.DataFrame(excel_data)
-        
-        # Create Excel file in memory
-        excel_buffer = BytesIO()
-        with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Attendance Report', index=False)
-        
-        excel_buffer.seek(0)
-        
-        # Generate filename
-        filename = f"Attendance_Report_{start_date.strftime('%Y%m%d')}.xlsx"
+            def rows():
+                for student in students:
+                    record = attendance_lookup.get(student['student_id'])
+                    yield [
+                        student['student_id'],
+                        student['name'],
+                        student.get('department', ''),
+                        student.get('year', ''),
+                        student.get('email', ''),
+                        student.get('phone', ''),
+                        'Present' if record else 'Absent',
+                        record['marked_at'].strftime('%H:%M:%S') if record else '',
+                        record['qr_code'] if record else ''
+                    ]
+            
+            return export_response(
+                f"Attendance_Report_{start_date.strftime('%Y%m%d')}",
+                fmt,
+                [('Attendance Report', columns, rows)]
+            )
         
-        return send_file(
-            excel_buffer,
-            as_attachment=True,
-            download_name=filename,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
+        # The report lists the whole roster, so a roster change is a new version too
+        version = report_version(day=start_date)
+        if version is not None:
+            version['roster'] = roster_cache.digest()
+        return cached_report(version, build)
         
     except Exception as e:
         print(f"❌ Error in download_excel: {e}")
@@ -595,86 +3405,84 @@ def download_excel():
 
 @app.route('/download/session/<session_id>')
 def download_session_excel(session_id):
-    """Download attendance report for a specific QR session - triggers auto cleanup"""
+    """Download attendance report for a specific QR session (xlsx or ?format=csv), streamed"""
     try:
         if not client:
             return jsonify({'error': 'Database not connected'}), 500
-        
-        # AUTO-CLEANUP: Remove expired sessions when downloading
-        print("🗑️ Performing auto-cleanup during download...")
-        cleanup_expired_sessions_and_data()
             
+        try:
+            fmt = _export_format()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
         # Find the QR session
         try:
-            qr_session = qr_sessions_collection.find_one({"_id": ObjectId(session_id)})
+            qr_session = qr_sessions_collection.find_one(
+                {"_id": ObjectId(session_id)},
+                {"qr_code": 1, "created_at": 1, "expires_at": 1}
+            )
         except:
             return jsonify({'error': 'Invalid session ID format'}), 400
             
         if not qr_session:
             return jsonify({'error': 'QR session not found'}), 404
         
-        # Get attendance records for this specific session
-        attendance_records = list(attendance_collection.find({
-            "qr_session_id": ObjectId(session_id)
-        }))
-        
-        if not attendance_records:
+        session_filter = {"qr_session_id": qr_session['_id']}
+        if not attendance_collection.find_one(session_filter, {"_id": 1}):
             return jsonify({'error': 'No attendance records found for this session'}), 404
         
-        # Prepare Excel data for this session only
-        excel_data = []
-        for record in attendance_records:
-            row = {
-                'Session_ID': session_id,
-                'QR_Code': record['qr_code'],
-                'Student_ID': record['student_id'],
-                'Student_Name': record['student_name'],
-                'Department': record['department'],
-                'Year': record['year'],
-                'Attendance_Time': record['marked_at'].strftime('%Y-%m-%d %H:%M:%S'),
-                'Status': 'Present',
-                'IP_Address': record.get('ip_address', ''),
-                'User_Agent': record.get('user_agent', '')[:50] + '...' if len(record.get('user_agent', '')) > 50 else record.get('user_agent', '')
-            }
-            excel_data.append(row)
+        columns = ['Session_ID', 'QR_Code', 'Student_ID', 'Student_Name', 'Department', 'Year',
+                   'Attendance_Time', 'Status', 'IP_Address', 'User_Agent']
+        present = []
         
-        # Create DataFrame and Excel file
-        df = pd.DataFrame(excel_data)
+        def rows():
+            # Streams this session's attendance straight from the cursor
+            cursor = attendance_collection.find(session_filter, {
+                "_id": 0, "qr_code": 1, "student_id": 1, "student_name": 1, "department": 1,
+                "year": 1, "marked_at": 1, "ip_address": 1, "user_agent": 1
+            }).sort("marked_at", 1)
+            for record in cursor:
+                present.append(record['student_id'])
+                user_agent = record.get('user_agent', '')
+                yield [
+                    session_id,
+                    record['qr_code'],
+                    record['student_id'],
+                    record['student_name'],
+                    record['department'],
+                    record['year'],
+                    record['marked_at'].strftime('%Y-%m-%d %H:%M:%S'),
+                    'Present',
+                    record.get('ip_address', ''),
+                    user_agent[:50] + '...' if len(user_agent) > 50 else user_agent
+                ]
         
-        # Create Excel file in memory
-        excel_buffer = BytesIO()
-        with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name=f'Session {session_id[:8]}', index=False)
-            
-            # Add summary sheet
-            summary_data = [{
-                'Session_ID': session_id,
-                'QR_Code': qr_session['qr_code'],
-                'Session_Created': qr_session['created_at'].strftime('%Y-%m-%d %H:%M:%S'),
-                'Session_Expired': qr_session['expires_at'].strftime('%Y-%m-%d %H:%M:%S'),
-                'Total_Attendees': len(attendance_records),
-                'Students_Present': ', '.join([r['student_id'] for r in attendance_records]),
-                'Download_Time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'Auto_Cleanup_Performed': 'Yes'
-            }]
-            summary_df = pd.DataFrame(summary_data)
-            summary_df.to_excel(writer, sheet_name='Session Summary', index=False)
-        
-        excel_buffer.seek(0)
+        summary_columns = ['Session_ID', 'QR_Code', 'Session_Created', 'Session_Expired', 'Total_Attendees',
+                           'Students_Present', 'Download_Time', 'Auto_Cleanup_Performed']
+        
+        def summary_rows():
+            # Written after the attendance sheet, so `present` is complete
+            yield [
+                session_id,
+                qr_session['qr_code'],
+                qr_session['created_at'].strftime('%Y-%m-%d %H:%M:%S'),
+                qr_session['expires_at'].strftime('%Y-%m-%d %H:%M:%S'),
+                len(present),
+                ', '.join(present),
+                datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                f'Background janitor (every {JANITOR_INTERVAL_SECONDS}s)'
+            ]
         
         # Generate unique filename with timestamp
         session_time = qr_session['created_at'].strftime('%Y%m%d_%H%M%S')
-        filename = f"Attendance_Session_{session_time}_{session_id[:8]}.xlsx"
+        filename = f"Attendance_Session_{session_time}_{session_id[:8]}"
         
-        print(f"📊 Session download complete: {filename}")
-        print(f"🗑️ Expired data automatically cleaned up")
+        print(f"📊 Session download: {filename}.{fmt}")
         
-        return send_file(
-            excel_buffer,
-            as_attachment=True,
-            download_name=filename,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
+        return cached_report(report_version(session_id=qr_session['_id']), lambda: export_response(filename, fmt, [
+            (f'Session {session_id[:8]}', columns, rows),
+            ('Session Summary', summary_columns, summary_rows)
+        ]))
         
     except Exception as e:
         print(f"❌ Error in download_session_excel: {e}")
@@ -683,17 +3491,123 @@ def download_session_excel(session_id):
             'message': 'Failed to generate session Excel report'
         }), 500
 
+def attendance_matrix(start_date, end_date, students):
+    """
+    Student x class-day attendance (1/0) for [start_date, end_date], with days
+    present and percentage. MongoDB groups to distinct (student, day) pairs;
+    pandas pivots them in one vectorised step.
+    """
+    pd = lazy_import('pandas')
+    student_ids = [s['student_id'] for s in students]
+    match = {"session_date": {"$gte": start_date, "$lte": end_date}}
+    if len(student_ids) < len(roster_cache):
+        match["student_id"] = {"$in": student_ids}
+
+    records = list(attendance_collection.aggregate([
+        {"$match": match},
+        {"$group": {"_id": {"student_id": "$student_id", "date": "$session_date"}}},
+        {"$project": {"_id": 0, "student_id": "$_id.student_id", "date": "$_id.date"}}
+    ], allowDiskUse=True))
+
+    with trace_span("pandas attendance matrix"):
+        pairs = pd.DataFrame(records, columns=['student_id', 'date'])
+        # A class day is any day on which someone in this population was marked
+        class_days = pd.DatetimeIndex(pairs['date'].unique()).sort_values()
+        matrix = pd.crosstab(pairs['student_id'], pairs['date']).clip(upper=1) if len(pairs) else pd.DataFrame()
+        matrix = matrix.reindex(index=student_ids, columns=class_days, fill_value=0).astype(int)
+        days_present = matrix.sum(axis=1)
+        percentage = (days_present * 100 / len(class_days)).round(1) if len(class_days) else days_present * 0.0
+    return matrix, days_present, percentage
+
+@app.route('/reports/range')
+def range_report():
+    """
+    Attendance matrix over a date range with per-student percentages.
+    Query: from, to (YYYY-MM-DD, inclusive), department, year, below (only
+    students under this percentage), format=xlsx|csv|json.
+    """
+    try:
+        if not client:
+            return jsonify({'error': 'Database not connected'}), 500
+        
+        try:
+            start_date = datetime.strptime(request.args['from'], '%Y-%m-%d')
+            end_date = datetime.strptime(request.args.get('to') or request.args['from'], '%Y-%m-%d')
+        except KeyError:
+            return jsonify({'error': 'from is required (YYYY-MM-DD)'}), 400
+        except ValueError:
+            return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
+        if end_date < start_date:
+            return jsonify({'error': 'to must not be before from'}), 400
+        if (end_date - start_date).days >= RANGE_REPORT_MAX_DAYS:
+            return jsonify({'error': f'Range is limited to {RANGE_REPORT_MAX_DAYS} days'}), 400
+        
+        fmt = request.args.get('format', 'xlsx').lower()
+        if fmt not in ('xlsx', 'csv', 'json'):
+            return jsonify({'error': 'format must be xlsx, csv or json'}), 400
+        try:
+            below = float(request.args['below']) if request.args.get('below') else None
+        except ValueError:
+            return jsonify({'error': 'below must be a percentage'}), 400
+        
+        # The roster is the source of truth for who is in a department/year
+        department = (request.args.get('department') or '').strip().lower()
+        year = (request.args.get('year') or '').strip()
+        students = [
+            s for s in roster_cache.all()
+            if (not department or str(s.get('department', '')).lower() == department)
+            and (not year or str(s.get('year', '')) == year)
+        ]
+        
+        matrix, days_present, percentage = attendance_matrix(start_date, end_date, students)
+        if below is not None:
+            keep = percentage < below
+            students = [s for s, k in zip(students, keep) if k]
+            matrix, days_present, percentage = matrix[keep], days_present[keep], percentage[keep]
+        day_labels = [d.strftime('%Y-%m-%d') for d in matrix.columns]
+        
+        if fmt == 'json':
+            return jsonify({
+                'from': start_date.strftime('%Y-%m-%d'),
+                'to': end_date.strftime('%Y-%m-%d'),
+                'class_days': day_labels,
+                'students': [{
+                    'student_id': s['student_id'],
+                    'name': s.get('name', ''),
+                    'attendance': ''.join('P' if v else 'A' for v in marks),
+                    'days_present': int(present),
+                    'percentage': float(pct)
+                } for s, marks, present, pct in zip(students, matrix.to_numpy(), days_present, percentage)]
+            })
+        
+        columns = ['Student_ID', 'Name', 'Department', 'Year'] + day_labels + ['Days_Present', 'Class_Days', 'Percentage']
+        
+        def rows():
+            for s, marks, present, pct in zip(students, matrix.to_numpy(), days_present, percentage):
+                yield ([s['student_id'], s.get('name', ''), s.get('department', ''), s.get('year', '')]
+                       + ['P' if v else 'A' for v in marks]
+                       + [int(present), len(day_labels), float(pct)])
+        
+        return export_response(
+            f"Attendance_Range_{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}",
+            fmt,
+            [('Attendance Matrix', columns, rows)]
+        )
+        
+    except Exception as e:
+        print(f"❌ Error in range_report: {e}")
+        return jsonify({
+            'error': str(e),
+            'message': 'Failed to generate range report'
+        }), 500
+
 @app.route('/download/latest-session')
 def download_latest_session():
-    """Download attendance report for the most recent QR session - triggers auto cleanup"""
+    """Download attendance report for the most recent QR session"""
     try:
         if not client:
             return jsonify({'error': 'Database not connected'}), 500
         
-        # AUTO-CLEANUP: Remove expired sessions when downloading latest
-        print("🗑️ Performing auto-cleanup during latest download...")
-        cleanup_expired_sessions_and_data()
-        
         # Find the most recent session that has attendance records
         latest_attendance = attendance_collection.find().sort("marked_at", -1).limit(1)
         latest_record = list(latest_attendance)
@@ -714,9 +3628,113 @@ def download_latest_session():
             'message': 'Failed to find latest session'
         }), 500
 
+def session_listing_pipeline(start_date, end_date, after=None, hide_empty=False, limit=SESSIONS_PAGE_SIZE):
+    """
+    One aggregation for a day's sessions with their attendees (newest first).
+    `after` is the (created_at, _id) keyset cursor of the previous page.
+    """
+    match = {"created_at": {"$gte": start_date, "$lt": end_date}}
+    if after:
+        created_at, session_id = after
+        match = {"$and": [match, {"$or": [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "_id": {"$lt": session_id}}
+        ]}]}
+
+    if hide_empty:
+        # Auto-rotated codes nobody scanned are noise on the dashboards. The session's
+        # own counter (or legacy used_by array) decides, so the $lookup sees one page only.
+        match = {"$and": [match, {"$or": [
+            {"auto_generated": {"$ne": True}},
+            {"used_by_count": {"$gt": 0}},
+            {"used_by.0": {"$exists": True}}
+        ]}]}
+
+    return [
+        {"$match": match},
+        {"$sort": {"created_at": -1, "_id": -1}},
+        # One extra row tells us whether there is a next page
+        {"$limit": limit + 1},
+        {"$project": {"qr_code": 1, "created_at": 1, "expires_at": 1, "auto_generated": 1}},
+        {"$lookup": {
+            "from": attendance_collection.name,
+            "localField": "_id",
+            "foreignField": "qr_session_id",
+            "pipeline": [
+                {"$sort": {"marked_at": 1}},
+                {"$project": {"_id": 0, "student_id": 1, "student_name": 1, "marked_at": 1}}
+            ],
+            "as": "attendees"
+        }},
+        {"$addFields": {"attendance_count": {"$size": "$attendees"}}},
+    ]
+
+def _parse_listing_args():
+    """(limit, after, hide_empty) from the query string; raises ValueError on bad input"""
+    limit = min(max(int(request.args.get('limit', SESSIONS_PAGE_SIZE)), 1), SESSIONS_MAX_PAGE_SIZE)
+    after = None
+    cursor = request.args.get('cursor')
+    if cursor:
+        created_at, _, session_id = cursor.rpartition('_')
+        if not ObjectId.is_valid(session_id):
+            raise ValueError(f"bad cursor {cursor!r}")
+        after = (datetime.fromisoformat(created_at), ObjectId(session_id))
+    hide_empty = request.args.get('hide_empty', '0') == '1'
+    return limit, after, hide_empty
+
+def stream_session_listing(start_date, end_date, header, attendees_key):
+    """Run the listing aggregation and stream the JSON response as the cursor is read"""
+    limit, after, hide_empty = _parse_listing_args()
+    # The first batch is fetched here, so database errors still become a 500
+    cursor = qr_sessions_collection.aggregate(
+        session_listing_pipeline(start_date, end_date, after, hide_empty, limit),
+        batchSize=100
+    )
+    day_rollup, _ = day_rollups(start_date)
+    total_sessions = day_rollup.get('sessions', 0)
+    total_attendees = day_rollup.get('attendance', 0)
+
+    def generate():
+        now = datetime.now()
+        returned = 0
+        last = None
+        yield json.dumps(header)[:-1] + (', ' if header else '') + '"sessions": ['
+        try:
+            for session in cursor:
+                if returned == limit:
+                    break
+                session_info = {
+                    'session_id': str(session['_id']),
+                    'qr_code': session['qr_code'],
+                    'created_at': session['created_at'].isoformat(),
+                    'expires_at': session['expires_at'].isoformat(),
+                    'is_expired': session['expires_at'] < now,
+                    'attendance_count': session['attendance_count'],
+                    'attendees': [{'student_id': a['student_id'], 'student_name': a['student_name'], 'marked_at': a['marked_at'].isoformat()} for a in session['attendees']],
+                    'download_url': f"/download/session/{str(session['_id'])}"
+                }
+                yield (',' if returned else '') + json.dumps(session_info)
+                returned += 1
+                last = session
+            else:
+                last = None
+        finally:
+            cursor.close()
+        yield '], ' + json.dumps({
+            'total_sessions': total_sessions,
+            attendees_key: total_attendees,
+            'returned': returned,
+            'next_cursor': f"{last['created_at'].isoformat()}_{last['_id']}" if last is not None else None
+        })[1:]
+
+    return Response(generate(), mimetype='application/json')
+
 @app.route('/sessions/active')
 def get_active_sessions():
-    """Get list of active QR sessions with attendance counts"""
+    """
+    Get today's QR sessions with attendance counts.
+    Query: limit, cursor (next_cursor of the previous page), hide_empty=1.
+    """
     try:
         if not client:
             return jsonify({'error': 'Database not connected'}), 500
@@ -725,40 +3743,10 @@ def get_active_sessions():
         today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
         today_end = today_start + timedelta(days=1)
         
-        sessions = list(qr_sessions_collection.find({
-            "created_at": {"$gte": today_start, "$lt": today_end}
-        }).sort("created_at", -1))
-        
-        session_data = []
-        for session in sessions:
-            # Count attendance for this session
-            attendance_count = attendance_collection.count_documents({
-                "qr_session_id": session['_id']
-            })
-            
-            # Get attendee list
-            attendees = list(attendance_collection.find({
-                "qr_session_id": session['_id']
-            }, {"student_id": 1, "student_name": 1, "marked_at": 1}))
-            
-            session_info = {
-                'session_id': str(session['_id']),
-                'qr_code': session['qr_code'],
-                'created_at': session['created_at'].isoformat(),
-                'expires_at': session['expires_at'].isoformat(),
-                'is_expired': session['expires_at'] < datetime.now(),
-                'attendance_count': attendance_count,
-                'attendees': [{'student_id': a['student_id'], 'student_name': a['student_name'], 'marked_at': a['marked_at'].isoformat()} for a in attendees],
-                'download_url': f"/download/session/{str(session['_id'])}"
-            }
-            session_data.append(session_info)
-        
-        return jsonify({
-            'sessions': session_data,
-            'total_sessions': len(session_data),
-            'total_attendees_today': sum(s['attendance_count'] for s in session_data)
-        })
+        return stream_session_listing(today_start, today_end, {}, 'total_attendees_today')
         
+    except ValueError as e:
+        return jsonify({'error': f'Invalid listing parameters: {e}'}), 400
     except Exception as e:
         print(f"❌ Error in get_active_sessions: {e}")
         return jsonify({
@@ -768,7 +3756,7 @@ def get_active_sessions():
 
 @app.route('/sessions/by-date/<date>')
 def get_sessions_by_date(date):
-    """Get sessions for a specific date"""
+    """Get sessions for a specific date (same paging options as /sessions/active)"""
     try:
         if not client:
             return jsonify({'error': 'Database not connected'}), 500
@@ -781,39 +3769,14 @@ def get_sessions_by_date(date):
         except ValueError:
             return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
         
-        sessions = list(qr_sessions_collection.find({
-            "created_at": {"$gte": start_date, "$lt": end_date}
-        }).sort("created_at", -1))
-        
-        session_data = []
-        for session in sessions:
-            attendance_count = attendance_collection.count_documents({
-                "qr_session_id": session['_id']
-            })
-            
-            attendees = list(attendance_collection.find({
-                "qr_session_id": session['_id']
-            }, {"student_id": 1, "student_name": 1, "marked_at": 1}))
-            
-            session_info = {
-                'session_id': str(session['_id']),
-                'qr_code': session['qr_code'],
-                'created_at': session['created_at'].isoformat(),
-                'expires_at': session['expires_at'].isoformat(),
-                'is_expired': session['expires_at'] < datetime.now(),
-                'attendance_count': attendance_count,
-                'attendees': [{'student_id': a['student_id'], 'student_name': a['student_name'], 'marked_at': a['marked_at'].isoformat()} for a in attendees],
-                'download_url': f"/download/session/{str(session['_id'])}"
-            }
-            session_data.append(session_info)
-        
-        return jsonify({
-            'date': date,
-            'sessions': session_data,
-            'total_sessions': len(session_data),
-            'total_attendees': sum(s['attendance_count'] for s in session_data)
-        })
+        build = lambda: stream_session_listing(start_date, end_date, {'date': date}, 'total_attendees')
+        # Only closed days are cached: is_expired still changes during the day
+        if end_date > datetime.now():
+            return build()
+        return cached_report(report_version(day=start_date), build)
         
+    except ValueError as e:
+        return jsonify({'error': f'Invalid listing parameters: {e}'}), 400
     except Exception as e:
         print(f"❌ Error in get_sessions_by_date: {e}")
         return jsonify({
@@ -830,20 +3793,14 @@ def get_session_stats():
         
         # Get today's stats
         today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        today_end = today_start + timedelta(days=1)
-        
-        today_sessions = qr_sessions_collection.count_documents({
-            "created_at": {"$gte": today_start, "$lt": today_end}
-        })
-        
-        today_attendance = attendance_collection.count_documents({
-            "session_date": today_start
-        })
         
-        # Get total stats
-        total_sessions = qr_sessions_collection.count_documents({})
-        total_attendance = attendance_collection.count_documents({})
-        total_students = students_collection.count_documents({})
+        # Precomputed counters, one round trip regardless of history size
+        today_rollup, total_rollup = day_rollups(today_start)
+        today_sessions = today_rollup.get('sessions', 0)
+        today_attendance = today_rollup.get('attendance', 0)
+        total_sessions = total_rollup.get('sessions', 0)
+        total_attendance = total_rollup.get('attendance', 0)
+        total_students = len(roster_cache)
         
         # Get active sessions
         active_sessions = qr_sessions_collection.count_documents({
@@ -875,40 +3832,49 @@ def get_session_stats():
 
 @app.route('/qr/status')
 def qr_status():
-    """Get current QR status and timing information"""
+    """Get current QR status and timing information (?channel= for a class channel)"""
     try:
         if not client:
             return jsonify({'error': 'Database not connected'}), 500
         
+        channel = request_channel()
+        if channel is None:
+            return unknown_channel_response()
         current_time = datetime.now()
+        generating = bool(qr_generation_thread and qr_generation_thread.is_alive() and channel.scheduled)
         
         # Get current active QR
         active_qr = qr_sessions_collection.find_one({
+            "channel": channel.key,
             "is_active": True,
             "expires_at": {"$gt": current_time}
-        }, sort=[("created_at", -1)])
+        }, {"qr_code": 1, "created_at": 1, "expires_at": 1, **USED_BY_COUNT_PROJECTION}, sort=[("created_at", -1)])
         
         if active_qr:
             time_remaining = (active_qr['expires_at'] - current_time).total_seconds()
-            next_refresh = QR_AUTO_REFRESH_INTERVAL - (time_remaining % QR_AUTO_REFRESH_INTERVAL)
+            next_refresh = channel.interval - (time_remaining % channel.interval)
             
             return jsonify({
                 'active': True,
+                'channel': channel.name,
                 'qr_code': active_qr['qr_code'],
                 'created_at': active_qr['created_at'].isoformat(),
                 'expires_at': active_qr['expires_at'].isoformat(),
                 'time_remaining': max(0, time_remaining),
                 'next_refresh_in': max(0, next_refresh),
-                'refresh_interval': QR_AUTO_REFRESH_INTERVAL,
-                'auto_generation_active': qr_generation_thread and qr_generation_thread.is_alive(),
-                'used_by_count': len(active_qr.get('used_by', []))
+                'refresh_interval': channel.interval,
+                'auto_generation_active': generating,
+                'in_class_hours': channel.in_class_hours(current_time),
+                'used_by_count': active_qr.get('used_by_count', 0)
             })
         else:
             return jsonify({
                 'active': False,
+                'channel': channel.name,
                 'message': 'No active QR code',
-                'auto_generation_active': qr_generation_thread and qr_generation_thread.is_alive(),
-                'refresh_interval': QR_AUTO_REFRESH_INTERVAL
+                'auto_generation_active': generating,
+                'in_class_hours': channel.in_class_hours(current_time),
+                'refresh_interval': channel.interval
             })
         
     except Exception as e:
@@ -917,6 +3883,53 @@ def qr_status():
             'message': 'Failed to get QR status'
         }), 500
 
+@app.route('/students/import', methods=['POST'])
+def import_students():
+    """
+    Bulk import a roster. Send multipart 'file' (.xlsx or .csv) or a raw body
+    with ?format=csv|xlsx. Optional: department, year (defaults), dry_run=1.
+    """
+    if not client:
+        return jsonify({'error': 'Database not connected'}), 500
+
+    upload = request.files.get('file')
+    if upload:
+        stream, filename = upload.stream, upload.filename or 'roster.xlsx'
+    else:
+        stream, filename = request.stream, f"roster.{request.args.get('format', 'xlsx')}"
+        if filename.endswith('.xlsx'):
+            # Zip archives need random access
+            stream = BytesIO(request.get_data())
+
+    defaults = {'department': request.values.get('department'), 'year': request.values.get('year')}
+    dry_run = request.values.get('dry_run', '0') == '1'
+    try:
+        report = import_roster(iter_roster_rows(stream, filename), defaults, dry_run)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"❌ Error in import_students: {e}")
+        return jsonify({'error': str(e), 'message': 'Failed to import roster'}), 500
+
+    print(f"📥 Roster import: {report['inserted']} inserted, {report['updated']} updated, {report['rejected']} rejected")
+    return jsonify({**report, 'dry_run': dry_run})
+
+@app.route('/janitor/status')
+def janitor_status():
+    """Janitor counters for this process plus the current lease holder"""
+    lease = leases_collection.find_one({"_id": "janitor"}) if client else None
+    return jsonify({
+        'worker_id': WORKER_ID,
+        'enabled': JANITOR_ENABLED,
+        'interval_seconds': JANITOR_INTERVAL_SECONDS,
+        'batch_size': JANITOR_BATCH_SIZE,
+        'time_budget_seconds': JANITOR_TIME_BUDGET_SECONDS,
+        'retention_via_ttl': RETENTION_VIA_TTL,
+        'leader': lease and lease.get('holder'),
+        'lease_expires_at': lease and lease['expires_at'].isoformat(),
+        'stats': janitor_stats
+    })
+
 # --- Faculty TOTP Setup and Verification ---
 
 # Example: In production, store these in your faculty user collection in MongoDB
@@ -927,19 +3940,7 @@ FACULTY_TOTP_SECRETS = {
 
 def generate_qr_image_from_uri(uri):
     """Generate a QR code image (base64 PNG) from a provisioning URI."""
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(uri)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    buffered = BytesIO()
-    img.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
-    return f"data:image/png;base64,{img_str}"
+    return generate_qr_image(uri, 'png')
 
 @app.route('/faculty/totp/setup', methods=['POST'])
 def faculty_totp_setup():
@@ -958,6 +3959,7 @@ def faculty_totp_setup():
         return jsonify({"error": "TOTP already set up for this user"}), 400
 
     # Generate and store secret
+    pyotp = lazy_import('pyotp')
     secret = pyotp.random_base32()
     faculty_collection.update_one(
         {"email": email},
@@ -992,7 +3994,7 @@ def faculty_totp_verify():
     if not faculty or "totp_secret" not in faculty:
         return jsonify({"valid": False, "message": "No TOTP secret found for this user"}), 404
 
-    totp = pyotp.TOTP(faculty["totp_secret"])
+    totp = lazy_import('pyotp').TOTP(faculty["totp_secret"])
     is_valid = totp.verify(code)
     return jsonify({"valid": is_valid})
 
@@ -1038,38 +4040,49 @@ def attendance_for_session(session_id):
 @app.route('/sessions/start', methods=['POST'])
 def start_new_session():
     """
-    Delete all attendance records and QR sessions, then create a new QR session.
+    Delete all attendance records and QR sessions, then create a new QR session
+    (in ?channel=, default channel otherwise).
     This should be called by faculty to start a new session.
     """
     if not client:
         return jsonify({'error': 'Database not connected'}), 500
+    channel = request_channel()
+    if channel is None:
+        return unknown_channel_response()
 
     # Delete all attendance records
     deleted_attendance = attendance_collection.delete_many({}).deleted_count
     # Delete all QR sessions
     deleted_sessions = qr_sessions_collection.delete_many({}).deleted_count
+    session_members_collection.delete_many({})
 
     # Create a new QR session
-    qr_data = generate_random_data()
-    qr_image = generate_qr_image(qr_data)
+    session_id, qr_data, qr_image = channel.prerenderer.next_code()
     now = datetime.now()
     new_session = {
+        "_id": session_id,
         "qr_code": qr_data,
         "created_at": now,
-        "expires_at": now + timedelta(seconds=QR_VALIDITY_SECONDS),
+        "expires_at": now + timedelta(seconds=channel.validity),
         "is_active": True,
-        "used_by": [],
+        **channel_fields(channel.name),
+        **initial_usage(),
         "session_name": f"ManualSession_{now.strftime('%H%M%S')}",
         "created_by": "FACULTY",
         "auto_generated": False,
         "qr_image": qr_image
     }
-    ins = qr_sessions_collection.insert_one(new_session)
-    new_session["_id"] = ins.inserted_id
+    # Nothing is left to count; rebuilding (rather than dropping) the rollups
+    # starts a new epoch so no cached report from before the wipe is served
+    rebuild_rollups()
+    qr_sessions_collection.insert_one(session_document(new_session))
+    _safe_rollup(record_session_rollup, new_session)
 
-    # Update global current_qr_session
-    global current_qr_session
-    current_qr_session = new_session
+    # Every channel's sessions are gone; only this one has a current session now
+    channel.current = new_session
+    for other in qr_channels.all():
+        other.cache.invalidate()
+    channel.cache.publish(new_session)
 
     print(f"🧹 Deleted {deleted_attendance} attendance and {deleted_sessions} sessions. Started new session {new_session['_id']}.")
 
@@ -1082,6 +4095,79 @@ def start_new_session():
             'qr_code': new_session["qr_code"],
             'expires_at': new_session["expires_at"].isoformat(),
             'created_at': new_session["created_at"].isoformat(),
-            'image': new_session.get("qr_image", "")
+            'image': new_session.get("qr_image", ""),
+            'image_url': f"/qr/{new_session['_id']}.{QR_IMAGE_FORMAT}"
         }
     })
+
+def start_database_services():
+    """Per-process work that needs the database; runs once it is connected"""
+    # Bring indexes up to date once per process (gunicorn workers, `python qr_api.py`)
+    if AUTO_MIGRATE:
+        migrate_database()
+    else:
+        detect_attendance_uniqueness()
+
+    if ATTENDANCE_WRITE_MODE == "journal":
+        try:
+            start_attendance_writer()
+        except Exception as e:
+            print(f"❌ Could not open attendance journal, writing synchronously: {e}")
+
+    try:
+        start_roster_cache()
+    except Exception as e:
+        print(f"❌ Could not load roster cache: {e}")
+
+    # Backfill rollups once for deployments that predate them
+    try:
+        backfill_rollups()
+    except Exception as e:
+        print(f"❌ Could not build rollups: {e}")
+
+    # Every worker runs the scheduler so any of them can take over the generator lease
+    if QR_LEADER_ELECTION:
+        start_qr_scheduler()
+
+    # Threads do not survive a fork, so this must run in each worker (no gunicorn --preload)
+    if JANITOR_ENABLED:
+        start_janitor()
+
+def bring_up_database(retry):
+    """Connect (retrying with backoff if asked), then start the database services and mark the worker ready"""
+    started = time.perf_counter()
+    delay = 1.0
+    while not connect_database():
+        database_attempted.set()
+        if not retry:
+            return
+        time.sleep(delay)
+        delay = min(delay * 2, DB_CONNECT_RETRY_MAX_SECONDS)
+    try:
+        start_database_services()
+    except Exception as e:
+        print(f"❌ Database startup failed: {e}")
+    startup_report["database_seconds"] = round(time.perf_counter() - started, 4)
+    startup_report["ready_after_seconds"] = round(time.perf_counter() - MODULE_LOAD_STARTED, 4)
+    database_ready.set()
+    database_attempted.set()
+    print(f"✅ Ready {startup_report['ready_after_seconds']:.2f}s after start "
+          f"(database {startup_report['database_seconds']:.2f}s)")
+
+def require_database():
+    """For CLI commands: wait for the connection started at import, or fail"""
+    database_attempted.wait()
+    if not database_ready.is_set():
+        raise click.ClickException(f"Database not connected: {database_error}")
+
+if DEFER_DB_CONNECT:
+    threading.Thread(target=bring_up_database, args=(True,), daemon=True, name="db-connect").start()
+else:
+    bring_up_database(retry=False)
+
+startup_report["module_seconds"] = round(time.perf_counter() - MODULE_LOAD_STARTED, 4)
+startup_report["preloaded_heavy_modules"] = [name for name in HEAVY_MODULES if name in sys.modules]
+print(f"⏱️ Startup: imports {startup_report['imports_seconds']:.2f}s, module {startup_report['module_seconds']:.2f}s"
+      + (f", connecting to {STORAGE_BACKEND} in the background" if not database_ready.is_set() else ""))
+if startup_report["preloaded_heavy_modules"]:
+    print(f"⚠️ Imported at startup: {', '.join(startup_report['preloaded_heavy_modules'])}")
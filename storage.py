@@ -0,0 +1,1214 @@
+"""
+Embedded document storage for single-node deployments, tests and benchmarks.
+
+Implements the part of the pymongo Collection API that qr_api.py uses (find,
+updates with upsert, bulk writes, the aggregation stages of its reports,
+indexes, explain) on SQLite, so STORAGE_BACKEND=sqlite or memory runs the app
+without a MongoDB server:
+
+  connect("sqlite", "attendance.sqlite3")   # one WAL-mode file, any number of workers
+  connect("memory")                         # private to this process, gone on exit
+
+Each collection is a table of JSON documents. index_specs() becomes SQLite
+expression indexes over json_extract(), unique ones included. Filters are
+pushed down to SQL as far as those indexes can serve them and every row is
+re-checked in Python, so results follow MongoDB's matching rules for the
+operators implemented here. Equality on array fields (matching one element)
+is only honoured when the filter cannot be pushed down; this module never
+queries arrays that way. Change streams are not available: watch() raises
+OperationFailure like a standalone mongod, and callers fall back to polling.
+"""
+import base64
+import copy
+import itertools
+import json
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError, InvalidOperation, OperationFailure, WriteError
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+# How often expired documents are removed from collections with a TTL index (MongoDB's default)
+TTL_MONITOR_INTERVAL_SECONDS = 60
+# Rows read from SQLite per fetch while a cursor is iterated
+FETCH_SIZE = 256
+
+_FIELD_PATTERN = re.compile(r"^[A-Za-z0-9_]+(\.[A-Za-z0-9_]+)*$")
+_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_.\-]+$")
+_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+_MISSING = object()
+
+
+def connect(backend, path=None):
+    """A Client for STORAGE_BACKEND "sqlite" (a file at path) or "memory" """
+    if backend == "sqlite":
+        return Client(path or "attendance.sqlite3")
+    if backend == "memory":
+        return Client(":memory:")
+    raise ValueError(f"Unknown storage backend {backend!r} (expected mongodb, sqlite or memory)")
+
+
+# --- Documents <-> JSON ---
+
+def _encode(value):
+    """JSON form of the BSON types documents hold; the text of a date sorts like the date"""
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        # Milliseconds, like a BSON date
+        return {"$date": f"{value.strftime(_DATE_FORMAT)}.{value.microsecond // 1000:03d}"}
+    if isinstance(value, ObjectId):
+        return {"$oid": str(value)}
+    if isinstance(value, (bytes, bytearray)):
+        return {"$binary": base64.b64encode(bytes(value)).decode()}
+    if isinstance(value, (tuple, set)):
+        return list(value)
+    raise TypeError(f"cannot store a {type(value).__name__}")
+
+
+def _decode(obj):
+    if len(obj) == 1:
+        if "$date" in obj:
+            return datetime.strptime(obj["$date"], _DATE_FORMAT + ".%f")
+        if "$oid" in obj:
+            return ObjectId(obj["$oid"])
+        if "$binary" in obj:
+            return base64.b64decode(obj["$binary"])
+    return obj
+
+
+def _dumps(value):
+    return json.dumps(value, default=_encode, separators=(",", ":"))
+
+
+def _loads(text):
+    return json.loads(text, object_hook=_decode)
+
+
+# --- Ordering and equality (BSON comparison order) ---
+
+def _type_rank(value):
+    if value is None or value is _MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, (bytes, bytearray)):
+        return 6
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime):
+        return 9
+    return 10
+
+
+def _sort_key(value):
+    """Hashable key ordering values the way MongoDB does"""
+    rank = _type_rank(value)
+    if rank == 1:
+        return (1, 0)
+    if rank == 4:
+        return (4, tuple((k, _sort_key(v)) for k, v in value.items()))
+    if rank == 5:
+        return (5, tuple(_sort_key(v) for v in value))
+    if rank == 7:
+        return (7, value.binary)
+    if rank == 9 and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (rank, value)
+
+
+def _compare(a, b):
+    ka, kb = _sort_key(a), _sort_key(b)
+    return (ka > kb) - (ka < kb)
+
+
+def _equal(a, b):
+    return _sort_key(a) == _sort_key(b)
+
+
+def _truthy(value):
+    """Aggregation truthiness: null, missing, false and 0 are false, everything else (even "" and []) true"""
+    if value is None or value is _MISSING or value is False:
+        return False
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value != 0
+    return True
+
+
+# --- Paths ---
+
+def _get(value, path):
+    """Value at a dotted path; arrays of documents map to arrays of values. _MISSING if absent."""
+    parts = path.split(".")
+    for i, part in enumerate(parts):
+        if isinstance(value, dict):
+            value = value.get(part, _MISSING)
+        elif isinstance(value, list):
+            if part.isdigit():
+                index = int(part)
+                value = value[index] if index < len(value) else _MISSING
+            else:
+                rest = ".".join(parts[i:])
+                return [v for v in (_get(item, rest) for item in value if isinstance(item, dict)) if v is not _MISSING]
+        else:
+            return _MISSING
+        if value is _MISSING:
+            return _MISSING
+    return value
+
+
+def _candidates(doc, path):
+    """Every value a query on path compares against: the value and, for arrays, their elements"""
+    values = [doc]
+    for part in path.split("."):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit() and int(part) < len(value):
+                    found.append(value[int(part)])
+                found.extend(item[part] for item in value if isinstance(item, dict) and part in item)
+        values = found
+    expanded = list(values)
+    for value in values:
+        if isinstance(value, list):
+            expanded.extend(value)
+    return expanded
+
+
+def _set_path(doc, path, value):
+    *parents, last = path.split(".")
+    for part in parents:
+        child = doc.get(part)
+        if not isinstance(child, dict):
+            child = doc[part] = {}
+        doc = child
+    doc[last] = value
+
+
+def _unset_path(doc, path):
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(last, None)
+
+
+# --- Query matching ---
+
+def _is_operator_dict(value):
+    return isinstance(value, dict) and bool(value) and all(k.startswith("$") for k in value)
+
+
+def _matches(doc, query, variables=None):
+    for key, condition in query.items():
+        if key == "$and":
+            ok = all(_matches(doc, q, variables) for q in condition)
+        elif key == "$or":
+            ok = any(_matches(doc, q, variables) for q in condition)
+        elif key == "$nor":
+            ok = not any(_matches(doc, q, variables) for q in condition)
+        elif key == "$expr":
+            ok = _truthy(_evaluate(condition, doc, variables))
+        elif key.startswith("$"):
+            raise OperationFailure(f"unknown top level operator: {key}", code=2)
+        elif _is_operator_dict(condition):
+            values = _candidates(doc, key)
+            ok = all(_match_operator(values, op, arg) for op, arg in condition.items())
+        else:
+            ok = _equals_any(_candidates(doc, key), condition)
+        if not ok:
+            return False
+    return True
+
+
+def _equals_any(values, target):
+    if target is None and not values:
+        return True
+    return any(_equal(value, target) for value in values)
+
+
+def _match_operator(values, op, arg):
+    if op == "$eq":
+        return _equals_any(values, arg)
+    if op == "$ne":
+        return not _equals_any(values, arg)
+    if op == "$in":
+        return any(_equals_any(values, target) for target in arg)
+    if op == "$nin":
+        return not any(_equals_any(values, target) for target in arg)
+    if op in ("$gt", "$gte", "$lt", "$lte"):
+        if arg is None and op in ("$gte", "$lte") and not values:
+            return True
+        # Only values of the same type compare (a date is never $gt a number)
+        return any(
+            _COMPARISONS[op](_compare(value, arg), 0)
+            for value in values if _type_rank(value) == _type_rank(arg)
+        )
+    if op == "$exists":
+        return bool(values) == bool(arg)
+    if op == "$not":
+        return not all(_match_operator(values, inner, inner_arg) for inner, inner_arg in arg.items())
+    if op == "$size":
+        return any(isinstance(value, list) and len(value) == arg for value in values)
+    raise OperationFailure(f"unknown operator: {op}", code=2)
+
+
+_COMPARISONS = {
+    "$eq": lambda c, _: c == 0,
+    "$ne": lambda c, _: c != 0,
+    "$gt": lambda c, _: c > 0,
+    "$gte": lambda c, _: c >= 0,
+    "$lt": lambda c, _: c < 0,
+    "$lte": lambda c, _: c <= 0,
+}
+
+
+# --- Filters pushed down to SQL ---
+
+_SQL_OPERATORS = {"$eq": "=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+
+def _key_sql(field):
+    """
+    The SQL value of a field, as indexes store it. Null and missing become -Inf:
+    one key for the unique indexes (as in MongoDB), sorted before any value.
+    """
+    return f"ifnull(json_extract(doc, '$.{field}'), -1e999)"
+
+
+def _sql_value(value):
+    """The parameter comparing equal to _key_sql() of value, or _MISSING if there is none"""
+    if value is None:
+        return float("-inf")
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float, str)):
+        return value
+    if isinstance(value, (datetime, ObjectId)):
+        # json_extract() returns nested objects as minified JSON text
+        return _dumps(value)
+    return _MISSING
+
+
+def _sql_filter(query):
+    """(where, params) selecting a superset of the documents matching query; where is '' if nothing narrows it"""
+    clauses, params = [], []
+    for field, condition in query.items():
+        if field == "$and":
+            for sub in condition:
+                where, sub_params = _sql_filter(sub)
+                if where:
+                    clauses.append(where)
+                    params += sub_params
+        elif field == "$or":
+            parts = [_sql_filter(sub) for sub in condition]
+            if parts and all(where for where, _ in parts):
+                clauses.append("(" + " OR ".join(f"({where})" for where, _ in parts) + ")")
+                for _, sub_params in parts:
+                    params += sub_params
+        elif not field.startswith("$") and _FIELD_PATTERN.match(field):
+            operators = condition if _is_operator_dict(condition) else {"$eq": condition}
+            for op, arg in operators.items():
+                if op in _SQL_OPERATORS and _sql_value(arg) is not _MISSING:
+                    clauses.append(f"{_key_sql(field)} {_SQL_OPERATORS[op]} ?")
+                    params.append(_sql_value(arg))
+                elif op == "$in" and all(_sql_value(v) is not _MISSING for v in arg):
+                    clauses.append(f"{_key_sql(field)} IN ({', '.join('?' * len(arg))})")
+                    params += [_sql_value(v) for v in arg]
+    return " AND ".join(clauses), params
+
+
+def _sql_order(sort):
+    """ORDER BY for a sort specification, or None if SQLite cannot order by it"""
+    if not sort or not all(_FIELD_PATTERN.match(field) for field, _ in sort):
+        return None
+    return ", ".join(f"{_key_sql(field)} {'DESC' if direction < 0 else 'ASC'}" for field, direction in sort)
+
+
+def _normalise_sort(sort, direction=None):
+    if sort is None:
+        return None
+    if isinstance(sort, str):
+        return [(sort, direction or 1)]
+    if isinstance(sort, dict):
+        return list(sort.items())
+    return [(field, d) for field, d in sort]
+
+
+# --- Aggregation expressions ---
+
+def _evaluate(expr, doc, variables=None):
+    if isinstance(expr, str) and expr.startswith("$$"):
+        name, _, path = expr[2:].partition(".")
+        value = doc if name in ("ROOT", "CURRENT") else (variables or {}).get(name, _MISSING)
+        return _get(value, path) if path else value
+    if isinstance(expr, str) and expr.startswith("$"):
+        return _get(doc, expr[1:])
+    if isinstance(expr, list):
+        return [_value(_evaluate(e, doc, variables)) for e in expr]
+    if isinstance(expr, dict):
+        if len(expr) == 1 and next(iter(expr)).startswith("$"):
+            op, args = next(iter(expr.items()))
+            return _expression_operator(op, args, doc, variables)
+        evaluated = {k: _evaluate(v, doc, variables) for k, v in expr.items()}
+        return {k: v for k, v in evaluated.items() if v is not _MISSING}
+    return expr
+
+
+def _value(value):
+    return None if value is _MISSING else value
+
+
+def _expression_operator(op, args, doc, variables):
+    if op == "$literal":
+        return args
+    if op == "$dateToString":
+        date = _value(_evaluate(args["date"], doc, variables))
+        if date is None:
+            return _value(_evaluate(args.get("onNull"), doc, variables))
+        fmt = args.get("format", "%Y-%m-%dT%H:%M:%S.%LZ").replace("%L", f"{date.microsecond // 1000:03d}")
+        return date.strftime(fmt)
+    if op == "$cond" and isinstance(args, dict):
+        args = [args["if"], args["then"], args["else"]]
+    if op == "$cond":
+        condition = _truthy(_evaluate(args[0], doc, variables))
+        return _value(_evaluate(args[1] if condition else args[2], doc, variables))
+
+    values = [_value(_evaluate(a, doc, variables)) for a in (args if isinstance(args, list) else [args])]
+    if op == "$ifNull":
+        return next((v for v in values[:-1] if v is not None), values[-1])
+    if op == "$size":
+        if not isinstance(values[0], list):
+            raise OperationFailure("The argument to $size must be an array", code=17124)
+        return len(values[0])
+    if op in _COMPARISONS:
+        return _COMPARISONS[op](_compare(values[0], values[1]), 0)
+    if op == "$cmp":
+        return _compare(values[0], values[1])
+    if op == "$and":
+        return all(_truthy(v) for v in values)
+    if op == "$or":
+        return any(_truthy(v) for v in values)
+    if op == "$not":
+        return not _truthy(values[0])
+    if op == "$in":
+        return any(_equal(values[0], v) for v in values[1])
+    if op == "$add":
+        dates = [v for v in values if isinstance(v, datetime)]
+        total = sum(v for v in values if not isinstance(v, datetime) and v is not None)
+        return dates[0] + timedelta(milliseconds=total) if dates else total
+    if op == "$subtract":
+        a, b = values
+        if isinstance(a, datetime) and isinstance(b, datetime):
+            return int((a - b).total_seconds() * 1000)
+        if isinstance(a, datetime):
+            return a - timedelta(milliseconds=b)
+        return a - b
+    raise OperationFailure(f"Unrecognized expression '{op}'", code=168)
+
+
+def _included(spec):
+    return spec is True or isinstance(spec, (int, float)) and not isinstance(spec, bool) and spec != 0
+
+
+def _excluded(spec):
+    return spec is False or isinstance(spec, (int, float)) and not isinstance(spec, bool) and spec == 0
+
+
+def _project(doc, projection, variables=None):
+    """Apply a find() projection or a $project stage (inclusion, exclusion or computed fields)"""
+    if not projection:
+        return doc
+    fields = {k: v for k, v in projection.items() if k != "_id"}
+    id_spec = projection.get("_id", True)
+    if all(_excluded(spec) for spec in fields.values()) and (fields or _excluded(id_spec)):
+        out = copy.copy(doc)
+        for field in fields:
+            _unset_path(out, field)
+        if _excluded(id_spec):
+            out.pop("_id", None)
+        return out
+
+    out = {}
+    if _included(id_spec):
+        if "_id" in doc:
+            out["_id"] = doc["_id"]
+    elif not _excluded(id_spec):
+        out["_id"] = _value(_evaluate(id_spec, doc, variables))
+    for field, spec in fields.items():
+        value = _get(doc, field) if _included(spec) else _evaluate(spec, doc, variables)
+        if value is not _MISSING:
+            _set_path(out, field, value)
+    return out
+
+
+# --- Aggregation stages ---
+
+def _sorted(docs, sort):
+    docs = list(docs)
+    for field, direction in reversed(sort):
+        docs.sort(key=lambda d: _sort_key(_get(d, field)), reverse=direction < 0)
+    return docs
+
+
+def _group(docs, spec, variables):
+    groups = {}
+    for doc in docs:
+        key = _value(_evaluate(spec["_id"], doc, variables))
+        group = groups.get(_sort_key(key))
+        if group is None:
+            group = groups[_sort_key(key)] = {"_id": key}
+        for field, accumulator in spec.items():
+            if field == "_id":
+                continue
+            (op, arg), = accumulator.items()
+            value = _evaluate(arg, doc, variables)
+            if op == "$sum":
+                total = group.get(field, 0)
+                group[field] = total + value if isinstance(value, (int, float)) and not isinstance(value, bool) else total
+            elif op == "$count":
+                group[field] = group.get(field, 0) + 1
+            elif op == "$avg":
+                total, n = group.get(field, (0, 0))
+                group[field] = (total + value, n + 1) if isinstance(value, (int, float)) else (total, n)
+            elif op == "$push":
+                group.setdefault(field, [])
+                if value is not _MISSING:
+                    group[field].append(value)
+            elif op == "$addToSet":
+                items = group.setdefault(field, [])
+                if value is not _MISSING and not any(_equal(value, item) for item in items):
+                    items.append(value)
+            elif op == "$first":
+                group.setdefault(field, _value(value))
+            elif op == "$last":
+                group[field] = _value(value)
+            elif op in ("$min", "$max"):
+                current = group.get(field)
+                if value not in (None, _MISSING) and (
+                        current is None or (_compare(value, current) < 0) == (op == "$min")):
+                    group[field] = value
+                group.setdefault(field, None)
+            else:
+                raise OperationFailure(f"unknown group operator '{op}'", code=15952)
+    for group in groups.values():
+        for field, accumulator in spec.items():
+            if field != "_id" and "$avg" in accumulator:
+                total, n = group[field]
+                group[field] = total / n if n else None
+        yield group
+
+
+def _unwind(docs, spec):
+    path = spec if isinstance(spec, str) else spec["path"]
+    keep_empty = isinstance(spec, dict) and spec.get("preserveNullAndEmptyArrays", False)
+    field = path[1:]
+    for doc in docs:
+        value = _get(doc, field)
+        if isinstance(value, list) and value:
+            for item in value:
+                out = copy.copy(doc)
+                _set_path(out, field, item)
+                yield out
+        elif isinstance(value, list) or value in (None, _MISSING):
+            if keep_empty:
+                yield doc
+        else:
+            yield doc
+
+
+def _lookup(collection, docs, spec, variables):
+    foreign = collection.database[spec["from"]]
+    for doc in docs:
+        inner_variables = {**(variables or {}),
+                           **{k: _value(_evaluate(v, doc, variables)) for k, v in spec.get("let", {}).items()}}
+        pipeline = list(spec.get("pipeline", []))
+        if "localField" in spec:
+            local = _value(_get(doc, spec["localField"]))
+            match = {spec["foreignField"]: {"$in": local} if isinstance(local, list) else local}
+            if pipeline and "$match" in pipeline[0]:
+                match = {"$and": [match, pipeline.pop(0)["$match"]]}
+            pipeline.insert(0, {"$match": match})
+        out = copy.copy(doc)
+        out[spec["as"]] = list(_run_pipeline(foreign, pipeline, inner_variables))
+        yield out
+
+
+def _run_pipeline(collection, pipeline, variables=None):
+    """Evaluate an aggregation pipeline lazily; a leading $match/$sort runs in SQLite"""
+    stages = list(pipeline)
+    query, sort = {}, None
+    if stages and "$match" in stages[0]:
+        query = stages.pop(0)["$match"]
+    if stages and "$sort" in stages[0] and _sql_order(list(stages[0]["$sort"].items())):
+        sort = list(stages.pop(0)["$sort"].items())
+    docs = (doc for _, doc in collection._scan(query, sort, variables))
+    for stage in stages:
+        (name, spec), = stage.items()
+        docs = _stage(collection, docs, name, spec, variables)
+    return docs
+
+
+def _stage(collection, docs, name, spec, variables):
+    if name == "$match":
+        return (doc for doc in docs if _matches(doc, spec, variables))
+    if name == "$sort":
+        return iter(_sorted(docs, list(spec.items())))
+    if name == "$limit":
+        return itertools.islice(docs, spec)
+    if name == "$skip":
+        return itertools.islice(docs, spec, None)
+    if name == "$project":
+        return (_project(doc, spec, variables) for doc in docs)
+    if name in ("$addFields", "$set"):
+        return ({**doc, **_evaluate(spec, doc, variables)} for doc in docs)
+    if name == "$unset":
+        fields = [spec] if isinstance(spec, str) else spec
+        return ({k: v for k, v in doc.items() if k not in fields} for doc in docs)
+    if name == "$group":
+        return _group(docs, spec, variables)
+    if name == "$lookup":
+        return _lookup(collection, docs, spec, variables)
+    if name == "$unwind":
+        return _unwind(docs, spec)
+    if name == "$count":
+        return iter([{spec: sum(1 for _ in docs)}])
+    raise OperationFailure(f"Unrecognized pipeline stage name: '{name}'", code=40324)
+
+
+# --- Updates ---
+
+def _upsert_seed(query):
+    """The document an upsert starts from: the filter's equality conditions"""
+    doc = {}
+    for field, condition in query.items():
+        if field == "$and":
+            for sub in condition:
+                for k, v in _upsert_seed(sub).items():
+                    doc[k] = v
+        elif field.startswith("$"):
+            continue
+        elif _is_operator_dict(condition):
+            if "$eq" in condition:
+                _set_path(doc, field, copy.deepcopy(condition["$eq"]))
+        else:
+            _set_path(doc, field, copy.deepcopy(condition))
+    return doc
+
+
+def _apply_update(doc, update, inserting):
+    if not update or not all(op.startswith("$") for op in update):
+        raise ValueError("update only works with $ operators")
+    new = copy.deepcopy(doc)
+    for op, fields in update.items():
+        if op == "$setOnInsert" and not inserting:
+            continue
+        for path, value in fields.items():
+            if op in ("$set", "$setOnInsert"):
+                _set_path(new, path, copy.deepcopy(value))
+            elif op == "$unset":
+                _unset_path(new, path)
+            elif op == "$inc":
+                current = _get(new, path)
+                current = 0 if current is _MISSING else current
+                if not isinstance(current, (int, float)) or isinstance(current, bool):
+                    raise WriteError(f"Cannot apply $inc to a value of non-numeric type ({path})", 14)
+                _set_path(new, path, current + value)
+            elif op in ("$max", "$min"):
+                current = _get(new, path)
+                if current is _MISSING or (_compare(value, current) > 0) == (op == "$max") and _compare(value, current) != 0:
+                    _set_path(new, path, copy.deepcopy(value))
+            elif op in ("$addToSet", "$push"):
+                items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                current = _get(new, path)
+                current = [] if current is _MISSING else current
+                if not isinstance(current, list):
+                    raise WriteError(f"Cannot apply {op} to a non-array field ({path})", 2)
+                for item in items:
+                    if op == "$push" or not any(_equal(item, existing) for existing in current):
+                        current.append(copy.deepcopy(item))
+                _set_path(new, path, current)
+            else:
+                raise WriteError(f"Unknown modifier: {op}", 9)
+    return new
+
+
+# --- Cursors ---
+
+class Cursor:
+    """find() results, read lazily; sort/limit/skip chain like pymongo's"""
+
+    def __init__(self, collection, query, projection=None, sort=None, limit=0, skip=0):
+        self.collection = collection
+        self._query = query
+        self._projection = projection
+        self._sort = sort
+        self._limit = limit
+        self._skip = skip
+        self._docs = None
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = _normalise_sort(key_or_list, direction)
+        return self
+
+    def limit(self, limit):
+        self._limit = abs(limit)
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def _generate(self):
+        docs = (doc for _, doc in self.collection._scan(self._query, self._sort))
+        end = self._skip + self._limit if self._limit else None
+        for doc in itertools.islice(docs, self._skip, end):
+            yield _project(doc, self._projection)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._docs is None:
+            self._docs = self._generate()
+        return next(self._docs)
+
+    def close(self):
+        if self._docs is not None:
+            self._docs.close()
+
+    def explain(self):
+        return self.collection._explain(self._query, self._sort)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CommandCursor:
+    """aggregate() results; like MongoDB, the first batch is computed before aggregate() returns"""
+
+    def __init__(self, docs, batch_size=101):
+        self._docs = docs
+        self._first = list(itertools.islice(docs, batch_size))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._first:
+            return self._first.pop(0)
+        return next(self._docs)
+
+    def close(self):
+        self._first = []
+        close = getattr(self._docs, "close", None)
+        if close:
+            close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# --- Collections ---
+
+class Collection:
+    def __init__(self, database, name):
+        if not _NAME_PATTERN.match(name):
+            raise ValueError(f"invalid collection name {name!r}")
+        self.database = database
+        self.name = name
+        self.full_name = f"{database.name}.{name}"
+        self._table = f'"{name}"'
+        database._create_table(name)
+
+    def __repr__(self):
+        return f"Collection({self.database!r}, {self.name!r})"
+
+    # Reads
+
+    def _select(self, query, sort=None):
+        """SQL and parameters for the rows that may match query, in sort order where SQLite can sort"""
+        where, params = _sql_filter(query)
+        order = _sql_order(sort)
+        sql = f"SELECT rowid, doc FROM {self._table}" + (f" WHERE {where}" if where else "")
+        return sql + (f" ORDER BY {order}" if order else ""), params, order is not None or not sort
+
+    def _scan(self, query, sort=None, variables=None):
+        """(rowid, document) for every match, in sort order"""
+        # Round trip the filter so its dates have BSON (millisecond) precision
+        query = _loads(_dumps(query or {}))
+        sql, params, ordered = self._select(query, sort)
+        rows = ((rowid, _loads(text)) for rowid, text in self.database._iterate(sql, params))
+        rows = ((rowid, doc) for rowid, doc in rows if _matches(doc, query, variables))
+        if not ordered:
+            # Still a generator, so callers can close() whichever they get
+            rows = (row for row in _sorted_rows(list(rows), sort))
+        return rows
+
+    def find(self, filter=None, projection=None, skip=0, limit=0, sort=None, **kwargs):
+        return Cursor(self, _id_filter(filter), projection, _normalise_sort(sort), limit, skip)
+
+    def find_one(self, filter=None, projection=None, *args, sort=None, **kwargs):
+        cursor = self.find(filter, projection, sort=sort, limit=1)
+        try:
+            return next(cursor, None)
+        finally:
+            cursor.close()
+
+    def count_documents(self, filter, **kwargs):
+        if not filter:
+            return self.estimated_document_count()
+        return sum(1 for _ in self._scan(filter))
+
+    def estimated_document_count(self, **kwargs):
+        return next(self.database._iterate(f"SELECT count(*) FROM {self._table}"))[0]
+
+    def aggregate(self, pipeline, **kwargs):
+        return CommandCursor(_run_pipeline(self, pipeline), kwargs.get("batchSize") or 101)
+
+    def watch(self, *args, **kwargs):
+        raise OperationFailure("The $changeStream stage is only supported on replica sets", code=40573)
+
+    def _explain(self, query, sort):
+        sql, params, _ = self._select(_loads(_dumps(query or {})), sort)
+        details = [row[3] for row in self.database._iterate(f"EXPLAIN QUERY PLAN {sql}", params)]
+        stages = []
+        for detail in details:
+            index = re.search(r"USING (?:COVERING )?INDEX (\S+)", detail)
+            if index:
+                stages.append({"stage": "IXSCAN", "indexName": index.group(1).split("/", 1)[-1]})
+            elif detail.startswith("SCAN"):
+                stages.append({"stage": "COLLSCAN"})
+            elif "TEMP B-TREE" in detail:
+                stages.append({"stage": "SORT"})
+        return {"queryPlanner": {"winningPlan": {"stage": "FETCH", "inputStages": stages}, "sqlite": details}}
+
+    # Writes
+
+    def _duplicate(self, error, doc):
+        message = f"E11000 duplicate key error collection: {self.full_name} ({error})"
+        return DuplicateKeyError(message, 11000, {"code": 11000, "errmsg": message, "keyValue": {"_id": doc.get("_id")}})
+
+    def _insert(self, connection, doc):
+        if "_id" not in doc:
+            # Like pymongo, the caller's document gets its _id
+            doc["_id"] = ObjectId()
+        try:
+            connection.execute(f"INSERT INTO {self._table} (doc) VALUES (?)", (_dumps(doc),))
+        except sqlite3.IntegrityError as e:
+            raise self._duplicate(e, doc)
+
+    def _replace(self, connection, rowid, doc):
+        try:
+            connection.execute(f"UPDATE {self._table} SET doc = ? WHERE rowid = ?", (_dumps(doc), rowid))
+        except sqlite3.IntegrityError as e:
+            raise self._duplicate(e, doc)
+
+    def _update(self, connection, query, update, upsert=False, multi=False, sort=None):
+        """Apply update to the first (or every) match, or upsert. Returns (matched, modified, upserted_id, before, after)."""
+        query = _id_filter(query)
+        scan = self._scan(query, sort)
+        rows = list(scan) if multi else list(itertools.islice(scan, 1))
+        scan.close()
+        matched = modified = 0
+        before = after = None
+        for rowid, doc in rows:
+            new = _apply_update(doc, update, inserting=False)
+            if not _equal(new.get("_id"), doc.get("_id")):
+                raise WriteError("Performing an update on the path '_id' would modify the immutable field '_id'", 66)
+            matched += 1
+            if _dumps(new) != _dumps(doc):
+                self._replace(connection, rowid, new)
+                modified += 1
+            if before is None:
+                before, after = doc, new
+        if matched or not upsert:
+            return matched, modified, None, before, after
+        seed = _upsert_seed(query)
+        new = _apply_update(seed, update, inserting=True)
+        new = {"_id": new.pop("_id", None) or ObjectId(), **new}
+        self._insert(connection, new)
+        return 0, 0, new["_id"], None, new
+
+    def _replace_one(self, connection, query, replacement, upsert=False):
+        """Replace the first match, or upsert. Returns (matched, modified, upserted_id)."""
+        if any(key.startswith("$") for key in replacement):
+            raise ValueError("replacement can not include $ operators")
+        query = _id_filter(query)
+        scan = self._scan(query)
+        rows = list(itertools.islice(scan, 1))
+        scan.close()
+        if rows:
+            rowid, doc = rows[0]
+            if "_id" in replacement and not _equal(replacement["_id"], doc["_id"]):
+                raise WriteError("After applying the update, the (immutable) field '_id' was found to have been altered", 66)
+            new = {"_id": doc["_id"], **{k: copy.deepcopy(v) for k, v in replacement.items() if k != "_id"}}
+            if _dumps(new) == _dumps(doc):
+                return 1, 0, None
+            self._replace(connection, rowid, new)
+            return 1, 1, None
+        if not upsert:
+            return 0, 0, None
+        seed = _upsert_seed(query)
+        new = {"_id": replacement.get("_id", seed.get("_id")) or ObjectId(),
+               **{k: copy.deepcopy(v) for k, v in replacement.items() if k != "_id"}}
+        self._insert(connection, new)
+        return 0, 0, new["_id"]
+
+    def insert_one(self, document, **kwargs):
+        with self.database._transaction() as connection:
+            self._insert(connection, document)
+        return InsertOneResult(document["_id"], True)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        documents = list(documents)
+        if not documents:
+            raise TypeError("documents must be a non-empty list")
+        details = _bulk_details()
+        inserted_ids = []
+        with self.database._transaction() as connection:
+            for index, document in enumerate(documents):
+                try:
+                    self._insert(connection, document)
+                except WriteError as e:
+                    details["writeErrors"].append({"index": index, "code": e.code, "errmsg": str(e), "op": document})
+                    if ordered:
+                        break
+                    continue
+                inserted_ids.append(document["_id"])
+                details["nInserted"] += 1
+        if details["writeErrors"]:
+            raise BulkWriteError(details)
+        return InsertManyResult(inserted_ids, True)
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        with self.database._transaction() as connection:
+            matched, modified, upserted_id, _, _ = self._update(connection, filter, update, upsert)
+        return UpdateResult(_update_raw(matched, modified, upserted_id), True)
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        with self.database._transaction() as connection:
+            matched, modified, upserted_id, _, _ = self._update(connection, filter, update, upsert, multi=True)
+        return UpdateResult(_update_raw(matched, modified, upserted_id), True)
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        with self.database._transaction() as connection:
+            matched, modified, upserted_id = self._replace_one(connection, filter, replacement, upsert)
+        return UpdateResult(_update_raw(matched, modified, upserted_id), True)
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False,
+                            return_document=False, **kwargs):
+        with self.database._transaction() as connection:
+            _, _, _, before, after = self._update(connection, filter, update, upsert, sort=_normalise_sort(sort))
+        doc = after if return_document else before
+        return _project(doc, projection) if doc is not None else None
+
+    def _delete(self, connection, query, multi):
+        scan = self._scan(_id_filter(query))
+        rowids = [rowid for rowid, _ in (scan if multi else itertools.islice(scan, 1))]
+        scan.close()
+        for start in range(0, len(rowids), 500):
+            chunk = rowids[start:start + 500]
+            connection.execute(f"DELETE FROM {self._table} WHERE rowid IN ({', '.join('?' * len(chunk))})", chunk)
+        return len(rowids)
+
+    def delete_one(self, filter, **kwargs):
+        with self.database._transaction() as connection:
+            return DeleteResult({"n": self._delete(connection, filter, multi=False)}, True)
+
+    def delete_many(self, filter, **kwargs):
+        with self.database._transaction() as connection:
+            return DeleteResult({"n": self._delete(connection, filter, multi=True)}, True)
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        requests = list(requests)
+        if not requests:
+            raise InvalidOperation("No operations to execute")
+        details = _bulk_details()
+        with self.database._transaction() as connection:
+            for index, request in enumerate(requests):
+                kind = type(request).__name__
+                try:
+                    if kind == "InsertOne":
+                        self._insert(connection, request._doc)
+                        details["nInserted"] += 1
+                    elif kind in ("UpdateOne", "UpdateMany", "ReplaceOne"):
+                        if kind == "ReplaceOne":
+                            matched, modified, upserted_id = self._replace_one(
+                                connection, request._filter, request._doc, request._upsert)
+                        else:
+                            matched, modified, upserted_id, _, _ = self._update(
+                                connection, request._filter, request._doc, request._upsert, multi=kind == "UpdateMany")
+                        details["nMatched"] += matched
+                        details["nModified"] += modified
+                        if upserted_id is not None:
+                            details["nUpserted"] += 1
+                            details["upserted"].append({"index": index, "_id": upserted_id})
+                    elif kind in ("DeleteOne", "DeleteMany"):
+                        details["nRemoved"] += self._delete(connection, request._filter, multi=kind == "DeleteMany")
+                    else:
+                        raise TypeError(f"{kind} is not supported by this storage backend")
+                except WriteError as e:
+                    details["writeErrors"].append({"index": index, "code": e.code, "errmsg": str(e), "op": repr(request)})
+                    if ordered:
+                        break
+        if details["writeErrors"]:
+            raise BulkWriteError(details)
+        return BulkWriteResult(details, True)
+
+    # Indexes
+
+    def create_index(self, keys, name=None, unique=False, expireAfterSeconds=None, **kwargs):
+        keys = _normalise_sort(keys)
+        for field, direction in keys:
+            if not _FIELD_PATTERN.match(field) or direction not in (1, -1):
+                raise OperationFailure(f"unsupported index key {field}: {direction}", code=67)
+        name = name or "_".join(f"{field}_{direction}" for field, direction in keys)
+        spec = {"key": keys, **({"unique": True} if unique else {}),
+                **({"expireAfterSeconds": expireAfterSeconds} if expireAfterSeconds is not None else {})}
+        existing = self.index_information().get(name)
+        if existing is not None:
+            existing.pop("v", None)
+            if existing != spec:
+                raise OperationFailure(f"An existing index has the same name as the requested index: {name}", code=86)
+            return name
+        columns = ", ".join(f"{_key_sql(field)} {'DESC' if direction < 0 else 'ASC'}" for field, direction in keys)
+        with self.database._transaction() as connection:
+            try:
+                connection.execute(f'CREATE {"UNIQUE " if unique else ""}INDEX "{self.name}/{name}" ON {self._table} ({columns})')
+            except sqlite3.IntegrityError as e:
+                raise OperationFailure(f"E11000 duplicate key error collection: {self.full_name} index: {name} ({e})", code=11000)
+            connection.execute("INSERT INTO _indexes (collection, name, spec) VALUES (?, ?, ?)",
+                               (self.name, name, json.dumps(spec)))
+        if expireAfterSeconds is not None:
+            self.database._start_ttl_monitor()
+        return name
+
+    def drop_index(self, index_or_name):
+        name = index_or_name if isinstance(index_or_name, str) else "_".join(f"{f}_{d}" for f, d in _normalise_sort(index_or_name))
+        if name == "_id_":
+            raise OperationFailure("cannot drop _id index", code=72)
+        with self.database._transaction() as connection:
+            if not connection.execute("DELETE FROM _indexes WHERE collection = ? AND name = ?", (self.name, name)).rowcount:
+                raise OperationFailure(f"index not found with name [{name}]", code=27)
+            connection.execute(f'DROP INDEX "{self.name}/{name}"')
+
+    def index_information(self):
+        info = {}
+        for name, spec in self.database._iterate("SELECT name, spec FROM _indexes WHERE collection = ?", (self.name,)):
+            spec = json.loads(spec)
+            spec["key"] = [(field, direction) for field, direction in spec["key"]]
+            info[name] = {"v": 2, **spec}
+        return info
+
+    def _set_ttl(self, key_pattern, seconds):
+        for name, info in self.index_information().items():
+            if dict(info["key"]) == dict(key_pattern) and "expireAfterSeconds" in info:
+                info.pop("v")
+                info["expireAfterSeconds"] = seconds
+                with self.database._transaction() as connection:
+                    connection.execute("UPDATE _indexes SET spec = ? WHERE collection = ? AND name = ?",
+                                       (json.dumps(info), self.name, name))
+                return
+        raise OperationFailure(f"cannot find index {key_pattern} for ns {self.full_name}", code=27)
+
+    def _expire(self):
+        """Delete what the TTL indexes say has expired (MongoDB's TTL monitor). Returns documents deleted."""
+        deleted = 0
+        now = datetime.now()
+        for info in self.index_information().values():
+            if "expireAfterSeconds" in info and len(info["key"]) == 1:
+                cutoff = now - timedelta(seconds=info["expireAfterSeconds"])
+                deleted += self.delete_many({info["key"][0][0]: {"$lt": cutoff}}).deleted_count
+        return deleted
+
+
+def _sorted_rows(rows, sort):
+    for field, direction in reversed(sort):
+        rows.sort(key=lambda row: _sort_key(_get(row[1], field)), reverse=direction < 0)
+    return rows
+
+
+def _id_filter(filter):
+    if filter is None:
+        return {}
+    return filter if isinstance(filter, dict) else {"_id": filter}
+
+
+def _update_raw(matched, modified, upserted_id):
+    raw = {"n": matched or int(upserted_id is not None), "nModified": modified}
+    if upserted_id is not None:
+        raw["upserted"] = upserted_id
+    return raw
+
+
+def _bulk_details():
+    return {"writeErrors": [], "writeConcernErrors": [], "nInserted": 0, "nUpserted": 0,
+            "nMatched": 0, "nModified": 0, "nRemoved": 0, "upserted": []}
+
+
+# --- Databases ---
+
+class Database:
+    """
+    One SQLite database. A file is opened once per thread in WAL mode, so
+    readers never wait for the writer and several processes can share it;
+    ":memory:" is a single connection shared (under a lock) by all threads.
+    """
+
+    def __init__(self, path, name="attendance"):
+        self.path = path
+        self.name = name
+        self._memory = path == ":memory:"
+        self._local = threading.local()
+        self._lock = threading.RLock() if self._memory else nullcontext()
+        self._shared = self._open() if self._memory else None
+        self._collections = {}
+        self._collections_lock = threading.Lock()
+        self._ttl_thread = None
+        with self._transaction() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS _indexes "
+                               "(collection TEXT NOT NULL, name TEXT NOT NULL, spec TEXT NOT NULL, PRIMARY KEY (collection, name))")
+        if any('"expireAfterSeconds"' in spec for spec, in self._iterate("SELECT spec FROM _indexes")):
+            self._start_ttl_monitor()
+
+    def __repr__(self):
+        return f"Database({self.path!r})"
+
+    def _open(self):
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        if not self._memory:
+            connection.execute("PRAGMA journal_mode=WAL")
+            # Durable at every checkpoint; a power cut may lose the last few commits, never corrupt
+            connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _connection(self):
+        if self._shared is not None:
+            return self._shared
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self._open()
+        return connection
+
+    def _iterate(self, sql, params=()):
+        """Rows of a query, fetched in FETCH_SIZE batches as they are consumed"""
+        with self._lock:
+            cursor = self._connection().execute(sql, params)
+        try:
+            while True:
+                with self._lock:
+                    rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            cursor.close()
+
+    @contextmanager
+    def _transaction(self):
+        """BEGIN IMMEDIATE ... COMMIT: a read-modify-write holds the write lock throughout"""
+        with self._lock:
+            connection = self._connection()
+            if connection.in_transaction:
+                yield connection
+                return
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def _create_table(self, name):
+        with self._transaction() as connection:
+            connection.execute(f'CREATE TABLE IF NOT EXISTS "{name}" (doc TEXT NOT NULL)')
+            connection.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS "{name}/_id_" ON "{name}" ({_key_sql("_id")})')
+            connection.execute("INSERT OR IGNORE INTO _indexes (collection, name, spec) VALUES (?, '_id_', ?)",
+                               (name, json.dumps({"key": [["_id", 1]]})))
+
+    def __getitem__(self, name):
+        with self._collections_lock:
+            if name not in self._collections:
+                self._collections[name] = Collection(self, name)
+            return self._collections[name]
+
+    get_collection = __getitem__
+
+    def list_collection_names(self):
+        return [name for name, in self._iterate(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name != '_indexes'")]
+
+    def command(self, command, value=None, **kwargs):
+        if command == "ping":
+            return {"ok": 1.0}
+        if command == "collMod":
+            index = kwargs.get("index") or {}
+            self[value]._set_ttl(index["keyPattern"], index["expireAfterSeconds"])
+            return {"ok": 1.0}
+        raise OperationFailure(f"no such command: '{command}'", code=59)
+
+    def expire(self):
+        """One TTL pass over every collection. Returns documents deleted."""
+        names = {name for name, in self._iterate("SELECT DISTINCT collection FROM _indexes")}
+        return sum(self[name]._expire() for name in names)
+
+    def _ttl_loop(self):
+        while True:
+            time.sleep(TTL_MONITOR_INTERVAL_SECONDS)
+            try:
+                self.expire()
+            except Exception as e:
+                print(f"❌ TTL pass failed: {e}")
+
+    def _start_ttl_monitor(self):
+        if self._ttl_thread is None:
+            self._ttl_thread = threading.Thread(target=self._ttl_loop, daemon=True)
+            self._ttl_thread.start()
+
+
+class Client:
+    """MongoClient stand-in: every database name maps to the one SQLite database at path"""
+
+    def __init__(self, path):
+        self.database = Database(path)
+        self.admin = self.database
+
+    def __repr__(self):
+        return f"Client({self.database.path!r})"
+
+    def __getitem__(self, name):
+        return self.database
+
+    get_database = __getitem__
+
+    def close(self):
+        pass
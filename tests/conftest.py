@@ -0,0 +1,64 @@
+"""
+Shared fixtures. Everything runs on the in-repo memory/sqlite backends;
+set TEST_MONGODB_URI to also run the storage tests against a real MongoDB.
+"""
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage
+
+BACKENDS = ["memory", "sqlite", "mongodb"]
+
+
+@pytest.fixture(params=BACKENDS)
+def database(request, tmp_path):
+    """An empty database on each backend"""
+    if request.param == "mongodb":
+        uri = os.getenv("TEST_MONGODB_URI")
+        if not uri:
+            pytest.skip("TEST_MONGODB_URI not set")
+        from pymongo import MongoClient
+        client = MongoClient(uri, serverSelectionTimeoutMS=5000)
+        name = f"storage_test_{uuid.uuid4().hex[:8]}"
+        yield client[name]
+        client.drop_database(name)
+        client.close()
+    else:
+        yield storage.connect(request.param, str(tmp_path / "test.sqlite3"))["test"]
+
+
+@pytest.fixture(scope="session")
+def api():
+    """qr_api on a private memory database; the janitor is off so tests control deletions"""
+    os.environ.update({
+        "STORAGE_BACKEND": "memory",
+        "JANITOR_ENABLED": "0",
+        "TRACE_SAMPLE_RATE": "0",
+    })
+    import qr_api
+    assert qr_api.wait_for_database(30)
+    return qr_api
+
+
+@pytest.fixture
+def client(api):
+    return api.app.test_client()
+
+
+@pytest.fixture
+def students(api):
+    """A small roster, removed again (with its marks) after the test"""
+    roster = [{"student_id": f"241000{i:04d}", "name": f"Student {i}", "department": "AIDS" if i % 2 else "CSE",
+               "year": "2024"} for i in range(6)]
+    api.students_collection.insert_many([dict(s) for s in roster])
+    api.roster_cache.invalidate()
+    yield roster
+    ids = {"$in": [s["student_id"] for s in roster]}
+    api.attendance_collection.delete_many({"student_id": ids})
+    api.students_collection.delete_many({"student_id": ids})
+    api.roster_cache.invalidate()
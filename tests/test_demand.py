@@ -0,0 +1,83 @@
+"""Demand-driven rotation: idle channels pause, /qr resumes them, followers' demand reaches the leader."""
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+
+def wait_until(predicate, timeout=6):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return predicate()
+
+
+@pytest.fixture
+def channel(api, monkeypatch):
+    """A one-second channel that goes idle one second after its last display request"""
+    monkeypatch.setattr(api, "QR_IDLE_TIMEOUT_SECONDS", 1)
+    api.qr_channels_collection.insert_one({"_id": "demand", "interval_seconds": 1, "validity_seconds": 30})
+    channel = api.qr_channels.get("demand")
+    yield channel
+    # Let the scheduler drop it on its next due tick
+    channel.last_demand, channel.shared_demand_at, channel.subscribers = float("-inf"), None, 0
+    wait_until(lambda: not channel.scheduled, 3)
+    api.qr_channels_collection.delete_one({"_id": "demand"})
+    api.qr_demand_collection.delete_one({"_id": "demand"})
+    api.qr_sessions_collection.delete_many({"channel": "demand"})
+
+
+def sessions(api):
+    return api.qr_sessions_collection.count_documents({"channel": "demand"})
+
+
+def test_in_demand(api, channel):
+    channel.last_demand, channel.shared_demand_at = float("-inf"), None
+    assert not channel.in_demand()
+    channel.subscribe(1)
+    assert channel.in_demand()
+    channel.subscribe(-1)
+    channel.shared_demand_at = datetime.now()
+    assert channel.in_demand()
+    channel.shared_demand_at = datetime.now() - timedelta(seconds=5)
+    assert not channel.in_demand()
+
+
+def test_idle_channel_pauses_and_qr_resumes_it(api, client, channel):
+    assert client.get("/qr?channel=demand").status_code == 200
+    assert channel.scheduled
+    assert wait_until(lambda: not channel.scheduled), "channel kept rotating without displays"
+    paused_at = sessions(api)
+    time.sleep(1.5)
+    assert sessions(api) == paused_at
+
+    resumes = api.scheduler_stats["resumes"]
+    first = client.get("/qr?channel=demand").json["session_id"]
+    assert channel.scheduled and api.scheduler_stats["resumes"] == resumes + 1
+    assert wait_until(lambda: client.get("/qr?channel=demand").json["session_id"] != first, 3)
+
+
+def test_follower_publishes_its_displays_demand(api, channel, monkeypatch):
+    monkeypatch.setattr(api, "is_generator_leader", lambda: False)
+    channel.subscribe(1)
+    api.activate_channel(channel)
+    try:
+        api.sync_channel_demand()
+    finally:
+        channel.subscribe(-1)
+    doc = api.qr_demand_collection.find_one({"_id": "demand"})
+    assert doc and datetime.now() - doc["last_demand_at"] < timedelta(seconds=5)
+
+
+def test_leader_resumes_a_channel_watched_on_another_worker(api, client, channel):
+    assert client.get("/qr?channel=demand").status_code == 200
+    channel.last_demand = float("-inf")
+    assert wait_until(lambda: not channel.scheduled)
+
+    # A display on another worker: only its demand record reaches this (leader) worker
+    api.qr_demand_collection.update_one({"_id": "demand"}, {"$set": {"last_demand_at": datetime.now()}}, upsert=True)
+    before = sessions(api)
+    assert wait_until(lambda: channel.scheduled, 4), "leader did not pick up the follower's demand"
+    assert wait_until(lambda: sessions(api) > before, 3)
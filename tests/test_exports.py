@@ -0,0 +1,37 @@
+"""Streamed exports: errors before the first chunk are 500s, later ones abort, and neither is cached."""
+import pytest
+
+
+@pytest.fixture
+def broken_roster(api, students, monkeypatch):
+    """The fixture roster with one student record the report cannot render, third in line"""
+    roster = sorted(students, key=lambda s: s["student_id"])
+    monkeypatch.setattr(api.roster_cache, "all", lambda: roster[:2] + [{"name": "no id"}] + roster[2:])
+    return roster
+
+
+def test_error_in_first_rows_is_a_500(client, broken_roster):
+    response = client.get("/download/excel?date=2003-04-05&format=csv")
+    assert response.status_code == 500
+    assert response.json["message"] == "Failed to generate Excel report"
+
+
+def test_xlsx_error_anywhere_is_a_500(client, broken_roster):
+    response = client.get("/download/excel?date=2003-04-06")
+    assert response.status_code == 500
+
+
+def test_error_mid_stream_aborts_and_is_not_cached(api, client, broken_roster, monkeypatch):
+    monkeypatch.setattr(api, "EXPORT_CHUNK_SIZE", 1)
+    response = client.get("/download/excel?date=2003-04-07&format=csv")
+    assert response.status_code == 200
+    with pytest.raises(KeyError):
+        response.get_data()
+    assert api.report_cache.get(response.headers["ETag"].strip('"')) is None
+
+
+def test_complete_export_is_cached(api, client, students):
+    response = client.get("/download/excel?date=2003-04-08&format=csv")
+    body = response.get_data()
+    assert response.status_code == 200 and students[0]["student_id"].encode() in body
+    assert api.report_cache.get(response.headers["ETag"].strip('"'))[0] == body
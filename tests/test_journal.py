@@ -0,0 +1,92 @@
+"""Write-behind journal: local dedupe, cross-worker check in /validate, orphan replay."""
+import os
+from datetime import datetime
+
+import pytest
+from bson import ObjectId, json_util
+
+
+def record(api, student_id, **fields):
+    return {
+        "_id": ObjectId(), "student_id": student_id, "student_name": "x", "department": "CSE", "year": "2024",
+        "qr_code": "CODE", "qr_session_id": ObjectId(), "marked_at": datetime.now(),
+        "session_date": datetime.now().replace(hour=0, minute=0, second=0, microsecond=0), "status": "present",
+        **fields,
+    }
+
+
+@pytest.fixture
+def journal(api, tmp_path, monkeypatch):
+    """A journal in a private directory, installed as this process's journal with the daily unique path on"""
+    monkeypatch.setattr(api, "ATTENDANCE_JOURNAL_DIR", str(tmp_path))
+    monkeypatch.setattr(api, "attendance_daily_unique", True)
+    journal = api.AttendanceJournal(str(tmp_path))
+    journal.open()
+    monkeypatch.setattr(api, "attendance_journal", journal)
+    yield journal
+    journal._file.close()
+
+
+def test_append_is_durable_and_dedupes_locally(api, journal, students):
+    first = record(api, students[0]["student_id"])
+    assert journal.append(first) is None
+    assert journal.append(record(api, students[0]["student_id"])) == first["marked_at"]
+    with open(journal.path, "rb") as f:
+        assert [json_util.loads(line)["_id"] for line in f] == [first["_id"]]
+    assert [r["_id"] for r in journal.take(0)] == [first["_id"]]
+    assert journal.backlog() == 1
+
+
+def test_done_truncates_once_everything_is_written(api, journal, students):
+    journal.append(record(api, students[0]["student_id"]))
+    journal.append(record(api, students[1]["student_id"]))
+    batch = journal.take(0)
+    journal.done(batch, batch[1:])
+    assert os.path.getsize(journal.path) > 0
+    journal.done(journal.take(0), [])
+    assert os.path.getsize(journal.path) == 0 and journal.backlog() == 0
+
+
+def test_validate_checks_marks_from_other_workers(api, client, journal, students, monkeypatch):
+    monkeypatch.setattr(api, "QR_TOKEN_MODE", "signed")
+    student_id = students[2]["student_id"]
+    # Written by another worker's journal: not in ours, only in the database
+    api.attendance_collection.insert_one(record(api, student_id))
+    token = api.generate_qr_token(ObjectId())
+    response = client.post("/validate", json={"qr_code": token, "student_id": student_id})
+    assert response.status_code == 400 and response.json["duplicate"]
+    assert journal.backlog() == 0
+
+
+def test_orphaned_journal_is_replayed_once(api, journal, students):
+    marks = [record(api, s["student_id"]) for s in students[:3]]
+    # The first was flushed before the crash, so replay finds it already there
+    api.attendance_collection.insert_one(dict(marks[0]))
+    orphan = os.path.join(api.ATTENDANCE_JOURNAL_DIR, "journal-dead-worker.jsonl")
+    with open(orphan, "wb") as f:
+        for mark in marks:
+            f.write(json_util.dumps(mark).encode("utf-8") + b"\n")
+        f.write(b'{"student_id": "torn')
+    before = dict(api.journal_stats)
+
+    api.replay_orphaned_journals()
+
+    assert not os.path.exists(orphan)
+    assert api.journal_stats["replayed_journals"] == before["replayed_journals"] + 1
+    assert api.journal_stats["inserted"] == before["inserted"] + 2
+    assert api.journal_stats["already_present"] == before["already_present"] + 1
+    for mark in marks:
+        assert api.attendance_collection.count_documents(api.attendance_key(mark)) == 1
+
+
+def test_journal_held_by_a_live_process_is_left_alone(api, journal, students):
+    other = api.AttendanceJournal(api.ATTENDANCE_JOURNAL_DIR)
+    other.path = os.path.join(api.ATTENDANCE_JOURNAL_DIR, "journal-live-worker.jsonl")
+    other.open()
+    try:
+        other.append(record(api, students[3]["student_id"]))
+        api.replay_orphaned_journals()
+        assert os.path.exists(other.path)
+        assert api.attendance_collection.count_documents({"student_id": students[3]["student_id"]}) == 0
+    finally:
+        other._file.close()
@@ -0,0 +1,95 @@
+"""Generator lease timing, leader takeover with KEEP_PREVIOUS_ACTIVE=0, and followers serving the leader's rotations."""
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+
+
+@pytest.fixture
+def channel(api):
+    api.qr_channels_collection.insert_one({"_id": "takeover", "interval_seconds": 60, "validity_seconds": 60})
+    yield api.qr_channels.get("takeover")
+    api.qr_channels_collection.delete_one({"_id": "takeover"})
+    api.qr_sessions_collection.delete_many({"channel": "takeover"})
+
+
+def test_lease_renews_well_inside_a_rotation(api):
+    assert api.QR_LEADER_LEASE_SECONDS <= api.QR_AUTO_REFRESH_INTERVAL / 2
+    # Worst-case takeover: the lease runs out, then a standby's next retry
+    assert api.QR_LEADER_LEASE_SECONDS * 4 / 3 <= api.QR_AUTO_REFRESH_INTERVAL
+
+
+def test_takeover_deactivates_the_old_leaders_sessions(api, channel, monkeypatch):
+    monkeypatch.setattr(api, "KEEP_PREVIOUS_ACTIVE", False)
+    now = datetime.now()
+    left_behind = [ObjectId() for _ in range(2)]
+    api.qr_sessions_collection.insert_many([{
+        "_id": session_id, "qr_code": f"OLD-{i}", "channel": "takeover", "is_active": True, "generator_token": 6,
+        "created_at": now, "expires_at": now + timedelta(seconds=60),
+    } for i, session_id in enumerate(left_behind)])
+    assert channel.current is None
+
+    api.rotate_channels([channel], generator_token=7)
+    first = channel.current["_id"]
+    active = [s["_id"] for s in api.qr_sessions_collection.find({"channel": "takeover", "is_active": True})]
+    assert active == [first]
+
+    api.rotate_channels([channel], generator_token=7)
+    active = [s["_id"] for s in api.qr_sessions_collection.find({"channel": "takeover", "is_active": True})]
+    assert active == [channel.current["_id"]] and channel.current["_id"] != first
+
+
+@pytest.fixture
+def follower(api, monkeypatch):
+    """This worker as a follower on a channel that another worker (the test) rotates"""
+    monkeypatch.setattr(api, "is_generator_leader", lambda: False)
+    api.qr_channels_collection.insert_one({"_id": "follower", "interval_seconds": 2, "validity_seconds": 60})
+    channel = api.qr_channels.get("follower")
+    channel.cache.invalidate()
+    yield channel
+    api.qr_channels_collection.delete_one({"_id": "follower"})
+    api.qr_sessions_collection.delete_many({"channel": "follower"})
+
+
+def leader_writes(api, code):
+    """Insert a rotation the way the leader in another worker would: straight to the database"""
+    now = datetime.now()
+    session = {"_id": ObjectId(), "qr_code": code, "channel": "follower", "is_active": True, "created_at": now,
+               "expires_at": now + timedelta(seconds=60), "session_name": code, "auto_generated": True}
+    api.qr_sessions_collection.insert_one(session)
+    return str(session["_id"])
+
+
+def test_follower_stream_picks_up_the_leaders_rotations(api, client, follower, monkeypatch):
+    assert not api.qr_session_watcher_active
+    monkeypatch.setattr(api, "QR_STREAM_HEARTBEAT_SECONDS", 10)
+    first = leader_writes(api, "F-1")
+    response = client.get("/qr/stream?channel=follower", buffered=False)
+    events = (chunk.decode() for chunk in response.response)
+    try:
+        assert next(events).startswith("retry:")
+        assert f"id: {first}\n" in next(events)
+        for i in (2, 3):
+            session_id = leader_writes(api, f"F-{i}")
+            started = time.monotonic()
+            event = next(events)
+            assert f"id: {session_id}\n" in event, event
+            assert time.monotonic() - started < follower.interval + 1
+    finally:
+        response.close()
+
+
+def test_follower_long_poll_picks_up_the_leaders_rotation(api, client, follower):
+    first = leader_writes(api, "P-1")
+    assert client.get(f"/qr/poll?channel=follower&since={first}&timeout=0.5").status_code == 204
+    second = []
+    writer = threading.Timer(0.3, lambda: second.append(leader_writes(api, "P-2")))
+    writer.start()
+    started = time.monotonic()
+    response = client.get(f"/qr/poll?channel=follower&since={first}&timeout=10")
+    writer.join()
+    assert response.status_code == 200
+    assert response.json["session_id"] == second[0]
+    assert time.monotonic() - started < follower.interval + 1
@@ -0,0 +1,58 @@
+"""Session listing aggregation: hide_empty filters before the attendee $lookup."""
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+
+DAY = datetime(2001, 2, 3)
+
+
+@pytest.fixture
+def sessions(api):
+    """Ten sessions a minute apart; every third is scanned, one is manual, one is a legacy used_by array"""
+    docs = []
+    for i in range(10):
+        created_at = DAY + timedelta(hours=9, minutes=i)
+        doc = {"_id": ObjectId(), "qr_code": f"LIST-{i}", "created_at": created_at,
+               "expires_at": created_at + timedelta(seconds=30), "auto_generated": i != 4, "used_by_count": 0}
+        if i % 3 == 0:
+            doc["used_by_count"] = 1
+        docs.append(doc)
+    docs[8].pop("used_by_count")
+    docs[8]["used_by"] = ["2410009999"]
+    api.qr_sessions_collection.insert_many(docs)
+    marks = [{"student_id": f"24100{i:05d}", "student_name": "x", "qr_session_id": d["_id"], "marked_at": d["created_at"],
+              "session_date": DAY} for i, d in enumerate(docs) if i % 3 == 0]
+    api.attendance_collection.insert_many(marks)
+    yield docs
+    api.qr_sessions_collection.delete_many({"_id": {"$in": [d["_id"] for d in docs]}})
+    api.attendance_collection.delete_many({"session_date": DAY})
+
+
+def listing(api, **kwargs):
+    pipeline = api.session_listing_pipeline(DAY, DAY + timedelta(days=1), **kwargs)
+    return list(api.qr_sessions_collection.aggregate(pipeline))
+
+
+def test_limit_comes_before_the_lookup(api):
+    stages = [next(iter(stage)) for stage in api.session_listing_pipeline(DAY, DAY + timedelta(days=1), hide_empty=True)]
+    assert stages.index("$limit") < stages.index("$lookup")
+    assert stages[:3] == ["$match", "$sort", "$limit"]
+
+
+def test_hide_empty_keeps_scanned_and_manual_sessions(api, sessions):
+    rows = listing(api, hide_empty=True, limit=20)
+    assert [r["qr_code"] for r in rows] == ["LIST-9", "LIST-8", "LIST-6", "LIST-4", "LIST-3", "LIST-0"]
+    assert {r["qr_code"]: r["attendance_count"] for r in rows}["LIST-6"] == 1
+
+
+def test_hide_empty_pages_fill_up(api, sessions):
+    first = listing(api, hide_empty=True, limit=2)
+    assert [r["qr_code"] for r in first] == ["LIST-9", "LIST-8", "LIST-6"]
+    last = first[1]
+    second = listing(api, hide_empty=True, limit=2, after=(last["created_at"], last["_id"]))
+    assert [r["qr_code"] for r in second] == ["LIST-6", "LIST-4", "LIST-3"]
+
+
+def test_without_hide_empty_every_session_is_listed(api, sessions):
+    assert len(listing(api, limit=20)) == 10
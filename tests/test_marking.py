@@ -0,0 +1,62 @@
+"""mark_attendance_once: one mark per student per day per channel, in one round trip."""
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+
+def record(student_id, **fields):
+    return {
+        "student_id": student_id, "student_name": "x", "department": "CSE", "year": "2024",
+        "qr_code": "CODE", "qr_session_id": ObjectId(), "marked_at": datetime.now().replace(microsecond=0),
+        "session_date": datetime.now().replace(hour=0, minute=0, second=0, microsecond=0), "status": "present",
+        **fields,
+    }
+
+
+def test_first_mark_is_inserted(api, students):
+    attendance_id, existing = api.mark_attendance_once(record(students[0]["student_id"]))
+    assert existing is None
+    assert api.attendance_collection.find_one({"_id": attendance_id})["student_id"] == students[0]["student_id"]
+
+
+def test_second_mark_returns_the_first(api, students):
+    first = record(students[1]["student_id"])
+    attendance_id, _ = api.mark_attendance_once(first)
+    later = record(students[1]["student_id"], marked_at=first["marked_at"] + timedelta(minutes=5), qr_code="LATER")
+    again_id, existing = api.mark_attendance_once(later)
+    assert again_id is None
+    assert existing["_id"] == attendance_id and existing["marked_at"] == first["marked_at"]
+    assert api.attendance_collection.count_documents({"student_id": students[1]["student_id"]}) == 1
+
+
+def test_other_channel_or_day_is_a_new_mark(api, students):
+    student_id = students[2]["student_id"]
+    today = record(student_id)
+    assert api.mark_attendance_once(today)[1] is None
+    assert api.mark_attendance_once(record(student_id, channel="lab-2"))[1] is None
+    yesterday = record(student_id, session_date=today["session_date"] - timedelta(days=1))
+    assert api.mark_attendance_once(yesterday)[1] is None
+    assert api.attendance_collection.count_documents({"student_id": student_id}) == 3
+
+
+def test_lost_upsert_race_is_a_duplicate(api, students, monkeypatch):
+    student_id = students[3]["student_id"]
+    winner = record(student_id)
+    api.attendance_collection.insert_one(dict(winner))
+
+    def collide(*args, **kwargs):
+        raise DuplicateKeyError("E11000 duplicate key error")
+
+    monkeypatch.setattr(api.attendance_collection, "find_one_and_update", collide)
+    attendance_id, existing = api.mark_attendance_once(record(student_id))
+    assert attendance_id is None and existing["marked_at"] == winner["marked_at"]
+
+
+def test_validate_reports_the_duplicate(api, client, students, monkeypatch):
+    monkeypatch.setattr(api, "QR_TOKEN_MODE", "signed")
+    student_id = students[4]["student_id"]
+    assert client.post("/validate", json={"qr_code": api.generate_qr_token(ObjectId()), "student_id": student_id}).status_code == 200
+    response = client.post("/validate", json={"qr_code": api.generate_qr_token(ObjectId()), "student_id": student_id})
+    assert response.status_code == 400 and response.json["duplicate"]
+    assert api.attendance_collection.count_documents({"student_id": student_id}) == 1
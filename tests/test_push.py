@@ -0,0 +1,98 @@
+"""Push channels: /qr/stream (Server-Sent Events) and the /qr/poll long-poll fallback."""
+import json
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def channel(api, client, monkeypatch):
+    """A channel this (leader) worker rotates only when the test says so"""
+    monkeypatch.setattr(api, "QR_STREAM_HEARTBEAT_SECONDS", 1)
+    api.qr_channels_collection.insert_one({"_id": "push", "interval_seconds": 600, "validity_seconds": 600})
+    channel = api.qr_channels.get("push")
+    assert client.get("/qr?channel=push").status_code == 200
+    yield channel
+    channel.last_demand, channel.shared_demand_at = float("-inf"), None
+    api.qr_channels_collection.delete_one({"_id": "push"})
+    api.qr_demand_collection.delete_one({"_id": "push"})
+    api.qr_sessions_collection.delete_many({"channel": "push"})
+
+
+def rotate(api, channel):
+    api.rotate_channels([channel], api.generator_lease["token"])
+    return str(channel.current["_id"])
+
+
+def parse_event(chunk):
+    fields = dict(line.split(": ", 1) for line in chunk.strip().split("\n"))
+    return fields["id"], fields["event"], json.loads(fields["data"])
+
+
+def open_stream(client, **headers):
+    response = client.get("/qr/stream?channel=push", headers=headers, buffered=False)
+    return response, (chunk.decode() for chunk in response.response)
+
+
+def test_stream_sends_the_current_code_then_each_rotation(api, client, channel):
+    current = str(channel.cache.snapshot()[0]["_id"])
+    response, events = open_stream(client)
+    try:
+        assert response.mimetype == "text/event-stream"
+        assert next(events) == "retry: 600000\n\n"
+        session_id, event, data = parse_event(next(events))
+        assert (session_id, event, data["session_id"], data["channel"]) == (current, "qr", current, "push")
+
+        rotated = rotate(api, channel)
+        session_id, _, data = parse_event(next(events))
+        assert session_id == rotated and data["data"] == channel.current["qr_code"]
+    finally:
+        response.close()
+
+
+def test_stream_resumes_from_last_event_id(api, client, channel):
+    seen = str(channel.cache.snapshot()[0]["_id"])
+    response, events = open_stream(client, **{"Last-Event-ID": seen})
+    try:
+        assert next(events).startswith("retry:")
+        # Nothing new yet: the display keeps its code and gets heartbeats
+        assert next(events) == ": keep-alive\n\n"
+        rotated = rotate(api, channel)
+        assert parse_event(next(events))[0] == rotated
+    finally:
+        response.close()
+
+    missed = rotate(api, channel)
+    response, events = open_stream(client, **{"Last-Event-ID": rotated})
+    try:
+        next(events)
+        assert parse_event(next(events))[0] == missed
+    finally:
+        response.close()
+
+
+def test_poll_times_out_with_204(client, channel):
+    current = str(channel.cache.snapshot()[0]["_id"])
+    started = time.monotonic()
+    response = client.get(f"/qr/poll?channel=push&since={current}&timeout=0.5")
+    assert response.status_code == 204 and response.data == b""
+    assert 0.4 < time.monotonic() - started < 3
+
+
+def test_poll_returns_on_rotation(api, client, channel):
+    current = str(channel.cache.snapshot()[0]["_id"])
+    rotated = []
+    timer = threading.Timer(0.3, lambda: rotated.append(rotate(api, channel)))
+    timer.start()
+    response = client.get(f"/qr/poll?channel=push&since={current}&timeout=10")
+    timer.join()
+    assert response.status_code == 200
+    assert response.json["session_id"] == rotated[0]
+
+
+def test_poll_with_an_old_id_returns_at_once(client, channel):
+    current = str(channel.cache.snapshot()[0]["_id"])
+    response = client.get("/qr/poll?channel=push&since=000000000000000000000000&timeout=10")
+    assert response.status_code == 200 and response.json["session_id"] == current
+    assert client.get("/qr/poll?channel=push&timeout=abc").status_code == 400
@@ -0,0 +1,39 @@
+"""/qr conditional GETs: the session id is the ETag, so polls between rotations are 304s."""
+import pytest
+
+
+@pytest.fixture
+def channel(api):
+    api.qr_channels_collection.insert_one({"_id": "etag", "interval_seconds": 600, "validity_seconds": 600})
+    yield api.qr_channels.get("etag")
+    api.qr_channels_collection.delete_one({"_id": "etag"})
+    api.qr_sessions_collection.delete_many({"channel": "etag"})
+
+
+def test_unchanged_code_is_not_modified(client, channel):
+    first = client.get("/qr?channel=etag")
+    assert first.status_code == 200, first.json
+    etag = first.headers["ETag"]
+    assert etag.strip('"') == first.json["session_id"]
+    assert first.headers["Cache-Control"] == "no-cache"
+
+    again = client.get("/qr?channel=etag", headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.data == b"" and again.headers["ETag"] == etag
+
+
+def test_rotation_changes_the_etag(api, client, channel):
+    etag = client.get("/qr?channel=etag").headers["ETag"]
+    api.rotate_channels([channel], api.generator_lease["token"])
+    response = client.get("/qr?channel=etag", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json["session_id"] == str(channel.current["_id"])
+
+
+def test_image_is_immutable(client, channel):
+    session_id = client.get("/qr?channel=etag").json["session_id"]
+    image = client.get(f"/qr/{session_id}.svg")
+    assert image.status_code == 200 and image.mimetype == "image/svg+xml"
+    again = client.get(f"/qr/{session_id}.svg", headers={"If-None-Match": image.headers["ETag"]})
+    assert again.status_code == 304
@@ -0,0 +1,59 @@
+"""report_version moves with every recorded mark, so cached reports and their ETags go stale."""
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+
+
+@pytest.fixture
+def signed(api, monkeypatch):
+    monkeypatch.setattr(api, "QR_TOKEN_MODE", "signed")
+    return api
+
+
+def today():
+    return datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def scan(client, api, session_id, student_id):
+    return client.post("/validate", json={"qr_code": api.generate_qr_token(session_id), "student_id": student_id})
+
+
+def test_mark_bumps_day_and_session(signed, client, students):
+    session_id = ObjectId()
+    before = signed.report_version(day=today(), session_id=session_id)
+    assert scan(client, signed, session_id, students[0]["student_id"]).status_code == 200
+    after = signed.report_version(day=today(), session_id=session_id)
+    day_id, session_key = f"day:{signed._day(today())}", f"session:{session_id}"
+    assert after[day_id] > before[day_id]
+    assert after[session_key] > before[session_key]
+    assert after["epoch"] == before["epoch"]
+
+
+def test_duplicate_scan_leaves_the_version_alone(signed, client, students):
+    session_id = ObjectId()
+    assert scan(client, signed, session_id, students[1]["student_id"]).status_code == 200
+    before = signed.report_version(day=today(), session_id=session_id)
+    assert scan(client, signed, session_id, students[1]["student_id"]).status_code == 400
+    assert signed.report_version(day=today(), session_id=session_id) == before
+
+
+def test_rebuild_starts_a_new_epoch(api):
+    before = api.report_version(day=today())
+    api.rebuild_rollups()
+    assert api.report_version(day=today())["epoch"] != before["epoch"]
+
+
+def test_cached_export_is_refreshed_by_a_mark(signed, client, students):
+    path = f"/download/excel?date={today():%Y-%m-%d}&format=csv"
+    first = client.get(path)
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+    assert client.get(path, headers={"If-None-Match": etag}).status_code == 304
+
+    student_id = students[2]["student_id"]
+    assert scan(client, signed, ObjectId(), student_id).status_code == 200
+    fresh = client.get(path, headers={"If-None-Match": etag})
+    assert fresh.status_code == 200 and fresh.headers["ETag"] != etag
+    row = next(line for line in fresh.get_data(as_text=True).splitlines() if line.startswith(student_id))
+    assert "Present" in row
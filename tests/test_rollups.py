@@ -0,0 +1,60 @@
+from datetime import datetime
+
+from bson import ObjectId
+
+
+def mark(api, student_id, session_id, department="CSE"):
+    now = datetime.now()
+    record = {"_id": ObjectId(), "student_id": student_id, "qr_session_id": session_id, "department": department,
+              "marked_at": now, "session_date": now.replace(hour=0, minute=0, second=0, microsecond=0)}
+    api.attendance_collection.insert_one(record)
+    return record
+
+
+def test_rebuild_swaps_in_place_and_keeps_new_counters(api):
+    session_id = ObjectId()
+    mark(api, "2410990001", session_id)
+    api.rollups_collection.insert_one({"_id": "session:stale", "attendance": 7, "kind": "session"})
+    epoch = api.rollups_collection.find_one({"_id": "total"}, {"epoch": 1})
+    real_bulk_write = api.rollups_collection.bulk_write
+
+    # A mark counted after the rebuild has aggregated must not be deleted as stale
+    late_session = ObjectId()
+    def mark_then_write(*args, **kwargs):
+        if not api.attendance_collection.find_one({"qr_session_id": late_session}):
+            api.record_attendance_rollup(mark(api, "2410990002", late_session))
+        return real_bulk_write(*args, **kwargs)
+    api.rollups_collection.bulk_write = mark_then_write
+    try:
+        api.rebuild_rollups()
+    finally:
+        del api.rollups_collection.bulk_write
+
+    assert api.rollups_collection.find_one({"_id": "session:stale"}) is None
+    assert api.rollups_collection.find_one({"_id": f"session:{session_id}"})["attendance"] == 1
+    assert api.rollups_collection.find_one({"_id": f"session:{late_session}"})["attendance"] == 1
+    assert api.rollups_collection.find_one({"_id": "total"})["epoch"] != (epoch or {}).get("epoch")
+
+
+def test_rebuild_is_repeatable(api):
+    mark(api, "2410990003", ObjectId())
+    api.rebuild_rollups()
+    first = {d["_id"]: d.get("attendance") for d in api.rollups_collection.find({}, {"attendance": 1})}
+    api.rebuild_rollups()
+    second = {d["_id"]: d.get("attendance") for d in api.rollups_collection.find({}, {"attendance": 1})}
+    assert first == second
+
+
+def test_backfill_runs_in_one_worker(api):
+    api.rollups_collection.delete_many({"_id": "total"})
+    api.leases_collection.delete_many({"_id": "rollup-backfill"})
+    api.leases_collection.insert_one({"_id": "rollup-backfill", "holder": "other-worker", "token": 1,
+                                      "expires_at": datetime(2100, 1, 1)})
+    api.backfill_rollups()
+    assert api.rollups_collection.find_one({"_id": "total"}) is None
+
+    api.leases_collection.delete_many({"_id": "rollup-backfill"})
+    api.backfill_rollups()
+    assert api.rollups_collection.find_one({"_id": "total"}) is not None
+    # Released, so the next backfill (or a restart) need not wait for it to expire
+    assert api.leases_collection.find_one({"_id": "rollup-backfill"})["expires_at"] <= datetime.now()
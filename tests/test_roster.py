@@ -0,0 +1,49 @@
+"""Roster import from the roster shipped with the repo, and reports over what it imports."""
+import csv
+import io
+import os
+
+import pytest
+
+ROSTER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Y24 - AIDS LIST (2).xlsx")
+
+
+def upload(client, **values):
+    with open(ROSTER, "rb") as f:
+        return client.post("/students/import", data={"file": (f, os.path.basename(ROSTER)), **values},
+                           content_type="multipart/form-data")
+
+
+@pytest.fixture
+def imported(api, client):
+    response = upload(client)
+    assert response.status_code == 200, response.json
+    yield response.json
+    api.students_collection.delete_many({"student_id": {"$gte": "2410080000", "$lt": "2410090000"}})
+    api.roster_cache.invalidate()
+
+
+def test_shipped_roster_imports(api, imported):
+    assert imported["rows"] == 83 and imported["inserted"] == 83 and imported["rejected"] == 0
+    student = api.students_collection.find_one({"student_id": "2410080001"})
+    assert student["name"] == "DIVIJ MAZUMDAR" and student["department"] == "B.Tech - AI&DS"
+    assert "year" not in student
+
+
+def test_report_over_a_roster_without_years(client, imported):
+    response = client.get("/download/excel?format=csv")
+    assert response.status_code == 200
+    rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+    students = [row for row in rows if row and row[0].startswith("24100800")]
+    assert len(students) == 83
+    assert students[0][2:4] == ["B.Tech - AI&DS", ""]
+
+
+def test_reimport_only_touches_changed_students(api, client, imported):
+    api.students_collection.update_one({"student_id": "2410080002"}, {"$set": {"name": "Renamed"}})
+    before = {s["student_id"]: s["updated_at"] for s in api.students_collection.find({"student_id": {"$gte": "2410080000", "$lt": "2410090000"}})}
+    again = upload(client).json
+    assert (again["inserted"], again["updated"], again["unchanged"]) == (0, 1, 82)
+    after = {s["student_id"]: s["updated_at"] for s in api.students_collection.find({"student_id": {"$gte": "2410080000", "$lt": "2410090000"}})}
+    assert [sid for sid in after if after[sid] != before[sid]] == ["2410080002"]
+    assert upload(client).json["unchanged"] == 83
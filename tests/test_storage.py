@@ -0,0 +1,209 @@
+"""The same operations on every backend must give MongoDB's results"""
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import storage
+
+DAY = datetime(2026, 10, 17)
+
+
+def make_attendance(collection):
+    docs = []
+    for i in range(40):
+        doc = {
+            "_id": ObjectId(f"{i + 1:024x}"),
+            "student_id": f"24{i % 10:04d}",
+            "session_date": DAY - timedelta(days=i % 3),
+            "marked_at": DAY + timedelta(minutes=i),
+            "qr_session_id": ObjectId(f"{i % 4 + 100:024x}"),
+            "n": i % 5,
+            "flag": i % 2 == 0,
+            "meta": {"room": f"R{i % 4}"},
+        }
+        if i % 7:
+            doc["channel"] = None if i % 3 == 0 else "ch:a"
+        docs.append(doc)
+    collection.insert_many(docs)
+    collection.create_index([("student_id", 1), ("session_date", 1)])
+    collection.create_index([("qr_session_id", 1), ("marked_at", 1)])
+    return docs
+
+
+def ids(docs):
+    return sorted(int(str(d["_id"]), 16) for d in docs)
+
+
+QUERIES = [
+    {},
+    {"student_id": "240003"},
+    {"channel": None},
+    {"channel": "ch:a"},
+    {"channel": {"$exists": False}},
+    {"channel": {"$ne": None}},
+    {"n": {"$gt": 2}},
+    {"n": {"$gte": 1, "$lt": 3}},
+    {"n": {"$in": [0, 4]}},
+    {"flag": True},
+    {"flag": 1},
+    {"meta.room": "R1"},
+    {"session_date": DAY},
+    {"marked_at": {"$gte": DAY + timedelta(minutes=10), "$lt": DAY + timedelta(minutes=20)}},
+    {"qr_session_id": {"$in": [ObjectId(f"{101:024x}"), ObjectId(f"{102:024x}")]}},
+    {"$or": [{"n": 1}, {"flag": True}]},
+    {"$and": [{"n": {"$ne": 1}}, {"student_id": {"$in": ["240001", "240002"]}}]},
+]
+
+
+@pytest.mark.parametrize("query", QUERIES, ids=[str(q) for q in QUERIES])
+def test_find_matches_python_semantics(database, query):
+    docs = make_attendance(database["attendance"])
+    expected = [d for d in docs if storage._matches(storage._loads(storage._dumps(d)), query)]
+    assert ids(database["attendance"].find(query)) == ids(expected)
+    assert database["attendance"].count_documents(query) == len(expected)
+
+
+def test_bool_is_not_number(database):
+    make_attendance(database["attendance"])
+    assert database["attendance"].count_documents({"flag": True}) == 20
+    assert database["attendance"].count_documents({"flag": 1}) == 0
+
+
+def test_sort_limit_and_projection(database):
+    make_attendance(database["attendance"])
+    found = list(database["attendance"].find(
+        {"n": {"$lt": 2}}, {"_id": 0, "student_id": 1, "marked_at": 1}
+    ).sort([("n", -1), ("marked_at", 1)]).limit(3))
+    assert found == [
+        {"student_id": "240001", "marked_at": DAY + timedelta(minutes=1)},
+        {"student_id": "240006", "marked_at": DAY + timedelta(minutes=6)},
+        {"student_id": "240001", "marked_at": DAY + timedelta(minutes=11)},
+    ]
+
+
+def test_sql_filter_pushdown():
+    where, params = storage._sql_filter({"student_id": "240001", "n": {"$gte": 1, "$in": [1, 2]}, "flag": True})
+    assert where.count("json_extract") == 4
+    assert params == ["240001", 1, 1, 2, 1]
+    # Only narrows: what SQL cannot express is left to the Python re-check
+    assert storage._sql_filter({"student_id": {"$regex": "^24"}}) == ("", [])
+    assert storage._sql_filter({"$or": [{"n": 1}, {"student_id": {"$regex": "x"}}]}) == ("", [])
+    where, params = storage._sql_filter({"channel": None})
+    assert params == [float("-inf")]
+
+
+def test_indexed_query_uses_index():
+    collection = storage.connect("memory")["test"]["attendance"]
+    make_attendance(collection)
+    plan = collection.find({"qr_session_id": ObjectId(f"{101:024x}")}).sort("marked_at", 1).explain()
+    stages = plan["queryPlanner"]["winningPlan"]["inputStages"]
+    assert stages == [{"stage": "IXSCAN", "indexName": "qr_session_id_1_marked_at_1"}]
+
+
+def test_python_sort_on_unindexable_field(database):
+    # Field names SQLite cannot ORDER BY are sorted in Python; the scan must still close cleanly
+    collection = database["things"]
+    collection.insert_many([{"_id": 1, "a": {"b-c": 2}}, {"_id": 2, "a": {"b-c": 1}}])
+    before = collection.find_one_and_update({}, {"$set": {"z": 1}}, sort=[("a.b-c", 1)])
+    assert before["_id"] == 2
+    assert collection.find_one({"z": 1})["_id"] == 2
+    assert collection.delete_one({"a.b-c": {"$gt": 1}}).deleted_count == 1
+    assert [d["_id"] for d in collection.find()] == [2]
+
+
+def test_lookup_pipeline(database):
+    attendance = database["attendance"]
+    make_attendance(attendance)
+    sessions = database["sessions"]
+    sessions.insert_many([{"_id": ObjectId(f"{100 + i:024x}"), "name": f"S{i}", "created_at": DAY + timedelta(hours=i)}
+                          for i in range(5)])
+    listing = list(sessions.aggregate([
+        {"$match": {"created_at": {"$gte": DAY}}},
+        {"$sort": {"created_at": -1}},
+        {"$lookup": {
+            "from": "attendance",
+            "let": {"sid": "$_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$qr_session_id", "$$sid"]}}},
+                {"$sort": {"marked_at": 1}},
+                {"$project": {"_id": 0, "student_id": 1}},
+            ],
+            "as": "attendees",
+        }},
+        {"$addFields": {"attendance_count": {"$size": "$attendees"}}},
+        {"$project": {"_id": 0, "name": 1, "attendance_count": 1, "attendees": 1}},
+    ]))
+    assert [(s["name"], s["attendance_count"]) for s in listing] == [
+        ("S4", 0), ("S3", 10), ("S2", 10), ("S1", 10), ("S0", 10)]
+    assert listing[1]["attendees"][:3] == [{"student_id": "240003"}, {"student_id": "240007"}, {"student_id": "240001"}]
+
+
+def test_group_and_count(database):
+    make_attendance(database["attendance"])
+    grouped = list(database["attendance"].aggregate([
+        {"$match": {"session_date": DAY}},
+        {"$group": {"_id": "$meta.room", "marks": {"$sum": 1}, "last": {"$max": "$marked_at"}}},
+        {"$sort": {"_id": 1}},
+    ]))
+    assert grouped == [
+        {"_id": "R0", "marks": 4, "last": DAY + timedelta(minutes=36)},
+        {"_id": "R1", "marks": 3, "last": DAY + timedelta(minutes=33)},
+        {"_id": "R2", "marks": 3, "last": DAY + timedelta(minutes=30)},
+        {"_id": "R3", "marks": 4, "last": DAY + timedelta(minutes=39)},
+    ]
+
+
+def test_upsert_return_document_before(database):
+    collection = database["marks"]
+    collection.create_index([("student_id", 1), ("session_date", 1)], unique=True)
+    update = {"$setOnInsert": {"marked_at": DAY}, "$inc": {"scans": 1}}
+    key = {"student_id": "240001", "session_date": DAY}
+
+    assert collection.find_one_and_update(key, update, upsert=True, return_document=ReturnDocument.BEFORE) is None
+    before = collection.find_one_and_update(key, update, upsert=True, return_document=ReturnDocument.BEFORE,
+                                            projection={"_id": 0})
+    assert before == {"student_id": "240001", "session_date": DAY, "marked_at": DAY, "scans": 1}
+    after = collection.find_one_and_update(key, update, upsert=True, return_document=ReturnDocument.AFTER,
+                                           projection={"_id": 0, "scans": 1})
+    assert after == {"scans": 3}
+    assert collection.count_documents({}) == 1
+
+    with pytest.raises(DuplicateKeyError):
+        collection.insert_one({"student_id": "240001", "session_date": DAY})
+
+
+def test_unique_index_treats_null_and_missing_alike(database):
+    collection = database["channels"]
+    collection.create_index([("student_id", 1), ("channel", 1)], unique=True)
+    collection.insert_one({"student_id": "240001"})
+    with pytest.raises(DuplicateKeyError):
+        collection.insert_one({"student_id": "240001", "channel": None})
+    collection.insert_one({"student_id": "240001", "channel": "ch:a"})
+
+
+def test_ttl_index(database):
+    collection = database["sessions"]
+    collection.create_index([("expires_at", 1)], expireAfterSeconds=60)
+    now = datetime.now().replace(microsecond=0)
+    collection.insert_many([{"_id": 1, "expires_at": now - timedelta(minutes=5)},
+                            {"_id": 2, "expires_at": now}])
+    info = [i for i in collection.index_information().values() if "expireAfterSeconds" in i]
+    assert info and info[0]["expireAfterSeconds"] == 60
+    if isinstance(database, storage.Database):
+        # MongoDB's monitor runs every 60s; the embedded one can be run on demand
+        assert database.expire() == 1
+        assert [d["_id"] for d in collection.find()] == [2]
+
+
+def test_replace_one_and_bulk_replace(database):
+    from pymongo import ReplaceOne
+    collection = database["rollups"]
+    result = collection.replace_one({"_id": "total"}, {"sessions": 1}, upsert=True)
+    assert result.upserted_id == "total"
+    assert collection.replace_one({"_id": "total"}, {"sessions": 2}).modified_count == 1
+    collection.bulk_write([ReplaceOne({"_id": "total"}, {"sessions": 3}, upsert=True),
+                           ReplaceOne({"_id": "day:x"}, {"_id": "day:x", "sessions": 1}, upsert=True)])
+    assert sorted((d["_id"], d["sessions"]) for d in collection.find()) == [("day:x", 1), ("total", 3)]
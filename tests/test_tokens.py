@@ -0,0 +1,109 @@
+"""Signed QR tokens: verification in CPU, and /validate taking the channel from the token."""
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+
+
+@pytest.fixture
+def signed(api, monkeypatch):
+    monkeypatch.setattr(api, "QR_TOKEN_MODE", "signed")
+    return api
+
+
+@pytest.fixture
+def lab(api, client):
+    """A named channel with a '.' in it, so the token format has to cope"""
+    response = client.post("/qr/channels", json={"name": "lab.1", "interval_seconds": 60, "validity_seconds": 90})
+    assert response.status_code in (200, 201)
+    yield "lab.1"
+    api.qr_channels_collection.delete_one({"_id": "lab.1"})
+    api.qr_channels.expire_config("lab.1")
+
+
+def test_round_trip(api):
+    session_id = ObjectId()
+    assert api.verify_qr_token(api.generate_qr_token(session_id)) == (session_id, None)
+    assert api.verify_qr_token(api.generate_qr_token(session_id, "lab.1")) == (session_id, "lab.1")
+
+
+def test_default_token_stays_alphanumeric(api):
+    token = api.generate_qr_token(ObjectId())
+    assert token == token.upper() and token.count(".") == 1
+
+
+@pytest.mark.parametrize("tamper", [
+    lambda t: t[:-1] + ("A" if t[-1] != "A" else "B"),
+    lambda t: t.replace(".", ".other.", 1),
+    lambda t: "0" * 24 + t[24:],
+    lambda t: "junk",
+    lambda t: "",
+])
+def test_tampered_tokens_are_rejected(api, tamper):
+    token = api.generate_qr_token(ObjectId(), "lab.1")
+    assert api.verify_qr_token(tamper(token)) is None
+
+
+def test_channel_is_part_of_the_signature(api):
+    session_id = ObjectId()
+    sid, _, signature = api.generate_qr_token(session_id).partition(".")
+    assert api.verify_qr_token(f"{sid}.lab.1.{signature}") is None
+
+
+def test_expiry_comes_from_the_session_id(api):
+    issued = datetime.now().replace(microsecond=0) - timedelta(seconds=100)
+    session_id = ObjectId.from_datetime(issued.astimezone())
+    expires_at = api.qr_token_expiry(session_id, 30)
+    assert expires_at < datetime.now()
+    assert api.qr_token_expiry(session_id, 200) > datetime.now()
+
+
+def validate(client, token, student_id, **extra):
+    return client.post("/validate", json={"qr_code": token, "student_id": student_id, **extra})
+
+
+def test_named_channel_token_needs_no_channel_param(signed, client, students, lab):
+    response = validate(client, signed.generate_qr_token(ObjectId(), lab), students[0]["student_id"])
+    assert response.status_code == 200, response.json
+    mark = signed.attendance_collection.find_one({"student_id": students[0]["student_id"]})
+    assert mark["channel"] == lab
+
+
+def test_matching_channel_param_is_accepted(signed, client, students, lab):
+    response = validate(client, signed.generate_qr_token(ObjectId(), lab), students[1]["student_id"], channel=lab)
+    assert response.status_code == 200, response.json
+
+
+def test_disagreeing_channel_param_is_rejected(signed, client, students, lab):
+    response = validate(client, signed.generate_qr_token(ObjectId(), lab), students[2]["student_id"], channel="default")
+    assert response.status_code == 400
+    assert response.json["message"] == "This QR code belongs to a different class"
+
+
+def test_expired_token_is_rejected(signed, client, students, lab):
+    old = ObjectId.from_datetime(datetime.now().astimezone() - timedelta(seconds=600))
+    response = validate(client, signed.generate_qr_token(old, lab), students[3]["student_id"])
+    assert response.status_code == 400
+    assert "expired" in response.json["message"]
+
+
+def test_token_for_unknown_channel_is_invalid(signed, client, students):
+    response = validate(client, signed.generate_qr_token(ObjectId(), "no-such-class"), students[4]["student_id"])
+    assert response.status_code == 400
+    assert response.json["message"] == "Invalid QR code"
+
+
+def test_random_mode_rejects_the_same_mismatch(api, client, students, lab):
+    session_id = ObjectId()
+    api.qr_sessions_collection.insert_one({
+        "_id": session_id, "qr_code": "RANDOM-LAB-CODE", "channel": lab, "is_active": True,
+        "created_at": datetime.now(), "expires_at": datetime.now() + timedelta(seconds=60),
+    })
+    try:
+        student_id = students[5]["student_id"]
+        response = validate(client, "RANDOM-LAB-CODE", student_id, channel="default")
+        assert response.status_code == 400
+        assert response.json["message"] == "This QR code belongs to a different class"
+        assert validate(client, "RANDOM-LAB-CODE", student_id).status_code == 200
+    finally:
+        api.qr_sessions_collection.delete_one({"_id": session_id})